@@ -16,9 +16,14 @@ setup(
         'lxml',
         'argparse',
         ],
+    extras_require={
+        'watch': ['pyinotify'],
+        },
     entry_points={
         'console_scripts': [
             'r53 = r53.r53:main',
+            'r53-bench = r53.bench:main',
+            'r53-fakeroute53 = r53.fakeroute53:main',
             ],
         },
     zip_safe=False,
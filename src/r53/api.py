@@ -0,0 +1,195 @@
+"""Plan and push Route 53 configs from Python.
+
+r53.main parses arguments, prints, prompts and exits; none of that happens
+here. A Client is built from the connection, zone ID cache, rate limiter
+and snapshot store it should use, so a long-running service can keep one
+around, share it between threads and make many calls over the same open
+connection. Plans and results come back as objects rather than text:
+
+  client = api.Client(r53.connect(), limiter=r53.RateLimiter(5))
+  plan = client.plan('foursquare.com', 'foursquare.com.xml')
+  if plan.changes and not plan.errors:
+    result = client.push(plan, wait=600)
+
+validate and diff work on local configs and need no connection at all.
+"""
+
+import collections
+import time
+import r53
+
+
+class InvalidPlanError(Exception):
+  """Raised when asked to push a plan that failed validation.
+
+  Attributes: errors: [ error strings ], as in Plan.errors."""
+
+  def __init__(self, zone, errors):
+    Exception.__init__(self, '%s: %s' % (zone, '; '.join(errors)))
+    self.errors = errors
+
+
+class Plan(collections.namedtuple('Plan', 'zone zone_id config changes batches errors')):
+  """What pushing a config to a zone would change.
+
+  Fields: zone: string eg. foursquare.com, or None.
+          zone_id: hosted zone ID, or None for a diff of local configs.
+          config: [ RRSet ], the config to push.
+          changes: [ (action, RRSet) ] in the order they would be made.
+          batches: [ [ (action, RRSet) ] ], the changes split into requests.
+          errors: [ error strings ]; if any, Route 53 would reject the
+            changes and push refuses them."""
+  __slots__ = ()
+
+  def changeset(self, comment=None):
+    """Returns: lxml.etree.Element (<ChangeResourceRecordSetsRequest>)
+    holding every change, as generate_changeset would make."""
+    return r53.changes_to_xml(self.changes, comment)
+
+
+# changes is the number made; waits is [ r53.ChangeWait ] when push waited.
+PushResult = collections.namedtuple('PushResult', 'zone zone_id changes change_ids waits')
+
+
+def _config(config, format, origin):
+  """Returns: [ RRSet ], config itself if it is a list and else read from
+  it; see r53.read_config."""
+  if isinstance(config, list):
+    return config
+  return r53.read_config(config, format, origin)
+
+
+def validate(config, format=None, origin=None):
+  """Check a config without Route 53; see r53.check_config.
+
+  Args: config: [ RRSet ], or a filename or open file to read one from.
+        format, origin: see r53.read_config.
+  Returns: [ errors ] list of error strings or []."""
+  return r53.check_config(_config(config, format, origin))
+
+
+def diff(old, new, format=None, origin=None, processes=1):
+  """Plan turning one local config into another, as if old were live.
+
+  Args: old, new: see validate; either may be a snapshot.
+        format, origin: see r53.read_config.
+        processes: see r53.diff_rrsets.
+  Returns: Plan with no zone_id; it cannot be pushed."""
+  old, new = _config(old, format, origin), _config(new, format, origin)
+  changes, batches, errors = r53.plan_push(old, new, processes=processes)
+  return Plan(origin, None, new, changes, batches, errors)
+
+
+class Client(object):
+  """Route 53 operations that return their results and raise their errors.
+
+  Zone IDs are remembered for the life of the client. Safe to use from
+  several threads at once.
+
+  Args: conn: connection to Route 53, eg. from r53.connect; a new one
+          to endpoint if None.
+        cache: optional r53.ZoneCache, shared with other clients and runs.
+        limiter: optional r53.RateLimiter. conn is wrapped in an
+          r53.ThrottledConnection using it, unless it is one already;
+          clients on one account should share a limiter.
+        store: optional snapshot.SnapshotStore; zones fetched or pushed
+          are snapshotted in it.
+        max_age: seconds a snapshot in store may stand in for fetching a
+          zone; see r53.get_live_config.
+        retries: see r53.ThrottledConnection.
+        endpoint: see r53.connect."""
+
+  def __init__(self, conn=None, cache=None, limiter=None, store=None, max_age=0, retries=8,
+               endpoint=None):
+    if conn is None:
+      conn = r53.connect(endpoint)
+    if limiter is not None and not isinstance(conn, r53.ThrottledConnection):
+      conn = r53.ThrottledConnection(conn, limiter, retries)
+    self.conn = conn
+    self.cache = cache
+    self.store = store
+    self.max_age = max_age
+    self.zones = {}
+
+  def lookup_zone(self, zone):
+    """Returns: zone ID eg. ZE2DYFZDWGSL4.
+
+    Raises: r53.ZoneNotFoundError"""
+    zone = zone.rstrip('.')
+    zone_id = self.zones.get(zone)
+    if zone_id is None:
+      zone_id = self.zones[zone] = r53.lookup_zone(self.conn, zone, cache=self.cache)
+    return zone_id
+
+  def forget_zone(self, zone):
+    """Drop a zone's ID, eg. once the zone has been deleted and recreated."""
+    zone = zone.rstrip('.')
+    self.zones.pop(zone, None)
+    if self.cache is not None:
+      self.cache.invalidate(zone)
+
+  def fetch(self, zone, shards=1):
+    """Get a zone's live config.
+
+    Args: zone: string eg. foursquare.com
+          shards: see r53.get_live_config.
+    Returns: [ RRSet ]
+    Raises: r53.ZoneNotFoundError; boto.route53.exception.DNSServerError.
+            A zone whose ID turns out to be stale is forgotten, so asking
+            again looks it up afresh."""
+    zone_id = self.lookup_zone(zone)
+    try:
+      return r53.get_live_config(self.conn, zone_id, self.store, self.max_age, shards)
+    except Exception as e:
+      if getattr(e, 'error_code', None) == 'NoSuchHostedZone':
+        self.forget_zone(zone)
+      raise
+
+  def plan(self, zone, config, format=None, processes=1, shards=1):
+    """Work out what pushing config to zone would change, changing nothing.
+
+    Args: zone: string eg. foursquare.com
+          config: see validate.
+          format: see r53.read_config.
+          processes: see r53.diff_rrsets.
+          shards: see fetch.
+    Returns: Plan
+    Raises: as fetch."""
+    config = _config(config, format, zone)
+    live = self.fetch(zone, shards)
+    zone_id = self.lookup_zone(zone)
+    changes, batches, errors = r53.plan_push(live, config, zone_id, processes=processes)
+    return Plan(zone, zone_id, config, changes, batches, errors)
+
+  def push(self, plan, comment=None, wait=None):
+    """Make a plan's changes.
+
+    Args: plan: Plan, from plan.
+          comment: see r53.submit_batches.
+          wait: seconds to wait for the changes to reach every Route 53
+            server, or None not to wait; see r53.wait_for_changes.
+    Returns: PushResult
+    Raises: InvalidPlanError if the plan has errors or no zone_id;
+            boto.route53.exception.DNSServerError if Route 53 rejects it."""
+    if plan.zone_id is None:
+      raise InvalidPlanError(plan.zone, ['a diff of local configs cannot be pushed'])
+    if plan.errors:
+      raise InvalidPlanError(plan.zone, plan.errors)
+    if not plan.changes:
+      return PushResult(plan.zone, plan.zone_id, 0, [], [])
+    start = time.time()
+    change_ids = r53.submit_batches(self.conn, plan.zone_id, plan.batches, comment)
+    if self.store is not None:
+      r53.save_snapshot(self.store, plan.zone_id, plan.config)
+    waits = []
+    if wait is not None:
+      waits = r53.wait_for_changes(self.conn, change_ids, wait, start)
+    return PushResult(plan.zone, plan.zone_id, len(plan.changes), change_ids, waits)
+
+  def sync(self, zone, config, format=None, comment=None, wait=None):
+    """Plan and push in one go.
+
+    Args: see plan and push.
+    Returns: PushResult
+    Raises: as push."""
+    return self.push(self.plan(zone, config, format), comment, wait)
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from boto.route53.exception import DNSServerError
+import api
+import fakeroute53
+import r53
+
+class ApiTest(unittest.TestCase):
+  """Tests for functions in api.py, against fakeroute53."""
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.route53 = fakeroute53.FakeRoute53()
+    self.rrsets = [r53.RRSet('host%d.example.com.' % i, 'A', ttl='60', values=['192.168.0.%d' % i])
+                   for i in range(5)]
+    self.zone_id = self.route53.add_zone('example.com', self.rrsets)
+    self.server = fakeroute53.Server(('localhost', 0), self.route53)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.limiter = r53.RateLimiter(1000)
+    self.cache = r53.ZoneCache(os.path.join(self.tmpdir, 'zones.json'))
+    self.client = api.Client(r53.connect(self.server.endpoint), self.cache, self.limiter)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmpdir)
+
+  def test_plan_and_push(self):
+    self.assertTrue(isinstance(self.client.conn, r53.ThrottledConnection))
+    self.assertTrue(self.client.conn.limiter is self.limiter)
+    new = self.rrsets[1:] + [r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.1.1'])]
+    plan = self.client.plan('example.com', new)
+    self.assertEqual((plan.zone_id, plan.errors), (self.zone_id, []))
+    self.assertEqual(set(plan.changes), set([('DELETE', self.rrsets[0]), ('CREATE', new[-1])]))
+    self.assertEqual(len(r53.changes_from_xml(plan.changeset('test'))), 2)
+    self.assertEqual(self.cache.get('example.com'), self.zone_id)
+    result = self.client.push(plan, 'test', wait=5)
+    self.assertEqual(result.changes, 2)
+    self.assertEqual([wait.status for wait in result.waits], ['INSYNC'])
+    self.assertEqual(set(self.client.fetch('example.com')), set(new))
+    self.assertEqual(self.client.sync('example.com', new), api.PushResult('example.com', self.zone_id, 0, [], []))
+
+  def test_invalid_plans(self):
+    cname = r53.RRSet('host0.example.com.', 'CNAME', ttl='60', values=['example.com.'])
+    plan = self.client.plan('example.com', self.rrsets + [cname])
+    self.assertEqual(plan.errors, ['host0.example.com. would have a CNAME alongside A'])
+    self.assertRaises(api.InvalidPlanError, self.client.push, plan)
+    self.assertRaises(api.InvalidPlanError, self.client.push, api.diff(self.rrsets, self.rrsets[1:]))
+    self.assertRaises(r53.ZoneNotFoundError, self.client.plan, 'example.org', self.rrsets)
+    # A zone that has gone away is forgotten, so it is looked up again next time.
+    del self.route53.zones[self.zone_id]
+    self.assertRaises(DNSServerError, self.client.fetch, 'example.com')
+    self.assertEqual((self.client.zones, self.cache.get('example.com')), ({}, None))
+
+  def test_offline(self):
+    path = os.path.join(self.tmpdir, 'example.com.zone')
+    with open(path, 'w') as f:
+      f.write('$TTL 60\nhost0 A 192.168.0.1\nhost0 CNAME example.com.\n')
+    self.assertEqual(api.validate(self.rrsets), [])
+    self.assertEqual(api.validate(path, origin='example.com'),
+                     ['host0.example.com. would have a CNAME alongside A'])
+    plan = api.diff(self.rrsets, path, origin='example.com')
+    self.assertEqual(plan.zone_id, None)
+    self.assertEqual(len(plan.changes), 6)
+    self.assertEqual(len(plan.errors), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,433 @@
+"""Benchmarks for the r53 hot paths on synthetic zones.
+
+Generates deterministic zones of any size and times each stage of a pull and
+a push against them, reporting wall time, CPU time and peak memory growth
+per stage and zone size:
+
+$ r53-bench --sizes 1000,10000,100000
+$ r53-bench --sizes 1000000 --stages diff_rrsets,plan_push --json
+
+Every stage runs in its own forked process, so stages cannot inherit each
+other's memory or warm caches. The fetch_http stages list the zone from a
+fakeroute53 server running in another process: opening a connection per
+request, over one kept-alive connection, and with gzip on top; they also
+report requests, connections and response bytes.
+
+The startup stages time whole r53 runs, one per subcommand, from process
+start to exit; on small zones they measure mostly import and setup time:
+
+$ r53-bench --sizes 10 --stages startup_help,startup_validate,startup_diff,startup_pull
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+import lxml.etree
+import extsort
+import fakeroute53
+import metrics
+import r53
+
+ZONE_ID = 'ZBENCH'
+R53_SCRIPT = os.path.splitext(r53.__file__)[0] + '.py'
+PAGE_SIZE = 300
+REGIONS = ('us-east-1', 'us-west-2', 'eu-west-1', 'ap-southeast-1')
+
+
+def generate_zone(num, origin='example.com', seed=0):
+  """Generate a deterministic zone of num record sets.
+
+  Besides plain A, AAAA, CNAME and MX sets the mix includes long TXT
+  values, wildcards, weighted and latency-based sets, and aliases.
+
+  Args: num: int, record sets to generate.
+        origin: string, zone name.
+        seed: int, same seed gives the same zone.
+  Returns: [ r53.RRSet ]"""
+  rnd = random.Random(seed)
+  origin = origin.rstrip('.') + '.'
+  rrsets = [
+      r53.RRSet(origin, 'SOA', ttl='900', values=[
+          'ns-1.awsdns-01.net. hostmaster.%s 1 7200 900 1209600 86400' % origin]),
+      r53.RRSet(origin, 'NS', ttl='172800', values=[
+          'ns-1.awsdns-01.net.', 'ns-2.awsdns-02.org.', 'ns-3.awsdns-03.com.', 'ns-4.awsdns-04.co.uk.']),
+      ]
+  i = 0
+  while len(rrsets) < num:
+    i += 1
+    name = 'host%d.%s' % (i, origin)
+    ttl = str(rnd.choice((60, 300, 900, 3600)))
+    kind = rnd.random()
+    if kind < 0.55:
+      rrsets.append(r53.RRSet(name, 'A', ttl=ttl, values=[_ipv4(rnd) for _ in range(rnd.randint(1, 4))]))
+    elif kind < 0.65:
+      rrsets.append(r53.RRSet(name, 'AAAA', ttl=ttl, values=['2001:db8::%x' % rnd.getrandbits(16)]))
+    elif kind < 0.72:
+      rrsets.append(r53.RRSet(name, 'CNAME', ttl=ttl, values=['host%d.%s' % (rnd.randint(1, i), origin)]))
+    elif kind < 0.77:
+      rrsets.append(r53.RRSet(name, 'MX', ttl=ttl, values=[
+          '10 mx1.%s' % origin, '20 mx%d.%s' % (rnd.randint(2, 9), origin)]))
+    elif kind < 0.83:
+      rrsets.append(r53.RRSet(name, 'TXT', ttl=ttl, values=[
+          ' '.join('"%s"' % _text(rnd, 255) for _ in range(rnd.randint(1, 3)))]))
+    elif kind < 0.88:
+      rrsets.append(r53.RRSet('*.sub%d.%s' % (i, origin), 'A', ttl=ttl, values=[_ipv4(rnd)]))
+    elif kind < 0.93:
+      for j in range(rnd.randint(2, 4)):
+        rrsets.append(r53.RRSet(name, 'A', 'weight-%d' % j, ttl, [_ipv4(rnd)],
+                                [('Weight', str(rnd.randint(0, 255)))]))
+    elif kind < 0.97:
+      for region in rnd.sample(REGIONS, rnd.randint(2, 3)):
+        rrsets.append(r53.RRSet(name, 'A', region, ttl, [_ipv4(rnd)], [('Region', region)]))
+    else:
+      rrsets.append(r53.RRSet(name, 'A', extra=[('AliasTarget', (
+          ('HostedZoneId', ZONE_ID),
+          ('DNSName', 'host%d.%s' % (rnd.randint(1, i), origin)),
+          ('EvaluateTargetHealth', 'false')))]))
+  return rrsets[:num]
+
+
+def _ipv4(rnd):
+  return '10.%d.%d.%d' % (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(1, 254))
+
+
+def _text(rnd, max_len):
+  return ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz0123456789=-') for _ in range(rnd.randint(16, max_len)))
+
+
+def mutate(rrsets, fraction=0.01, seed=1):
+  """Derive an edited copy of a zone, with about fraction of its record sets
+  deleted, retimed or added.
+
+  Returns: [ r53.RRSet ]"""
+  rnd = random.Random(seed)
+  new = []
+  for i, rrset in enumerate(rrsets):
+    roll = rnd.random()
+    if i < 2 or roll >= fraction:
+      new.append(rrset)
+    elif roll < fraction / 3:
+      continue
+    elif roll < 2 * fraction / 3 and rrset.ttl is not None:
+      new.append(r53.RRSet(rrset.name, rrset.type, rrset.set_identifier, '30', rrset.values, rrset.extra))
+    else:
+      new.append(rrset)
+      new.append(r53.RRSet('new%d.%s' % (i, rrsets[0].name), 'A', ttl='60', values=[_ipv4(rnd)]))
+  return new
+
+
+def to_xml(rrsets):
+  """Returns: string, <ResourceRecordSets> document."""
+  out = StringIO.StringIO()
+  r53.write_rrsets((rrset.to_element() for rrset in rrsets), out)
+  return out.getvalue()
+
+
+def to_zonefile(rrsets):
+  """Returns: string, zone file holding the record sets a zone file can
+  express (no weighted, latency or alias sets)."""
+  lines = []
+  for rrset in rrsets:
+    if rrset.set_identifier is not None or rrset.extra:
+      continue
+    name = rrset.name.replace('\\052', '*')
+    for value in rrset.values:
+      lines.append('%s %s IN %s %s\n' % (name, rrset.ttl, rrset.type, value))
+  return ''.join(lines)
+
+
+def to_json(rrsets):
+  """Returns: string, AWS CLI style ResourceRecordSets JSON."""
+  items = []
+  for rrset in rrsets:
+    item = {'Name': rrset.name, 'Type': rrset.type}
+    if rrset.set_identifier is not None:
+      item['SetIdentifier'] = rrset.set_identifier
+    if rrset.ttl is not None:
+      item['TTL'] = int(rrset.ttl)
+    if rrset.values:
+      item['ResourceRecords'] = [{'Value': value} for value in rrset.values]
+    for tag, value in rrset.extra:
+      item[tag] = dict(value) if isinstance(value, tuple) else value
+    items.append(item)
+  return json.dumps({'ResourceRecordSets': items})
+
+
+def to_pages(rrsets, page_size=PAGE_SIZE):
+  """Split a zone into ListResourceRecordSets responses.
+
+  Returns: dict mapping request path to response body."""
+  pages = {}
+  cursor = {}
+  for start in range(0, max(len(rrsets), 1), page_size):
+    page = rrsets[start:start + page_size]
+    body = ['<ListResourceRecordSetsResponse xmlns="%s"><ResourceRecordSets>' % r53.R53_XMLNS]
+    body.extend(lxml.etree.tostring(rrset.to_element()) for rrset in page)
+    body.append('</ResourceRecordSets>')
+    path = r53.rrset_path(ZONE_ID, **cursor)
+    if start + page_size < len(rrsets):
+      following = rrsets[start + page_size]
+      cursor = {'name': following.name, 'type': following.type}
+      body.append('<IsTruncated>true</IsTruncated>')
+      body.append('<NextRecordName>%s</NextRecordName>' % following.name)
+      body.append('<NextRecordType>%s</NextRecordType>' % following.type)
+      if following.set_identifier is not None:
+        cursor['identifier'] = following.set_identifier
+        body.append('<NextRecordIdentifier>%s</NextRecordIdentifier>' % following.set_identifier)
+    else:
+      body.append('<IsTruncated>false</IsTruncated>')
+    body.append('<MaxItems>%d</MaxItems></ListResourceRecordSetsResponse>' % page_size)
+    pages[path] = ''.join(body)
+  return pages
+
+
+class FakeConnection(object):
+  """Serves pre-rendered ListResourceRecordSets pages, standing in for a
+  Route53Connection so fetches can be timed without the network."""
+
+  def __init__(self, pages):
+    self.pages = pages
+
+  def make_request(self, action, path, headers=None, data=''):
+    return StringIO.StringIO(self.pages[path])
+
+
+def serve(rrsets):
+  """Serve rrsets as zone ZONE_ID from a fakeroute53 server in a child
+  process; kill the child when done with it.
+
+  Returns: (endpoint, pid)"""
+  route53 = fakeroute53.FakeRoute53(PAGE_SIZE)
+  route53.add_zone('example.com', rrsets, ZONE_ID)
+  server = fakeroute53.Server(('localhost', 0), route53)
+  pid = os.fork()
+  if pid == 0:
+    try:
+      server.serve_forever()
+    finally:
+      os._exit(0)
+  endpoint = server.endpoint
+  server.socket.close()
+  return endpoint, pid
+
+
+def _session(**options):
+  return lambda d: r53.connect(d['endpoint'], **options)
+
+
+def _parse(doc):
+  return lxml.etree.parse(StringIO.StringIO(doc), parser=r53.xml_parser()).getroot()
+
+
+def _parse_raw(doc):
+  """Parse keeping whitespace, as a hand-written config would arrive."""
+  return lxml.etree.parse(StringIO.StringIO(doc)).getroot()
+
+
+def _normalize_chain(root):
+  """The pre-canonicalizer push: strip space, sort values, then convert."""
+  r53.normalize_xml(root)
+  r53.normalize_rrs(root)
+  return [rrset.fingerprint for rrset in r53.rrsets_from_xml(root)]
+
+
+def _canonicalize(root):
+  return [rrset.fingerprint for rrset in r53.rrsets_from_xml(root)]
+
+
+def _command(*args):
+  """Returns: prepare function for a startup stage, giving the r53 command
+  line to run; args are %-formatted with the inputs."""
+  return lambda d: [sys.executable, R53_SCRIPT] + [arg % d for arg in args]
+
+
+def _run_command(argv):
+  with open(os.devnull, 'w') as devnull:
+    status = subprocess.call(argv, stdout=devnull, stderr=devnull)
+  # --diff exits 1 when the configs differ.
+  if status not in (0, 1):
+    raise RuntimeError('%s exited %d' % (' '.join(argv), status))
+
+
+_ONLINE = ('--zone', 'example.com', '--endpoint', '%(endpoint)s', '--zone-cache', '%(dir)s/zones.json',
+           '--snapshots', '')
+
+
+# name: (prepare(inputs) -> arg, run(arg)). Only run is measured.
+STAGES = [
+    ('fetch_config', (lambda d: FakeConnection(d['pages']),
+                      lambda conn: r53.fetch_config(ZONE_ID, conn))),
+    ('fetch_http', (_session(keepalive=False, compress=False),
+                    lambda conn: r53.fetch_rrsets(ZONE_ID, conn))),
+    ('fetch_http_keepalive', (_session(keepalive=True, compress=False),
+                              lambda conn: r53.fetch_rrsets(ZONE_ID, conn))),
+    ('fetch_http_gzip', (_session(keepalive=True, compress=True),
+                         lambda conn: r53.fetch_rrsets(ZONE_ID, conn))),
+    ('merge_config', (lambda d: r53.fetch_config(ZONE_ID, FakeConnection(d['pages'])),
+                      r53.merge_config)),
+    ('fetch_rrsets', (lambda d: FakeConnection(d['pages']),
+                      lambda conn: r53.fetch_rrsets(ZONE_ID, conn))),
+    ('normalize_xml', (lambda d: _parse(d['xml']), r53.normalize_xml)),
+    ('normalize_rrs', (lambda d: _parse(d['xml']), r53.normalize_rrs)),
+    ('normalize_chain', (lambda d: _parse_raw(d['xml']), _normalize_chain)),
+    ('canonicalize', (lambda d: _parse_raw(d['xml']), _canonicalize)),
+    ('generate_changeset', (lambda d: (_parse(d['xml']), _parse(d['new_xml'])),
+                            lambda args: r53.generate_changeset(args[0], args[1], 'bench'))),
+    ('validate_changeset', (lambda d: r53.generate_changeset(_parse(d['xml']), _parse(d['new_xml']), 'bench'),
+                            r53.validate_changeset)),
+    ('diff_rrsets', (lambda d: (d['rrsets'], d['new_rrsets']),
+                     lambda args: r53.diff_rrsets(*args))),
+    ('diff_rrsets_sharded', (lambda d: (d['rrsets'], d['new_rrsets']),
+                             lambda args: r53.diff_rrsets(args[0], args[1], multiprocessing.cpu_count()))),
+    ('diff_parsed', (lambda d: (d['xml'], d['new_xml']),
+                     lambda docs: r53.diff_rrsets(*[r53.read_config(StringIO.StringIO(doc), 'xml') for doc in docs]))),
+    ('diff_external', (lambda d: (d['xml'], d['new_xml']),
+                       lambda docs: list(extsort.diff_rrsets(
+                           *[r53.iter_config(StringIO.StringIO(doc), 'xml') for doc in docs],
+                           buffer_size=4 << 20)))),
+    ('plan_push', (lambda d: (d['rrsets'], d['new_rrsets']),
+                   lambda args: r53.plan_push(*args))),
+    ('parse_xml', (lambda d: d['xml'],
+                   lambda doc: r53.read_config(StringIO.StringIO(doc), 'xml'))),
+    ('parse_bind', (lambda d: d['bind'],
+                    lambda doc: r53.read_config(StringIO.StringIO(doc), 'bind', 'example.com'))),
+    ('parse_json', (lambda d: d['json'],
+                    lambda doc: r53.read_config(StringIO.StringIO(doc), 'json'))),
+    ('startup_help', (_command('--help'), _run_command)),
+    ('startup_validate', (_command('--validate', '%(dir)s/new.xml'), _run_command)),
+    ('startup_diff', (_command('--diff', '%(dir)s/old.xml', '%(dir)s/new.xml'), _run_command)),
+    ('startup_pull', (_command('--pull', *_ONLINE), _run_command)),
+    ('startup_push', (_command('--push', '%(dir)s/new.xml', '--dryrun', '--confirm', *_ONLINE),
+                      _run_command)),
+    ]
+STAGE_NAMES = [name for name, _ in STAGES]
+
+
+def make_inputs(num, fraction=0.01):
+  """Generate everything the stages need for a zone of num record sets."""
+  rrsets = generate_zone(num)
+  new_rrsets = mutate(rrsets, fraction)
+  return {
+      'rrsets': rrsets,
+      'new_rrsets': new_rrsets,
+      'xml': to_xml(rrsets),
+      'new_xml': to_xml(new_rrsets),
+      'pages': to_pages(rrsets),
+      'bind': to_zonefile(rrsets),
+      'json': to_json(rrsets),
+      }
+
+
+def run_stage(stage, inputs):
+  """Time one stage in a forked child.
+
+  Returns: dict with wall and cpu seconds, the latter including any child
+           processes, and peak_kb, the growth of peak RSS while the stage
+           ran, plus any r53.STATS counters the stage added to."""
+  prepare, run = dict(STAGES)[stage]
+  r, w = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    status = 1
+    try:
+      os.close(r)
+      arg = prepare(inputs)
+      r53.STATS.reset()
+      metrics.reset_peak()
+      base, _ = metrics.memory()
+      times = os.times()
+      start = time.time()
+      run(arg)
+      wall = time.time() - start
+      end_times = os.times()
+      _, peak = metrics.memory()
+      result = {
+          'wall': wall,
+          'cpu': sum(end_times[i] - times[i] for i in range(4)),
+          'peak_kb': max(peak - base, 0)}
+      result.update(r53.STATS.counters)
+      os.write(w, json.dumps(result))
+      status = 0
+    finally:
+      os._exit(status)
+  os.close(w)
+  out = []
+  while True:
+    data = os.read(r, 4096)
+    if not data:
+      break
+    out.append(data)
+  os.close(r)
+  _, status = os.waitpid(pid, 0)
+  if status != 0:
+    raise RuntimeError('stage %s failed' % stage)
+  return json.loads(''.join(out))
+
+
+def run(sizes, stages):
+  """Run stages over zones of each size.
+
+  Yields: dict for each size and stage, as returned by run_stage plus the
+          size and stage."""
+  for size in sizes:
+    inputs = make_inputs(size)
+    pid = None
+    if [stage for stage in stages if stage.startswith(('fetch_http', 'startup_pull', 'startup_push'))]:
+      inputs['endpoint'], pid = serve(inputs['rrsets'])
+    inputs['dir'] = tempfile.mkdtemp(prefix='r53-bench-')
+    for name, doc in (('old.xml', inputs['xml']), ('new.xml', inputs['new_xml'])):
+      with open(os.path.join(inputs['dir'], name), 'w') as f:
+        f.write(doc)
+    try:
+      for stage in stages:
+        result = run_stage(stage, inputs)
+        result.update({'size': size, 'stage': stage})
+        yield result
+    finally:
+      shutil.rmtree(inputs['dir'], ignore_errors=True)
+      if pid is not None:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark r53 on synthetic zones.')
+  parser.add_argument('--sizes', default='1000,10000,100000',
+                      help="Comma separated zone sizes, in record sets.")
+  parser.add_argument('--stages', default=','.join(STAGE_NAMES),
+                      help="Comma separated stages to run, from: %s." % ', '.join(STAGE_NAMES))
+  parser.add_argument('--json', action='store_true', help="Print one JSON object per result.")
+  args = parser.parse_args()
+  r53.log.addHandler(logging.NullHandler())
+  sizes = [int(size) for size in args.sizes.split(',')]
+  stages = args.stages.split(',')
+  for stage in stages:
+    if stage not in STAGE_NAMES:
+      parser.error('unknown stage %s' % stage)
+  if not args.json:
+    print '%10s  %-20s %10s %10s %10s %10s %10s' % (
+        'size', 'stage', 'wall s', 'cpu s', 'peak MB', 'conns', 'MB read')
+  for result in run(sizes, stages):
+    if args.json:
+      print json.dumps(result, sort_keys=True)
+    else:
+      http = ''
+      if 'api_calls' in result:
+        http = ' %10d %10.1f' % (result.get('connections', 0), result.get('bytes', 0) / 1048576.0)
+      print '%10d  %-20s %10.3f %10.3f %10.1f%s' % (
+          result['size'], result['stage'], result['wall'], result['cpu'], result['peak_kb'] / 1024.0, http)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,35 @@
+import unittest
+import StringIO
+import bench
+import r53
+
+class BenchTest(unittest.TestCase):
+  """Tests for functions in bench.py."""
+
+  def test_generate_zone(self):
+    rrsets = bench.generate_zone(500)
+    self.assertEqual(len(rrsets), 500)
+    self.assertEqual(rrsets, bench.generate_zone(500))
+    self.assertEqual(len(set(rrset.key for rrset in rrsets)), 500)
+    self.assertTrue([r for r in rrsets if r.name.startswith('\\052.')])
+    self.assertTrue([r for r in rrsets if ('Weight', ) == tuple(f[0] for f in r.extra)])
+    self.assertTrue([r for r in rrsets if r.extra and r.extra[0][0] == 'AliasTarget'])
+
+  def test_formats_round_trip(self):
+    rrsets = bench.generate_zone(500)
+    self.assertEqual(r53.fetch_rrsets(bench.ZONE_ID, bench.FakeConnection(bench.to_pages(rrsets, 100))),
+                     rrsets)
+    self.assertEqual(r53.read_config(StringIO.StringIO(bench.to_xml(rrsets)), 'xml'), rrsets)
+    self.assertEqual(r53.read_config(StringIO.StringIO(bench.to_json(rrsets)), 'json'), rrsets)
+    plain = [r for r in rrsets if r.set_identifier is None and not r.extra]
+    self.assertEqual(r53.read_config(StringIO.StringIO(bench.to_zonefile(rrsets)), 'bind', 'example.com'),
+                     plain)
+
+  def test_run_stage(self):
+    result = bench.run_stage('diff_rrsets', bench.make_inputs(100))
+    self.assertEqual(sorted(result), ['cpu', 'peak_kb', 'wall'])
+    self.assertTrue(bench.run_stage('startup_help', {})['wall'] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
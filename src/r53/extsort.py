@@ -0,0 +1,210 @@
+"""Diff configs too big to hold in memory.
+
+Each side is streamed into sorted run files of at most a buffer's worth of
+record sets, the runs are merged back in key order through mmap, and the
+two sorted streams are merge-joined by key into changes as they go. Memory
+use is bounded by the buffer size and the number of runs, not by the size
+of the zone.
+
+Run files hold length-prefixed records: the record set's sort key, then
+its fields marshalled.
+"""
+
+import heapq
+import marshal
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import r53
+
+DEFAULT_BUFFER = 64 << 20
+
+_HEADER = struct.Struct('<II')
+
+# Rough memory cost of a buffered record beyond its strings.
+_OVERHEAD = 150
+
+
+def _bytes(text):
+  if isinstance(text, unicode):
+    return text.encode('utf-8')
+  return text
+
+
+def _encode(rrset):
+  """Returns: (sort key, payload) strings. Sort keys compare like the
+  (Name, Type, SetIdentifier) tuples they encode."""
+  key = '\0'.join(_bytes(field) for field in (rrset.name, rrset.type, rrset.set_identifier or ''))
+  return key, marshal.dumps((rrset.name, rrset.type, rrset.set_identifier, rrset.ttl, rrset.values,
+                             rrset.extra))
+
+
+def _decode(payload):
+  return r53.RRSet(*marshal.loads(payload))
+
+
+def _write_run(records, directory):
+  """Sort records and write them to a new run file.
+
+  Returns: path of the run."""
+  records.sort()
+  fd, path = tempfile.mkstemp(suffix='.run', dir=directory)
+  with os.fdopen(fd, 'wb') as f:
+    for key, payload in records:
+      f.write(_HEADER.pack(len(key), len(payload)))
+      f.write(key)
+      f.write(payload)
+  return path
+
+
+def _read_run(path):
+  """Yields: (sort key, payload) from a run file, through mmap."""
+  with open(path, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    if not size:
+      return
+    data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  try:
+    offset = 0
+    while offset < size:
+      key_len, payload_len = _HEADER.unpack_from(data, offset)
+      offset += _HEADER.size
+      key = data[offset:offset + key_len]
+      offset += key_len
+      yield key, data[offset:offset + payload_len]
+      offset += payload_len
+  finally:
+    data.close()
+
+
+def sort_rrsets(rrsets, directory, buffer_size=DEFAULT_BUFFER):
+  """Sort record sets by key, spilling to run files in directory whenever
+  buffer_size bytes of them are held.
+
+  Args: rrsets: iterable of RRSet.
+        directory: string, where to write runs; the caller removes them.
+        buffer_size: int, bytes of record sets to hold at once.
+  Yields: (sort key, payload) in key order; see _decode."""
+  records = []
+  held = 0
+  runs = []
+  for rrset in rrsets:
+    key, payload = _encode(rrset)
+    records.append((key, payload))
+    held += len(key) + len(payload) + _OVERHEAD
+    if held >= buffer_size:
+      runs.append(_write_run(records, directory))
+      records = []
+      held = 0
+  if not runs:
+    records.sort()
+    for record in records:
+      yield record
+    return
+  if records:
+    runs.append(_write_run(records, directory))
+  del records
+  r53.log.debug('merging %d sorted runs' % len(runs))
+  for record in heapq.merge(*[_read_run(path) for path in runs]):
+    yield record
+
+
+def _unique(records, side):
+  """Pass sorted records through, raising on a repeated key."""
+  last = None
+  for key, payload in records:
+    if key == last:
+      msg = 'duplicate ResourceRecordSet in %s: %s' % (side, key.replace('\0', ' '))
+      r53.log.error(msg)
+      raise r53.InvalidArgumentException(msg)
+    last = key
+    yield key, payload
+
+
+def merge_join(old, new):
+  """Diff two sorted record streams.
+
+  Args: old, new: iterables of (sort key, payload), as sort_rrsets yields.
+  Yields: (action, RRSet, old RRSet or None) in key order."""
+  old = _unique(old, 'live config')
+  new = _unique(new, 'new config')
+  done = (None, None)
+  old_key, old_payload = next(old, done)
+  new_key, new_payload = next(new, done)
+  while old_key is not None or new_key is not None:
+    if new_key is None or (old_key is not None and old_key < new_key):
+      yield 'DELETE', _decode(old_payload), None
+      old_key, old_payload = next(old, done)
+    elif old_key is None or new_key < old_key:
+      yield 'CREATE', _decode(new_payload), None
+      new_key, new_payload = next(new, done)
+    else:
+      if old_payload != new_payload:
+        current, rrset = _decode(old_payload), _decode(new_payload)
+        if current != rrset:
+          yield 'UPSERT', rrset, current
+      old_key, old_payload = next(old, done)
+      new_key, new_payload = next(new, done)
+
+
+def diff_rrsets(old, new, buffer_size=DEFAULT_BUFFER, directory=None, replaced=None):
+  """r53.diff_rrsets for configs that don't fit in memory.
+
+  Changes come in key order rather than in the configs' order, but all the
+  changes to one name come together, DELETEs first, so plan_change_batches
+  still keeps them in one batch and they still apply in a sensible order.
+
+  Args: old, new: iterables of RRSet, eg. streamed from Route 53 and from
+          a file; each is read once.
+        buffer_size: int, bytes of record sets to hold per side.
+        directory: where to put run files; a temporary directory under
+          TMPDIR by default. Runs are removed when the diff finishes.
+        replaced: optional dict, given the live version of every UPSERTed
+          record set by key.
+  Yields: (action, RRSet)"""
+  tmpdir = tempfile.mkdtemp(prefix='r53-', dir=directory)
+  try:
+    old_sorted = sort_rrsets(old, tmpdir, buffer_size)
+    new_sorted = sort_rrsets(new, tmpdir, buffer_size)
+    name = None
+    pending = []
+    for action, rrset, current in merge_join(old_sorted, new_sorted):
+      if rrset.name != name:
+        for change in sorted(pending, key=lambda change: change[0] != 'DELETE'):
+          yield change
+        name = rrset.name
+        pending = []
+      if current is not None and replaced is not None:
+        replaced[current.key] = current
+      pending.append((action, rrset))
+    for change in sorted(pending, key=lambda change: change[0] != 'DELETE'):
+      yield change
+  finally:
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def plan_push(live_config, new_config, zone_id=None, buffer_size=DEFAULT_BUFFER, directory=None):
+  """r53.plan_push for configs that don't fit in memory.
+
+  Only the changes and the live versions of what they replace are kept, so
+  preflight can only check those; see its complete argument.
+
+  Args: live_config, new_config: iterables of RRSet.
+        zone_id: see r53.preflight.
+        buffer_size, directory: see diff_rrsets.
+  Returns: as r53.plan_push."""
+  replaced = {}
+  changes = list(diff_rrsets(live_config, new_config, buffer_size, directory, replaced))
+  if not changes:
+    return [], [], []
+  live = [rrset for action, rrset in changes if action == 'DELETE'] + replaced.values()
+  live_index = r53.index_rrsets(live)
+  changes = r53.order_changes(changes, live_index)
+  batches = r53.plan_change_batches(changes)
+  errs = []
+  for batch in batches:
+    errs.extend(r53.validate_changes(batch))
+  errs.extend(r53.preflight(live, batches, zone_id, live_index, complete=False))
+  return changes, batches, errs
@@ -0,0 +1,62 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import bench
+import extsort
+import r53
+
+class ExtSortTest(unittest.TestCase):
+  """Tests for functions in extsort.py."""
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.old = bench.generate_zone(3000)
+    self.new = bench.mutate(self.old, 0.05)
+    random.Random(0).shuffle(self.new)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_sort_rrsets(self):
+    runs = os.path.join(self.tmpdir, 'runs')
+    os.mkdir(runs)
+    records = list(extsort.sort_rrsets(iter(self.new), runs, 20000))
+    self.assertTrue(len(os.listdir(runs)) > 10)
+    self.assertEqual([extsort._decode(payload) for _, payload in records],
+                     sorted(self.new, key=lambda rrset: rrset.key))
+    self.assertEqual(list(extsort.sort_rrsets(iter(self.new), runs, 1 << 30)), records)
+
+  def test_diff_rrsets(self):
+    replaced = {}
+    changes = list(extsort.diff_rrsets(iter(self.old), iter(self.new), 20000, self.tmpdir, replaced))
+    self.assertEqual(os.listdir(self.tmpdir), [])
+    expected = r53.diff_rrsets(self.old, self.new)
+    self.assertEqual(len(changes), len(expected))
+    self.assertEqual(set(changes), set(expected))
+    old_index = r53.index_rrsets(self.old)
+    self.assertEqual(replaced, dict((rrset.key, old_index[rrset.key])
+                                    for action, rrset in expected if action == 'UPSERT'))
+    # Changes to a name come together, DELETEs first.
+    names = [rrset.name for _, rrset in changes]
+    self.assertEqual(len(set(names)), len([n for i, n in enumerate(names) if i == 0 or names[i - 1] != n]))
+    swap = [('DELETE', r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.0.1'])),
+            ('CREATE', r53.RRSet('www.example.com.', 'CNAME', ttl='60', values=['example.com.']))]
+    self.assertEqual(list(extsort.diff_rrsets([swap[0][1]], [swap[1][1]])), swap)
+
+  def test_duplicates(self):
+    diff = extsort.diff_rrsets(iter(self.old), iter(self.new + self.new[:1]), 20000, self.tmpdir)
+    self.assertRaises(r53.InvalidArgumentException, list, diff)
+    self.assertEqual(os.listdir(self.tmpdir), [])
+
+  def test_plan_push(self):
+    changes, batches, errs = extsort.plan_push(iter(self.old), iter(self.new), buffer_size=20000)
+    expected = r53.plan_push(self.old, self.new)
+    self.assertEqual(len(changes), len(expected[0]))
+    self.assertEqual(set(changes), set(expected[0]))
+    self.assertEqual(sum(len(batch) for batch in batches), len(changes))
+    self.assertEqual(errs, expected[2])
+
+
+if __name__ == '__main__':
+    unittest.main()
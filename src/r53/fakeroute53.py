@@ -0,0 +1,512 @@
+"""A local stand-in for the Route 53 API, for offline end-to-end and load
+testing of r53.
+
+Implements enough of the 2013-04-01 API for r53 and boto: listing hosted
+zones (by marker and by name), GetHostedZone, CreateHostedZone,
+ListResourceRecordSets with real Next* pagination,
+ChangeResourceRecordSets with Route 53's batch semantics, and GetChange.
+State lives in memory. Latency, page size, change propagation time and
+throttling are configurable:
+
+$ r53-fakeroute53 --port 8053 --zone example.com=example.com.xml \\
+    --generate big.example.com=200000 --latency 0.05 --rate 5
+$ r53 --endpoint localhost:8053 --zone big.example.com --pull
+"""
+
+import argparse
+import bisect
+import BaseHTTPServer
+import cgi
+import itertools
+import logging
+import socket
+import SocketServer
+import threading
+import time
+import urlparse
+import zlib
+import lxml.etree
+import r53
+
+log = logging.getLogger('fakeroute53')
+
+NS = r53.R53_XMLNS
+PREFIX = '/%s' % r53.R53_API_VERSION
+
+
+class Route53Error(Exception):
+  """An error response: HTTP status, error code and message."""
+
+  def __init__(self, status, code, message):
+    Exception.__init__(self, message)
+    self.status = status
+    self.code = code
+    self.message = message
+
+  def to_xml(self):
+    if self.code == 'InvalidChangeBatch':
+      root = lxml.etree.Element('{%s}InvalidChangeBatch' % NS, nsmap={None: NS})
+      messages = lxml.etree.SubElement(root, '{%s}Messages' % NS)
+      lxml.etree.SubElement(messages, '{%s}Message' % NS).text = self.message
+      return root
+    root = lxml.etree.Element('{%s}ErrorResponse' % NS, nsmap={None: NS})
+    error = lxml.etree.SubElement(root, '{%s}Error' % NS)
+    lxml.etree.SubElement(error, '{%s}Type' % NS).text = 'Sender'
+    lxml.etree.SubElement(error, '{%s}Code' % NS).text = self.code
+    lxml.etree.SubElement(error, '{%s}Message' % NS).text = self.message
+    lxml.etree.SubElement(root, '{%s}RequestId' % NS).text = 'fakeroute53'
+    return root
+
+
+class Zone(object):
+  """One hosted zone's name and record sets."""
+
+  def __init__(self, zone_id, name):
+    self.id = zone_id
+    self.name = name.rstrip('.') + '.'
+    self.rrsets = {}
+    self.last_change = 0
+    self._order = None
+
+  def order(self):
+    """Returns: [ (order_key, RRSet.key) ], sorted; cached until the next change."""
+    if self._order is None:
+      self._order = sorted((r53.listing_order(key), key) for key in self.rrsets)
+    return self._order
+
+  def changed(self):
+    self._order = None
+    self.last_change = time.time()
+
+
+class FakeRoute53(object):
+  """In-memory Route 53 state and request handling.
+
+  Args: page_size: default MaxItems for ListResourceRecordSets.
+        sync_delay: seconds before a change reports INSYNC.
+        prior_request_delay: seconds after a change during which further
+          changes to the same zone fail with PriorRequestNotComplete."""
+
+  def __init__(self, page_size=300, sync_delay=0.0, prior_request_delay=0.0):
+    self.page_size = page_size
+    self.sync_delay = sync_delay
+    self.prior_request_delay = prior_request_delay
+    self.zones = {}
+    self.changes = {}
+    self.lock = threading.Lock()
+    self.ids = itertools.count(1)
+
+  def add_zone(self, name, rrsets=(), zone_id=None):
+    """Create a hosted zone holding rrsets (iterable of r53.RRSet).
+
+    Returns: the new zone's ID, zone_id if given."""
+    with self.lock:
+      return self._add_zone(name, rrsets, zone_id)
+
+  def _add_zone(self, name, rrsets, zone_id=None):
+    zone = Zone(zone_id or 'Z%012d' % next(self.ids), name)
+    for rrset in rrsets:
+      zone.rrsets[rrset.key] = rrset
+    self.zones[zone.id] = zone
+    return zone.id
+
+  def handle(self, method, path, query, body):
+    """Answer one request.
+
+    Args: method: string eg. GET
+          path: string, URL path.
+          query: dict of query parameters.
+          body: string, request body.
+    Returns: (HTTP status, lxml.etree.Element)"""
+    try:
+      if not path.startswith(PREFIX + '/'):
+        raise Route53Error(404, 'NotFound', 'unknown API version in %s' % path)
+      parts = path[len(PREFIX) + 1:].split('/')
+      with self.lock:
+        if parts == ['hostedzone'] and method == 'GET':
+          return 200, self.list_hosted_zones(query)
+        if parts == ['hostedzone'] and method == 'POST':
+          return 201, self.create_hosted_zone(body)
+        if parts == ['hostedzonesbyname'] and method == 'GET':
+          return 200, self.list_hosted_zones_by_name(query)
+        if len(parts) == 2 and parts[0] == 'hostedzone' and method == 'GET':
+          return 200, self.get_hosted_zone(parts[1])
+        if len(parts) == 3 and parts[0] == 'hostedzone' and parts[2] == 'rrset':
+          if method == 'GET':
+            return 200, self.list_rrsets(parts[1], query)
+          if method == 'POST':
+            return 200, self.change_rrsets(parts[1], body)
+        if len(parts) == 2 and parts[0] == 'change' and method == 'GET':
+          return 200, self.get_change(parts[1])
+      raise Route53Error(404, 'NotFound', 'no such operation: %s %s' % (method, path))
+    except Route53Error as e:
+      return e.status, e.to_xml()
+
+  def _zone(self, zone_id):
+    try:
+      return self.zones[zone_id]
+    except KeyError:
+      raise Route53Error(404, 'NoSuchHostedZone', 'No hosted zone found with ID: %s' % zone_id)
+
+  def _max_items(self, query, default=100):
+    try:
+      return max(1, int(query.get('maxitems', default)))
+    except ValueError:
+      raise Route53Error(400, 'InvalidInput', 'maxitems must be a number')
+
+  def _hosted_zone(self, parent, zone):
+    hz = lxml.etree.SubElement(parent, '{%s}HostedZone' % NS)
+    lxml.etree.SubElement(hz, '{%s}Id' % NS).text = '/hostedzone/%s' % zone.id
+    lxml.etree.SubElement(hz, '{%s}Name' % NS).text = zone.name
+    lxml.etree.SubElement(hz, '{%s}CallerReference' % NS).text = zone.id
+    config = lxml.etree.SubElement(hz, '{%s}Config' % NS)
+    lxml.etree.SubElement(config, '{%s}PrivateZone' % NS).text = 'false'
+    lxml.etree.SubElement(hz, '{%s}ResourceRecordSetCount' % NS).text = str(len(zone.rrsets))
+    return hz
+
+  def _root(self, tag):
+    return lxml.etree.Element('{%s}%s' % (NS, tag), nsmap={None: NS})
+
+  def list_hosted_zones(self, query):
+    ids = sorted(self.zones)
+    start = bisect.bisect_left(ids, query.get('marker', ''))
+    max_items = self._max_items(query)
+    root = self._root('ListHostedZonesResponse')
+    zones = lxml.etree.SubElement(root, '{%s}HostedZones' % NS)
+    for zone_id in ids[start:start + max_items]:
+      self._hosted_zone(zones, self.zones[zone_id])
+    lxml.etree.SubElement(root, '{%s}Marker' % NS).text = query.get('marker', '')
+    truncated = start + max_items < len(ids)
+    lxml.etree.SubElement(root, '{%s}IsTruncated' % NS).text = 'true' if truncated else 'false'
+    if truncated:
+      lxml.etree.SubElement(root, '{%s}NextMarker' % NS).text = ids[start + max_items]
+    lxml.etree.SubElement(root, '{%s}MaxItems' % NS).text = str(max_items)
+    return root
+
+  def list_hosted_zones_by_name(self, query):
+    ordered = sorted((r53.listing_order((zone.name, None, None))[0], zone.id, zone) for zone in self.zones.values())
+    start = 0
+    if 'dnsname' in query:
+      start = bisect.bisect_left(ordered, (r53.listing_order((query['dnsname'], None, None))[0],))
+    max_items = self._max_items(query)
+    root = self._root('ListHostedZonesByNameResponse')
+    zones = lxml.etree.SubElement(root, '{%s}HostedZones' % NS)
+    for _, _, zone in ordered[start:start + max_items]:
+      self._hosted_zone(zones, zone)
+    if 'dnsname' in query:
+      lxml.etree.SubElement(root, '{%s}DNSName' % NS).text = query['dnsname']
+    truncated = start + max_items < len(ordered)
+    lxml.etree.SubElement(root, '{%s}IsTruncated' % NS).text = 'true' if truncated else 'false'
+    if truncated:
+      following = ordered[start + max_items][2]
+      lxml.etree.SubElement(root, '{%s}NextDNSName' % NS).text = following.name
+      lxml.etree.SubElement(root, '{%s}NextHostedZoneId' % NS).text = following.id
+    lxml.etree.SubElement(root, '{%s}MaxItems' % NS).text = str(max_items)
+    return root
+
+  def get_hosted_zone(self, zone_id):
+    zone = self._zone(zone_id)
+    root = self._root('GetHostedZoneResponse')
+    self._hosted_zone(root, zone)
+    delegation = lxml.etree.SubElement(root, '{%s}DelegationSet' % NS)
+    servers = lxml.etree.SubElement(delegation, '{%s}NameServers' % NS)
+    lxml.etree.SubElement(servers, '{%s}NameServer' % NS).text = 'ns-1.fakeroute53.invalid'
+    return root
+
+  def create_hosted_zone(self, body):
+    try:
+      request = lxml.etree.XML(body)
+    except lxml.etree.XMLSyntaxError as e:
+      raise Route53Error(400, 'InvalidInput', str(e))
+    name = request.findtext('{%s}Name' % NS)
+    if not name:
+      raise Route53Error(400, 'InvalidInput', 'Name is required')
+    name = name.rstrip('.') + '.'
+    zone_id = self._add_zone(name, [
+        r53.RRSet(name, 'SOA', ttl='900', values=[
+            'ns-1.fakeroute53.invalid. hostmaster.fakeroute53.invalid. 1 7200 900 1209600 86400']),
+        r53.RRSet(name, 'NS', ttl='172800', values=['ns-1.fakeroute53.invalid.'])])
+    root = self._root('CreateHostedZoneResponse')
+    self._hosted_zone(root, self.zones[zone_id])
+    root.append(self._change_info(self._new_change()))
+    return root
+
+  def list_rrsets(self, zone_id, query):
+    zone = self._zone(zone_id)
+    order = zone.order()
+    start = 0
+    if 'name' in query:
+      start = bisect.bisect_left(order, (r53.listing_order((query['name'], query.get('type'),
+                                                    query.get('identifier'))),))
+    elif 'type' in query:
+      raise Route53Error(400, 'InvalidInput', 'type requires name')
+    max_items = self._max_items(query, self.page_size)
+    root = self._root('ListResourceRecordSetsResponse')
+    rrsets = lxml.etree.SubElement(root, '{%s}ResourceRecordSets' % NS)
+    for _, key in order[start:start + max_items]:
+      zone.rrsets[key].to_element(rrsets)
+    truncated = start + max_items < len(order)
+    lxml.etree.SubElement(root, '{%s}IsTruncated' % NS).text = 'true' if truncated else 'false'
+    if truncated:
+      name, rtype, identifier = order[start + max_items][1]
+      lxml.etree.SubElement(root, '{%s}NextRecordName' % NS).text = name
+      lxml.etree.SubElement(root, '{%s}NextRecordType' % NS).text = rtype
+      if identifier is not None:
+        lxml.etree.SubElement(root, '{%s}NextRecordIdentifier' % NS).text = identifier
+    lxml.etree.SubElement(root, '{%s}MaxItems' % NS).text = str(max_items)
+    return root
+
+  def apply_changes(self, zone, changes):
+    """Check a batch against a zone the way Route 53 does and apply it only
+    if every change is valid.
+
+    Raises: Route53Error (InvalidChangeBatch)"""
+    rrsets = dict(zone.rrsets)
+    errors = []
+    for action, rrset in changes:
+      current = rrsets.get(rrset.key)
+      if action == 'CREATE' and current is not None:
+        errors.append('Tried to create resource record set [name=\'%s\', type=\'%s\'] but it already exists'
+                      % (rrset.name, rrset.type))
+      elif action == 'DELETE' and current != rrset:
+        errors.append('Tried to delete resource record set [name=\'%s\', type=\'%s\'] but %s'
+                      % (rrset.name, rrset.type,
+                         'it was not found' if current is None else 'the values provided do not match the current values'))
+      elif action not in ('CREATE', 'DELETE', 'UPSERT'):
+        errors.append('Invalid action %s' % action)
+      if action == 'DELETE':
+        rrsets.pop(rrset.key, None)
+      else:
+        rrsets[rrset.key] = rrset
+    names = {}
+    for key in rrsets:
+      names.setdefault(key[0].lower(), set()).add(key[1])
+    for name, types in names.items():
+      if 'CNAME' in types and len(types) > 1:
+        errors.append('RRSet of type CNAME with DNS name %s is not permitted as it conflicts with other records '
+                      'with the same DNS name in zone %s' % (name, zone.name))
+    for action, rrset in changes:
+      target = dict(rrset.extra).get('AliasTarget')
+      if action == 'DELETE' or target is None:
+        continue
+      target = dict(target)
+      if target.get('HostedZoneId') == zone.id:
+        dnsname = target.get('DNSName', '').lower()
+        if not [key for key in rrsets if key[0].lower() == dnsname and key[1] == rrset.type]:
+          errors.append('Tried to create an alias that targets %s, type %s in zone %s, but the alias target '
+                        'name does not lie within the target zone' % (dnsname, rrset.type, zone.id))
+    if errors:
+      raise Route53Error(400, 'InvalidChangeBatch', '; '.join(errors))
+    zone.rrsets = rrsets
+    zone.changed()
+
+  def _new_change(self):
+    change_id = 'C%012d' % next(self.ids)
+    self.changes[change_id] = time.time()
+    return change_id
+
+  def _change_info(self, change_id):
+    submitted = self.changes[change_id]
+    info = lxml.etree.Element('{%s}ChangeInfo' % NS)
+    lxml.etree.SubElement(info, '{%s}Id' % NS).text = '/change/%s' % change_id
+    status = 'INSYNC' if time.time() >= submitted + self.sync_delay else 'PENDING'
+    lxml.etree.SubElement(info, '{%s}Status' % NS).text = status
+    lxml.etree.SubElement(info, '{%s}SubmittedAt' % NS).text = time.strftime(
+        '%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(submitted))
+    return info
+
+  def change_rrsets(self, zone_id, body):
+    zone = self._zone(zone_id)
+    if time.time() < zone.last_change + self.prior_request_delay:
+      raise Route53Error(400, 'PriorRequestNotComplete',
+                         'The request was rejected because Route 53 was still processing a prior request.')
+    try:
+      changes = r53.changes_from_xml(lxml.etree.XML(body))
+    except (lxml.etree.XMLSyntaxError, AttributeError) as e:
+      raise Route53Error(400, 'InvalidInput', 'malformed ChangeResourceRecordSetsRequest: %s' % e)
+    errors = r53.validate_changes(changes)
+    if errors:
+      raise Route53Error(400, 'InvalidChangeBatch', '; '.join(errors))
+    self.apply_changes(zone, changes)
+    root = self._root('ChangeResourceRecordSetsResponse')
+    root.append(self._change_info(self._new_change()))
+    return root
+
+  def get_change(self, change_id):
+    if change_id not in self.changes:
+      raise Route53Error(404, 'NoSuchChange', 'Could not find resource with ID: %s' % change_id)
+    root = self._root('GetChangeResponse')
+    root.append(self._change_info(change_id))
+    return root
+
+
+class Throttle(object):
+  """Non-blocking token bucket: requests beyond the rate are refused."""
+
+  def __init__(self, rate, burst=None):
+    self.rate = float(rate)
+    self.capacity = float(burst or rate)
+    self.tokens = self.capacity
+    self.stamp = time.time()
+    self.lock = threading.Lock()
+
+  def allow(self):
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+      self.stamp = now
+      if self.tokens < 1:
+        return False
+      self.tokens -= 1
+      return True
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """HTTP/1.1 front end for a FakeRoute53 held by the server."""
+  protocol_version = 'HTTP/1.1'
+  # Send each response in one go, and without waiting on Nagle's algorithm:
+  # on kept-alive connections it meets the client's delayed ACKs.
+  wbufsize = -1
+  disable_nagle_algorithm = True
+
+  def _dispatch(self, method):
+    server = self.server
+    url = urlparse.urlparse(self.path)
+    query = dict((k, v[-1]) for k, v in cgi.parse_qs(url.query).items())
+    length = int(self.headers.get('Content-Length') or 0)
+    body = self.rfile.read(length) if length else ''
+    if server.latency:
+      time.sleep(server.latency)
+    if server.throttle is not None and not server.throttle.allow():
+      status, root = 400, Route53Error(400, 'Throttling', 'Rate exceeded').to_xml()
+    else:
+      status, root = server.route53.handle(method, url.path, query, body)
+    payload = lxml.etree.tostring(root, xml_declaration=True, encoding='UTF-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'text/xml')
+    if server.gzip and 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+      compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+      payload = compressor.compress(payload) + compressor.flush()
+      self.send_header('Content-Encoding', 'gzip')
+    if self.close_connection:
+      self.send_header('Connection', 'close')
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+    server.count(requests=1, bytes=len(payload))
+
+  def do_GET(self):
+    self._dispatch('GET')
+
+  def do_POST(self):
+    self._dispatch('POST')
+
+  def do_DELETE(self):
+    self._dispatch('DELETE')
+
+  def log_message(self, format, *args):
+    log.debug('%s %s' % (self.address_string(), format % args))
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  """Threaded HTTP server for a FakeRoute53.
+
+  Counts connections accepted, requests answered and response body bytes
+  sent in stats.
+
+  Args: address: (host, port); port 0 picks a free one.
+        route53: FakeRoute53
+        latency: seconds to sleep before answering each request.
+        rate, burst: requests per second allowed before answering Throttling;
+          None disables throttling.
+        gzip: compress responses for clients that accept it."""
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address, route53, latency=0.0, rate=None, burst=None, gzip=True):
+    BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+    self.route53 = route53
+    self.latency = latency
+    self.throttle = Throttle(rate, burst) if rate else None
+    self.gzip = gzip
+    self.stats = {'connections': 0, 'requests': 0, 'bytes': 0}
+    self.requests = set()
+    self.requests_lock = threading.Lock()
+
+  def count(self, **counts):
+    with self.requests_lock:
+      for key, value in counts.items():
+        self.stats[key] += value
+
+  def process_request(self, request, client_address):
+    with self.requests_lock:
+      self.requests.add(request)
+      self.stats['connections'] += 1
+    SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+
+  def shutdown_request(self, request):
+    with self.requests_lock:
+      self.requests.discard(request)
+    BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+  def server_close(self):
+    """Stop listening, and hang up on clients holding connections open."""
+    BaseHTTPServer.HTTPServer.server_close(self)
+    self.hang_up()
+
+  def hang_up(self):
+    """Close every open connection, as a server dropping idle ones would."""
+    with self.requests_lock:
+      requests = list(self.requests)
+    for request in requests:
+      try:
+        request.shutdown(socket.SHUT_RDWR)
+      except socket.error:
+        pass
+
+  @property
+  def endpoint(self):
+    """host:port, as r53 --endpoint wants it."""
+    return '%s:%d' % self.server_address[:2]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Local stand-in for the Route 53 API.')
+  parser.add_argument('--host', default='localhost')
+  parser.add_argument('--port', type=int, default=8053)
+  parser.add_argument('--zone', action='append', default=[], metavar='NAME[=FILE]',
+                      help="Create a zone, optionally loaded from an XML, zone file or JSON config.")
+  parser.add_argument('--generate', action='append', default=[], metavar='NAME=COUNT',
+                      help="Create a zone filled with COUNT synthetic record sets.")
+  parser.add_argument('--page-size', type=int, default=300, help="Default MaxItems when listing record sets.")
+  parser.add_argument('--latency', type=float, default=0.0, help="Seconds to wait before each response.")
+  parser.add_argument('--rate', type=float, help="Requests per second before answering Throttling.")
+  parser.add_argument('--burst', type=float, help="Requests allowed back to back; defaults to --rate.")
+  parser.add_argument('--sync-delay', type=float, default=0.0, help="Seconds before a change is INSYNC.")
+  parser.add_argument('--prior-request-delay', type=float, default=0.0,
+                      help="Seconds after a change during which the zone answers PriorRequestNotComplete.")
+  parser.add_argument('--no-gzip', action='store_true', help="Never compress responses.")
+  parser.add_argument('--verbose', action='store_true')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+  route53 = FakeRoute53(args.page_size, args.sync_delay, args.prior_request_delay)
+  for spec in args.zone:
+    name, _, filename = spec.partition('=')
+    rrsets = r53.read_config(filename, origin=name) if filename else []
+    log.info('zone %s: %s, %d record sets' % (name, route53.add_zone(name, rrsets), len(rrsets)))
+  for spec in args.generate:
+    import bench
+    name, _, count = spec.partition('=')
+    rrsets = bench.generate_zone(int(count), name)
+    log.info('zone %s: %s, %d record sets' % (name, route53.add_zone(name, rrsets), len(rrsets)))
+  server = Server((args.host, args.port), route53, args.latency, args.rate, args.burst, not args.no_gzip)
+  log.info('listening on %s' % server.endpoint)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,274 @@
+import errno
+import httplib
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from boto.exception import BotoServerError
+from boto.route53.exception import DNSServerError
+import bench
+import fakeroute53
+import r53
+import snapshot
+
+class FakeRoute53Test(unittest.TestCase):
+  """Tests for fakeroute53.py, driven through r53 and boto over HTTP."""
+  def setUp(self):
+    self.route53 = fakeroute53.FakeRoute53(page_size=3)
+    self.rrsets = [r53.RRSet('host%d.example.com.' % i, 'A', ttl='60', values=['192.168.0.%d' % i])
+                   for i in range(10)]
+    self.zone_id = self.route53.add_zone('example.com', self.rrsets)
+    self.other_id = self.route53.add_zone('example.net')
+    self.server = fakeroute53.Server(('localhost', 0), self.route53)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.conn = r53.connect(self.server.endpoint)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def test_zones(self):
+    self.assertEqual(r53.list_zones(self.conn), {'example.com': self.zone_id,
+                                                 'example.net': self.other_id})
+    self.assertEqual(r53.lookup_zone(self.conn, 'example.com'), self.zone_id)
+    self.assertRaises(r53.ZoneNotFoundError, r53.lookup_zone, self.conn, 'example.org')
+
+  def test_fetch_rrsets(self):
+    self.assertEqual(r53.fetch_rrsets(self.zone_id, self.conn), self.rrsets)
+    self.assertEqual(len(r53.fetch_config(self.zone_id, self.conn)), 4)
+    self.assertRaises(DNSServerError, r53.fetch_rrsets, 'ZNOSUCHZONE', self.conn)
+
+  def test_session(self):
+    plain = r53.connect(self.server.endpoint, compress=False, keepalive=False)
+    r53.STATS.reset()
+    self.assertEqual(r53.fetch_rrsets(self.zone_id, plain), self.rrsets)
+    self.assertEqual(r53.STATS.counters['connections'], 4)
+    plain_bytes = r53.STATS.counters['bytes']
+    r53.STATS.reset()
+    self.assertEqual(r53.fetch_rrsets(self.zone_id, self.conn), self.rrsets)
+    self.assertEqual(dict(r53.STATS.counters, bytes=0),
+                     {'api_calls': 4, 'connections': 1, 'pages': 4, 'rrsets': 10, 'bytes': 0})
+    self.assertTrue(r53.STATS.counters['bytes'] < plain_bytes)
+    # Errors don't cost the connection either.
+    self.assertRaises(DNSServerError, r53.fetch_rrsets, 'ZNOSUCHZONE', self.conn)
+    self.assertRaises(DNSServerError, self.conn.get_change, 'CNOSUCHCHANGE')
+    self.assertEqual(r53.lookup_zone(self.conn, 'example.com'), self.zone_id)
+    self.assertEqual(r53.STATS.counters['connections'], 1)
+
+  def test_fetch_rrsets_sharded(self):
+    self.route53.page_size = 20
+    zone_id = self.route53.add_zone('example.org', bench.generate_zone(500, 'example.org'))
+    rrsets = r53.fetch_rrsets(zone_id, self.conn)
+    self.assertEqual(len(rrsets), 500)
+    boundaries = r53.shard_boundaries(rrsets, 4)
+    self.assertEqual(len(boundaries), 3)
+    self.assertEqual(r53.fetch_rrsets_sharded(zone_id, self.conn, boundaries, 4), rrsets)
+    r53.STATS.reset()
+    probed = r53.probe_boundaries(zone_id, self.conn, 4)
+    self.assertEqual(len(probed), 3)
+    self.assertTrue(r53.STATS.counters['api_calls'] <= 1 + 2 * r53.PROBES_PER_SHARD * 4)
+    # A zone that fits in a page is fetched whole.
+    r53.STATS.reset()
+    self.assertEqual(r53.probe_boundaries(self.zone_id, self.conn, 4), [])
+    self.assertEqual(r53.STATS.counters['api_calls'], 1)
+    self.assertEqual(r53.fetch_rrsets_sharded(zone_id, self.conn, probed, 2), rrsets)
+    # Boundaries from an older listing: one record is gone, and two shards
+    # start past the end of the zone.
+    gone = rrsets[len(rrsets) // 2]
+    r53.submit_batches(self.conn, zone_id, [[('DELETE', gone)]])
+    stale = [gone.key, rrsets[-1].key, ('zzz.example.org.', 'A', None), ('zzzz.example.org.', 'A', None)]
+    self.assertEqual(r53.fetch_rrsets_sharded(zone_id, self.conn, stale, 3),
+                     [rrset for rrset in rrsets if rrset != gone])
+
+  def test_plan_targeted_push(self):
+    new = self.rrsets[1:] + [r53.RRSet('host3.example.com.', 'TXT', ttl='60', values=['"x"'])]
+    new[2] = r53.RRSet('host3.example.com.', 'A', ttl='300', values=['192.168.0.3'])
+    keys = r53.touched_keys(self.rrsets, new)
+    self.assertEqual(keys, set([('host0.example.com.', 'A'), ('host3.example.com.', 'A'),
+                                ('host3.example.com.', 'TXT')]))
+    r53.STATS.reset()
+    self.assertEqual(r53.plan_targeted_push(self.conn, self.zone_id, new, keys),
+                     r53.plan_push(self.rrsets, new))
+    self.assertEqual(r53.STATS.counters['api_calls'], 3)
+    # Live changes to the touched keys are seen; others are left alone.
+    r53.submit_batches(self.conn, self.zone_id, [[('DELETE', self.rrsets[0]), ('DELETE', self.rrsets[5])]])
+    changes, _, _ = r53.plan_targeted_push(self.conn, self.zone_id, new, keys)
+    self.assertEqual(changes, [('UPSERT', new[2]), ('CREATE', new[-1])])
+
+  def test_targeted_push_snapshot(self):
+    tmpdir = tempfile.mkdtemp()
+    store = snapshot.SnapshotStore(os.path.join(tmpdir, 'snapshots'))
+    r53.save_snapshot(store, self.zone_id, self.rrsets)
+    _, path = store.latest(self.zone_id)
+    old = os.path.join(os.path.dirname(path), '20000101T000000.000Z' + snapshot.SUFFIX)
+    os.rename(path, old)
+    # Changed in Route 53 behind the snapshot's back.
+    r53.submit_batches(self.conn, self.zone_id, [[('DELETE', self.rrsets[5])]])
+    new = list(self.rrsets)
+    new[3] = r53.RRSet('host3.example.com.', 'A', ttl='300', values=['192.168.0.3'])
+    filename = os.path.join(tmpdir, 'new.xml')
+    with open(filename, 'w') as f:
+      f.write(bench.to_xml(new))
+    script = os.path.join(os.path.dirname(os.path.abspath(r53.__file__)), 'r53.py')
+    def run(*args):
+      proc = subprocess.Popen([sys.executable, script, '--endpoint', self.server.endpoint, '--zone', 'example.com',
+                               '--snapshots', store.path, '--zone-cache', os.path.join(tmpdir, 'zones.json'),
+                               '--push', filename, '--confirm'] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      out = proc.communicate()[0]
+      self.assertEqual(proc.returncode, 0, out)
+      return out
+    try:
+      run('--targeted')
+      self.assertEqual(r53.fetch_rrsets(self.zone_id, self.conn), new[:5] + new[6:])
+      # Only host3 was checked, so the old snapshot is still the newest, and
+      # a push trusting fresh snapshots fetches the zone and sees host5 gone.
+      self.assertEqual(store.latest(self.zone_id)[1], old)
+      out = run('--max-snapshot-age', '3600', '--dryrun')
+      self.assertTrue('host5.example.com.' in out, out)
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_change_rrsets(self):
+    self.route53.sync_delay = 60
+    new = self.rrsets[1:] + [r53.RRSet('www.example.com.', 'CNAME', ttl='60', values=['host1.example.com.'])]
+    changes, batches, errs = r53.plan_push(self.rrsets, new)
+    self.assertEqual(errs, [])
+    change_ids = r53.submit_batches(self.conn, self.zone_id, batches, 'test')
+    self.assertEqual(r53.fetch_rrsets(self.zone_id, self.conn), new)
+    status = self.conn.get_change(change_ids[0])['GetChangeResponse']['ChangeInfo']['Status']
+    self.assertEqual(status, 'PENDING')
+    self.route53.sync_delay = 0
+    status = self.conn.get_change(change_ids[0])['GetChangeResponse']['ChangeInfo']['Status']
+    self.assertEqual(status, 'INSYNC')
+
+    # The batch is rejected as a whole: the DELETE no longer matches.
+    bad = [('CREATE', r53.RRSet('mail.example.com.', 'A', ttl='60', values=['192.168.0.99'])),
+           ('DELETE', self.rrsets[0])]
+    self.assertRaises(DNSServerError, r53.submit_batches, self.conn, self.zone_id, [bad])
+    conflict = [('CREATE', r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.0.99']))]
+    self.assertRaises(DNSServerError, r53.submit_batches, self.conn, self.zone_id, [conflict])
+    self.assertEqual(r53.fetch_rrsets(self.zone_id, self.conn), new)
+
+  def test_wait_for_changes(self):
+    self.route53.sync_delay = 0.2
+    start = time.time()
+    change_ids = r53.submit_batches(self.conn, self.zone_id, [[('DELETE', rrset)] for rrset in self.rrsets[:3]])
+    waits = r53.wait_for_changes(self.conn, change_ids, 5, start, delay=0.05)
+    self.assertEqual([(w.change_id, w.status) for w in waits], [(c, 'INSYNC') for c in change_ids])
+    self.assertTrue(all(0.2 <= w.latency < 5 and w.polls > 1 for w in waits))
+    self.route53.sync_delay = 60
+    change_ids = r53.submit_batches(self.conn, self.zone_id, [[('DELETE', self.rrsets[3])]])
+    waits = r53.wait_for_changes(self.conn, change_ids + ['CNOSUCHCHANGE'], 0.2, delay=0.05)
+    self.assertEqual([w.status for w in waits], ['PENDING', 'NoSuchChange'])
+    self.assertEqual(waits[0].latency, None)
+    # Other failures are reported per change too, not raised.
+    class FlakyConnection(object):
+      def get_change(conn, change_id):
+        if change_id == 'CUNAVAILABLE':
+          raise BotoServerError(503, 'Service Unavailable', '')
+        if change_id == 'CDROPPED':
+          raise socket.error(errno.ECONNRESET, 'Connection reset by peer')
+        return self.conn.get_change(change_id)
+    waits = r53.wait_for_changes(FlakyConnection(), ['CUNAVAILABLE', 'CDROPPED'] + change_ids, 0.2, delay=0.05)
+    self.assertEqual([w.status for w in waits], ['503', 'ConnectionError', 'PENDING'])
+
+  def test_audit(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      in_sync = os.path.join(tmpdir, 'example.com.zone')
+      with open(in_sync, 'w') as f:
+        f.write('$TTL 60\n' + ''.join('HOST%d A 192.168.0.%d\n' % (i, i) for i in reversed(range(10))))
+      drifted = os.path.join(tmpdir, 'example.net.zone')
+      with open(drifted, 'w') as f:
+        f.write('$TTL 60\nwww A 192.168.1.1\n')
+      r53.submit_batches(self.conn, self.other_id, [[
+          ('CREATE', r53.RRSet('www.example.net.', 'A', ttl='300', values=['192.168.1.1'])),
+          ('CREATE', r53.RRSet('mail.example.net.', 'A', ttl='60', values=['192.168.1.2']))]])
+      results = r53.audit_manifest(self.conn, [('example.com', in_sync), ('example.net', drifted),
+                                               ('example.org', drifted)])
+    finally:
+      shutil.rmtree(tmpdir)
+    self.assertEqual(results[0].live_hash, r53.zone_fingerprint(reversed(self.rrsets)))
+    self.assertEqual(results[0].live_hash, results[0].file_hash)
+    self.assertNotEqual(results[1].live_hash, results[1].file_hash)
+    report = json.loads(json.dumps(r53.audit_report(results)))
+    self.assertEqual([(z['zone'], z['status']) for z in report['zones']],
+                     [('example.com', 'in_sync'), ('example.net', 'drifted'), ('example.org', 'error')])
+    self.assertEqual((report['drifted'], report['errors']), (1, 1))
+    self.assertEqual(report['zones'][0]['changes'], [])
+    self.assertEqual(report['zones'][1]['changes'], [
+        {'action': 'DELETE', 'file': None,
+         'live': {'name': 'mail.example.net.', 'type': 'A', 'ttl': '60', 'values': ['192.168.1.2']}},
+        {'action': 'UPSERT',
+         'live': {'name': 'www.example.net.', 'type': 'A', 'ttl': '300', 'values': ['192.168.1.1']},
+         'file': {'name': 'www.example.net.', 'type': 'A', 'ttl': '60', 'values': ['192.168.1.1']}}])
+    self.assertEqual(report['zones'][0]['snapshot_age'], None)
+
+  def test_audit_options(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      # Not a name config_format would guess BIND from.
+      filename = os.path.join(tmpdir, 'example.com.txt')
+      with open(filename, 'w') as f:
+        f.write('$TTL 60\n' + ''.join('HOST%d A 192.168.0.%d\n' % (i, i) for i in range(10)))
+      store = snapshot.SnapshotStore(os.path.join(tmpdir, 'snapshots'))
+      audit = lambda max_age: r53.audit_manifest(self.conn, [('example.com', filename)], store=store,
+                                                 max_age=max_age, format='bind')[0]
+      fetched = audit(3600)
+      r53.submit_batches(self.conn, self.zone_id, [[('DELETE', self.rrsets[0])]])
+      from_snapshot = audit(3600)
+      refetched = audit(0)
+    finally:
+      shutil.rmtree(tmpdir)
+    self.assertEqual((fetched.error, fetched.changes, fetched.snapshot_age), (None, [], None))
+    self.assertEqual((from_snapshot.changes, from_snapshot.snapshot_age), ([], 0))
+    self.assertEqual(r53.audit_report([from_snapshot])['zones'][0]['snapshot_age'], 0)
+    self.assertEqual((refetched.changes, refetched.snapshot_age), ([('CREATE', None, self.rrsets[0])], None))
+
+  def test_throttling(self):
+    self.server.throttle = fakeroute53.Throttle(1, 1)
+    conn = httplib.HTTPConnection(self.server.endpoint)
+    conn.request('GET', '/2013-04-01/hostedzone')
+    self.assertEqual(conn.getresponse().read().count('<HostedZone>'), 2)
+    conn.request('GET', '/2013-04-01/hostedzone')
+    resp = conn.getresponse()
+    self.assertEqual(resp.status, 400)
+    self.assertEqual(DNSServerError(resp.status, resp.reason, resp.read()).error_code, 'Throttling')
+
+  def test_throttled_connection(self):
+    self.server.throttle = fakeroute53.Throttle(20, 1)
+    limiter = r53.RateLimiter(1000)
+    conn = r53.ThrottledConnection(self.conn, limiter, base_delay=0.01)
+    self.assertEqual(r53.fetch_rrsets(self.zone_id, conn), self.rrsets)
+    self.assertTrue(limiter.rate < 1000)
+    try:
+      r53.submit_batches(conn, self.zone_id, [[('DELETE', self.rrsets[0]), ('DELETE', self.rrsets[0])]])
+    except DNSServerError as e:
+      self.assertEqual(e.status, 400)
+      self.assertTrue('InvalidChangeBatch' in e.body)
+    else:
+      self.fail('invalid change batch accepted')
+
+
+  def test_throttled_connection_reconnects(self):
+    conn = r53.ThrottledConnection(self.conn, r53.RateLimiter(1000), base_delay=0.01)
+    self.assertEqual(r53.fetch_rrsets(self.zone_id, conn), self.rrsets)
+    # The kept-alive connection goes stale between calls.
+    self.server.hang_up()
+    time.sleep(0.1)
+    r53.STATS.reset()
+    self.assertEqual(r53.fetch_rrsets(self.zone_id, conn), self.rrsets)
+    self.assertEqual(r53.STATS.counters['retries'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
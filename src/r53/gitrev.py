@@ -0,0 +1,75 @@
+"""Read zone configs from git history, and remember which revision of a
+config was last pushed to a zone.
+
+Pushed revisions are kept as lightweight tags named r53-pushed/<zone> in the
+repository holding the config, so `git push --tags` shares them.
+"""
+
+import os
+import subprocess
+
+TAG_PREFIX = 'r53-pushed/'
+
+
+class GitError(Exception):
+  """Raised when git fails or the file is not in a git repository."""
+
+
+def _git(path, *args):
+  """Run git in the directory holding path.
+
+  Returns: git's output.
+  Raises: GitError"""
+  directory = os.path.dirname(os.path.abspath(path))
+  try:
+    proc = subprocess.Popen(('git',) + args, cwd=directory,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  except OSError as e:
+    raise GitError('cannot run git: %s' % e)
+  out, err = proc.communicate()
+  if proc.returncode != 0:
+    raise GitError('git %s: %s' % (' '.join(args), err.strip()))
+  return out
+
+
+def _relative(path):
+  return './' + os.path.basename(path)
+
+
+def show(path, rev):
+  """Returns: string, the contents of the file at path as of rev.
+
+  Raises: GitError, eg. if the file did not exist then."""
+  return _git(path, 'show', '%s:%s' % (rev, _relative(path)))
+
+
+def resolve(path, rev):
+  """Returns: the full commit ID rev names, in the repository holding path."""
+  return _git(path, 'rev-parse', '--verify', '%s^{commit}' % rev).strip()
+
+
+def is_clean(path):
+  """Returns: True if the file at path is tracked and unchanged since HEAD."""
+  try:
+    _git(path, 'ls-files', '--error-unmatch', _relative(path))
+    _git(path, 'diff', '--quiet', 'HEAD', '--', _relative(path))
+  except GitError:
+    return False
+  return True
+
+
+def last_push(path, zone):
+  """Returns: the commit ID last recorded as pushed to zone, or None."""
+  try:
+    return resolve(path, 'refs/tags/%s%s' % (TAG_PREFIX, zone.rstrip('.')))
+  except GitError:
+    return None
+
+
+def record_push(path, zone, rev='HEAD'):
+  """Record rev as the revision last pushed to zone.
+
+  Returns: the commit ID recorded."""
+  commit = resolve(path, rev)
+  _git(path, 'tag', '--force', '%s%s' % (TAG_PREFIX, zone.rstrip('.')), commit)
+  return commit
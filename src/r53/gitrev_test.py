@@ -0,0 +1,59 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+import gitrev
+import r53
+
+class GitRevTest(unittest.TestCase):
+  """Tests for functions in gitrev.py."""
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'example.com.zone')
+    self.env = dict(os.environ, GIT_AUTHOR_NAME='r53', GIT_AUTHOR_EMAIL='r53@example.com',
+                    GIT_COMMITTER_NAME='r53', GIT_COMMITTER_EMAIL='r53@example.com')
+    self.git('init', '-q')
+    self.commit('$TTL 60\nwww A 192.168.0.1\nmail A 192.168.0.2\n')
+    self.commit('$TTL 60\nwww A 192.168.0.3\nftp A 192.168.0.4\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def git(self, *args):
+    subprocess.check_call(('git',) + args, cwd=self.tmpdir, env=self.env,
+                          stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+  def commit(self, contents):
+    with open(self.path, 'w') as f:
+      f.write(contents)
+    self.git('add', 'example.com.zone')
+    self.git('commit', '-q', '-m', 'update')
+
+  def test_show(self):
+    self.assertEqual(gitrev.show(self.path, 'HEAD~1'), '$TTL 60\nwww A 192.168.0.1\nmail A 192.168.0.2\n')
+    self.assertRaises(gitrev.GitError, gitrev.show, self.path, 'HEAD~5')
+    self.assertRaises(gitrev.GitError, gitrev.show, '/nonexistent/example.com.zone', 'HEAD')
+
+  def test_record_push(self):
+    self.assertEqual(gitrev.last_push(self.path, 'example.com'), None)
+    head = gitrev.record_push(self.path, 'example.com.')
+    self.assertEqual(head, gitrev.resolve(self.path, 'HEAD'))
+    self.assertEqual(gitrev.last_push(self.path, 'example.com'), head)
+    self.assertTrue(gitrev.is_clean(self.path))
+    with open(self.path, 'a') as f:
+      f.write('new A 192.168.0.5\n')
+    self.assertFalse(gitrev.is_clean(self.path))
+
+  def test_read_revision(self):
+    old = r53.read_revision(self.path, 'HEAD~1', origin='example.com')
+    new = r53.read_config(self.path, origin='example.com')
+    self.assertEqual(r53.touched_keys(old, new), set([
+        ('www.example.com.', 'A'), ('mail.example.com.', 'A'), ('ftp.example.com.', 'A')]))
+    self.assertEqual(r53.read_revision(self.path, 'last-push', origin='example.com'), None)
+    r53.record_revision(self.path, 'example.com')
+    self.assertEqual(r53.read_revision(self.path, 'last-push', origin='example.com'), new)
+
+
+if __name__ == '__main__':
+    unittest.main()
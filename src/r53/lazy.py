@@ -0,0 +1,53 @@
+"""Put off expensive imports and setup until something first needs them.
+
+Most r53 runs only need a fraction of what its modules import: a diff of two
+local files never talks to Route 53, so it has no use for boto, and a BIND
+config never touches lxml. Each costs tens of milliseconds to import, which
+adds up when deploy tooling runs r53 many times over.
+"""
+
+import sys
+import threading
+
+
+class LazyModule(object):
+  """Stands in for `import name` until one of its attributes is first used.
+
+  The module is then imported and its attributes copied onto the stand-in,
+  so later lookups are plain attribute lookups:
+
+    lxml = LazyModule('lxml.etree')
+    ...
+    lxml.etree.XML(text)  # imports lxml.etree here
+
+  Args: name: string, dotted module name; the stand-in is for its top-level
+          package, just as `import name` binds that."""
+
+  def __init__(self, name):
+    self._lazy_name = name
+
+  def __getattr__(self, attr):
+    __import__(self._lazy_name)
+    module = sys.modules[self._lazy_name.partition('.')[0]]
+    self.__dict__.update(module.__dict__)
+    return getattr(module, attr)
+
+
+def once(factory):
+  """Decorate a function of no arguments so it runs on the first call only;
+  every call returns what that first call returned.
+
+  Safe to call from several threads: only one runs factory."""
+  lock = threading.Lock()
+  built = []
+
+  def get():
+    if not built:
+      with lock:
+        if not built:
+          built.append(factory())
+    return built[0]
+
+  get.__name__ = factory.__name__
+  get.__doc__ = factory.__doc__
+  return get
@@ -0,0 +1,181 @@
+"""Timing and counting for r53 runs.
+
+A Stats records wall time, CPU time and peak memory growth per named phase,
+plus counters such as API calls and pages fetched. It can be printed as a
+table, dumped as JSON, or sent to statsd or to an InfluxDB line protocol
+listener over UDP.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import socket
+import threading
+import time
+import urlparse
+
+
+def memory():
+  """Returns: (current RSS, peak RSS) of this process in KiB."""
+  try:
+    status = {}
+    with open('/proc/self/status') as f:
+      for line in f:
+        key, _, value = line.partition(':')
+        status[key] = value
+    return int(status['VmRSS'].split()[0]), int(status['VmHWM'].split()[0])
+  except (IOError, KeyError):
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak, peak
+
+
+def reset_peak():
+  """Restart peak RSS tracking from the current RSS, where Linux allows it."""
+  try:
+    with open('/proc/self/clear_refs', 'w') as f:
+      f.write('5')
+  except IOError:
+    pass
+
+
+def _cpu():
+  times = os.times()
+  return times[0] + times[1]
+
+
+class Phase(object):
+  """Measurements of one phase; see Stats.phase."""
+
+  def __init__(self, name):
+    self.name = name
+    self.wall = 0.0
+    self.cpu = 0.0
+    self.peak_kb = 0
+    self._peak = 0
+
+  def to_dict(self):
+    return {'phase': self.name, 'wall': self.wall, 'cpu': self.cpu, 'peak_kb': self.peak_kb}
+
+
+class Stats(object):
+  """Phases and counters of a run.
+
+  Counting is thread safe. Phases measure the whole process, so they are
+  only meaningful when timed from the thread doing the work; they may nest,
+  and a phase run twice adds up."""
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.phases = collections.OrderedDict()
+      self.counters = collections.Counter()
+      self._stack = []
+
+  def count(self, **counts):
+    """Add to counters, eg. count(pages=1, rrsets=300)."""
+    with self.lock:
+      self.counters.update(counts)
+
+  @contextlib.contextmanager
+  def phase(self, name):
+    """Measure the enclosed block as phase name.
+
+    Peak memory is the growth of peak RSS over RSS at the start of the
+    phase, as far as the platform can tell."""
+    with self.lock:
+      phase = self.phases.get(name)
+      if phase is None:
+        phase = self.phases[name] = Phase(name)
+    rss, _ = memory()
+    reset_peak()
+    self._stack.append(phase)
+    wall = time.time()
+    cpu = _cpu()
+    try:
+      yield phase
+    finally:
+      phase.wall += time.time() - wall
+      phase.cpu += _cpu() - cpu
+      self._stack.pop()
+      _, peak = memory()
+      peak = max(peak, phase._peak)
+      phase.peak_kb = max(phase.peak_kb, peak - rss)
+      # A nested phase reset the peak its parents were tracking.
+      for parent in self._stack:
+        parent._peak = max(parent._peak, peak)
+
+  def to_dict(self):
+    """Returns: {'phases': [ {phase, wall, cpu, peak_kb} ], 'counters': {name: value}}"""
+    with self.lock:
+      return {'phases': [phase.to_dict() for phase in self.phases.values()],
+              'counters': dict(self.counters)}
+
+  def to_json(self):
+    return json.dumps(self.to_dict(), sort_keys=True)
+
+  def summary(self):
+    """Returns: string, a table of the phases followed by the counters."""
+    lines = ['%-20s %10s %10s %10s' % ('phase', 'wall s', 'cpu s', 'peak MB')]
+    stats = self.to_dict()
+    for phase in stats['phases']:
+      lines.append('%-20s %10.3f %10.3f %10.1f' % (
+          phase['phase'], phase['wall'], phase['cpu'], phase['peak_kb'] / 1024.0))
+    counters = stats['counters']
+    if counters:
+      lines.append('  '.join('%s %d' % (name, counters[name]) for name in sorted(counters)))
+    return '\n'.join(lines)
+
+  def lines(self, protocol, prefix='r53', tags=None):
+    """Render as statsd or InfluxDB line protocol.
+
+    Args: protocol: 'statsd' or 'influx'
+          prefix: metric name prefix.
+          tags: optional dict, eg. {'zone': 'foursquare.com'}; statsd has no
+            tags, so they are folded into the metric names there.
+    Returns: [ string ]"""
+    stats = self.to_dict()
+    tags = tags or {}
+    out = []
+    if protocol == 'statsd':
+      base = '.'.join([prefix] + ['%s_%s' % (k, str(tags[k]).replace('.', '_')) for k in sorted(tags)])
+      for phase in stats['phases']:
+        name = '%s.phase.%s' % (base, phase['phase'])
+        out.append('%s.wall:%d|ms' % (name, phase['wall'] * 1000))
+        out.append('%s.cpu:%d|ms' % (name, phase['cpu'] * 1000))
+        out.append('%s.peak_kb:%d|g' % (name, phase['peak_kb']))
+      for counter, value in sorted(stats['counters'].items()):
+        out.append('%s.%s:%d|c' % (base, counter, value))
+    elif protocol == 'influx':
+      tagstr = ''.join(',%s=%s' % (k, str(tags[k]).replace(' ', '\\ ').replace(',', '\\,'))
+                       for k in sorted(tags))
+      stamp = int(time.time() * 1e9)
+      for phase in stats['phases']:
+        out.append('%s_phase%s,phase=%s wall=%f,cpu=%f,peak_kb=%di %d' % (
+            prefix, tagstr, phase['phase'], phase['wall'], phase['cpu'], phase['peak_kb'], stamp))
+      if stats['counters']:
+        out.append('%s%s %s %d' % (prefix, tagstr, ','.join(
+            '%s=%di' % item for item in sorted(stats['counters'].items())), stamp))
+    else:
+      raise ValueError('unknown protocol %s' % protocol)
+    return out
+
+  def send(self, sink, tags=None):
+    """Send to a metrics sink over UDP.
+
+    Args: sink: string, statsd://host:port or influx://host:port
+          tags: see lines."""
+    url = urlparse.urlparse(sink)
+    if url.scheme not in ('statsd', 'influx') or not url.hostname:
+      raise ValueError('metrics sink must be statsd://host:port or influx://host:port, not %s' % sink)
+    port = url.port or (8125 if url.scheme == 'statsd' else 8089)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+      for line in self.lines(url.scheme, tags=tags):
+        sock.sendto(line, (url.hostname, port))
+    finally:
+      sock.close()
@@ -0,0 +1,54 @@
+import json
+import socket
+import unittest
+import metrics
+
+class StatsTest(unittest.TestCase):
+  """Tests for functions in metrics.py."""
+  def setUp(self):
+    self.stats = metrics.Stats()
+    with self.stats.phase('fetch'):
+      with self.stats.phase('parse'):
+        data = ['x' * 1024 for _ in range(10000)]
+      del data
+    with self.stats.phase('fetch'):
+      pass
+    self.stats.count(api_calls=2, pages=2)
+    self.stats.count(api_calls=1)
+
+  def test_stats(self):
+    stats = self.stats.to_dict()
+    self.assertEqual([phase['phase'] for phase in stats['phases']], ['fetch', 'parse'])
+    fetch, parse = stats['phases']
+    self.assertTrue(fetch['wall'] >= parse['wall'] > 0)
+    self.assertTrue(fetch['peak_kb'] >= parse['peak_kb'])
+    self.assertEqual(stats['counters'], {'api_calls': 3, 'pages': 2})
+    self.assertEqual(json.loads(self.stats.to_json()), stats)
+    summary = self.stats.summary().splitlines()
+    self.assertEqual(summary[1].split()[0], 'fetch')
+    self.assertEqual(summary[-1], 'api_calls 3  pages 2')
+
+  def test_lines(self):
+    statsd = self.stats.lines('statsd', tags={'zone': 'example.com'})
+    self.assertTrue('r53.zone_example_com.api_calls:3|c' in statsd)
+    self.assertTrue([line for line in statsd if line.startswith('r53.zone_example_com.phase.parse.wall:')])
+    influx = self.stats.lines('influx', tags={'zone': 'example.com'})
+    self.assertTrue(influx[0].startswith('r53_phase,zone=example.com,phase=fetch wall='))
+    self.assertTrue(influx[-1].startswith('r53,zone=example.com api_calls=3i,pages=2i '))
+    self.assertRaises(ValueError, self.stats.lines, 'graphite')
+
+  def test_send(self):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(5)
+    try:
+      self.stats.send('statsd://127.0.0.1:%d' % sock.getsockname()[1])
+      received = [sock.recv(4096) for _ in self.stats.lines('statsd')]
+    finally:
+      sock.close()
+    self.assertTrue('r53.api_calls:3|c' in received)
+    self.assertRaises(ValueError, self.stats.send, 'http://127.0.0.1:1')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,46 +1,392 @@
 #!/usr/bin/python
 
 import argparse
+import atexit
+import collections
+import gc
+import getpass
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import time
 import logging
 import os
+import Queue
+import random
+import signal
 import socket
+import StringIO
 import sys
-import lxml.etree
-from boto.route53 import Route53Connection
+import threading
+import lazy
+import metrics
+import snapshot
+
+# boto is only imported to talk to Route 53, and these when first used; see
+# lazy.py and session.py.
+httplib = lazy.LazyModule('httplib')
+lxml = lazy.LazyModule('lxml.etree')
 
 R53_API_VERSION = '2013-04-01'
 R53_XMLNS = 'https://route53.amazonaws.com/doc/%s/' % R53_API_VERSION
-XML_PARSER = lxml.etree.XMLParser(remove_blank_text=True)
-XSLT_STRIPSPACE = lxml.etree.XSLT(lxml.etree.XML('''
+
+@lazy.once
+def xml_parser():
+  """Returns: lxml.etree.XMLParser that drops blank text, built on first use."""
+  return lxml.etree.XMLParser(remove_blank_text=True)
+
+@lazy.once
+def _stripspace_xslt():
+  return lxml.etree.XSLT(lxml.etree.XML('''
 <xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
   <xsl:strip-space elements="*"/>
-</xsl:stylesheet>''', parser=XML_PARSER))
+</xsl:stylesheet>''', parser=xml_parser()))
+
+def strip_space(xml):
+  """Returns: a copy of xml without whitespace-only text; the stylesheet
+  doing it is compiled on first use."""
+  return _stripspace_xslt()(xml)
+
+# Before lxml was loaded lazily these were lxml objects built on import.
+# XSLT_STRIPSPACE still strips space when called; XML_PARSER has been
+# removed, and xml_parser() returns the same parser.
+XSLT_STRIPSPACE = strip_space
+
+# ChangeResourceRecordSets limits, per request.
+MAX_CHANGES = 100
+MAX_RRS = 1000
+MAX_VALUE_CHARS = 10000
 
 log = logging.getLogger('route53client')
 log.setLevel(logging.DEBUG)
 
+# Counters (api_calls, pages, bytes, retries, rrsets...) and, in main, phase
+# timings for the current run.
+STATS = metrics.Stats()
+
 class ZoneNotFoundError(Exception):
   """Raised when unable to resolve a zone to its ID."""
 
-def lookup_zone(conn, zone):
+def check_response(resp):
+  """Raise if an API response is an error rather than the requested document.
+
+  Args: resp: response from conn.make_request.
+  Raises: boto.route53.exception.DNSServerError"""
+  status = getattr(resp, 'status', 200)
+  if status >= 300:
+    from boto.route53.exception import DNSServerError
+    raise DNSServerError(status, resp.reason, resp.read())
+
+class ZoneCache(object):
+  """On-disk cache of zone name to zone ID mappings.
+
+  Entries older than ttl seconds are ignored. The cache is a small JSON file
+  rewritten atomically whenever it changes, so concurrent runs can share it.
+
+  Args: path: string, cache file location.
+        ttl: int, seconds an entry stays valid."""
+
+  def __init__(self, path, ttl=86400):
+    self.path = path
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    try:
+      with open(path) as f:
+        self.entries = json.load(f)
+    except (IOError, ValueError):
+      self.entries = {}
+
+  def get(self, zone, stale=False):
+    """Returns: zone ID, or None if unknown, or expired and not stale.
+
+    Args: zone: string eg. foursquare.com
+          stale: bool, also return expired entries."""
+    entry = self.entries.get(zone.rstrip('.'))
+    if entry is None or (entry[1] + self.ttl < time.time() and not stale):
+      return None
+    return entry[0]
+
+  def update(self, zones):
+    """Record zone IDs. Args: zones: dict as returned by list_zones."""
+    with self.lock:
+      now = time.time()
+      for zone, zone_id in zones.items():
+        self.entries[zone.rstrip('.')] = [zone_id, now]
+      self._save()
+
+  def invalidate(self, zone=None):
+    """Forget one zone, or every zone if none is given."""
+    with self.lock:
+      if zone is None:
+        self.entries = {}
+      else:
+        self.entries.pop(zone.rstrip('.'), None)
+      self._save()
+
+  def _save(self):
+    directory = os.path.dirname(self.path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    tmp = '%s.%d' % (self.path, os.getpid())
+    with open(tmp, 'w') as f:
+      json.dump(self.entries, f)
+    os.rename(tmp, self.path)
+
+def _hosted_zones(root):
+  """Map the HostedZone elements of a listing response to their IDs."""
+  zones = {}
+  for hz in root.iterfind('.//{%s}HostedZone' % R53_XMLNS):
+    name = hz.findtext('{%s}Name' % R53_XMLNS).rstrip('.')
+    zones.setdefault(name, hz.findtext('{%s}Id' % R53_XMLNS).replace('/hostedzone/', ''))
+  return zones
+
+def list_zones(conn, cache=None):
+  """Map every hosted zone name in the account to its ID, following the
+  listing's NextMarker across pages.
+
+  Args: conn: boto.route53.Route53Connection
+        cache: optional ZoneCache to record the result in.
+  Returns: dict eg. {'foursquare.com': 'ZE2DYFZDWGSL4'}"""
+  zones = {}
+  marker = None
+  while True:
+    getstr = '/%s/hostedzone' % R53_API_VERSION
+    if marker is not None:
+      getstr += '?marker=%s' % marker
+    log.debug('requesting %s' % getstr)
+    resp = conn.make_request('GET', getstr)
+    check_response(resp)
+    root = lxml.etree.parse(resp).getroot()
+    for name, zone_id in _hosted_zones(root).items():
+      zones.setdefault(name, zone_id)
+    if root.findtext('{%s}IsTruncated' % R53_XMLNS) != 'true':
+      break
+    marker = root.findtext('{%s}NextMarker' % R53_XMLNS)
+  if cache is not None:
+    cache.update(zones)
+  return zones
+
+def lookup_zone_by_name(conn, zone):
+  """Look up a single zone with ListHostedZonesByName, which returns zones in
+  name order starting at the one asked for.
+
+  Args: conn: boto.route53.Route53Connection
+        zone: string eg. foursquare.com
+  Returns: zone ID, or None if there is no such zone.
+  Raises: DNSServerError if the endpoint is unavailable."""
+  getstr = '/%s/hostedzonesbyname?dnsname=%s.&maxitems=1' % (R53_API_VERSION, zone.rstrip('.'))
+  log.debug('requesting %s' % getstr)
+  resp = conn.make_request('GET', getstr)
+  check_response(resp)
+  return _hosted_zones(lxml.etree.parse(resp).getroot()).get(zone.rstrip('.'))
+
+def lookup_zone(conn, zone, zones=None, cache=None):
   """Look up a zone ID for a zone string.
 
+  Tries, in order: zones, cache, a single name-ordered lookup, and finally a
+  full listing of the account.
+
   Args: conn: boto.route53.Route53Connection
         zone: string eg. foursquare.com
+        zones: optional result of list_zones, to avoid listing again.
+        cache: optional ZoneCache, updated with whatever is looked up.
   Returns: zone ID eg. ZE2DYFZDWGSL4.
   Raises: ZoneNotFoundError if zone not found."""
-  all_zones = conn.get_all_hosted_zones()
-  for resp in all_zones['ListHostedZonesResponse']['HostedZones']:
-    if resp['Name'].rstrip('.') == zone.rstrip('.'):
-      return resp['Id'].replace('/hostedzone/', '')
-  raise ZoneNotFoundError('zone %s not found in response' % zone)
+  zone = zone.rstrip('.')
+  if zones is not None and zone in zones:
+    return zones[zone]
+  if cache is not None and cache.get(zone) is not None:
+    return cache.get(zone)
+  from boto.route53.exception import DNSServerError
+  try:
+    zone_id = lookup_zone_by_name(conn, zone)
+  except DNSServerError as e:
+    log.debug('ListHostedZonesByName failed (%s); listing all zones' % e.error_code)
+    zone_id = list_zones(conn, cache).get(zone)
+  else:
+    if zone_id is not None and cache is not None:
+      cache.update({zone: zone_id})
+  if zone_id is None:
+    raise ZoneNotFoundError('zone %s not found in response' % zone)
+  return zone_id
+
+def connect(endpoint=None, **options):
+  """Open a Route 53 connection, counting requests in STATS. This is where
+  boto gets imported.
+
+  Args: endpoint: see session.Route53Session.
+        options: passed to session.Route53Session.
+  Returns: session.Route53Session"""
+  import session
+  return session.Route53Session(endpoint, stats=STATS, **options)
+
+class RateLimiter(object):
+  """Token bucket shared by every thread that talks to the Route 53 API.
+
+  The rate adapts to what the account sustains: it is halved when Route 53
+  throttles a request and creeps back up towards the configured rate, by
+  about one request per second every second, while requests succeed.
+
+  Args: rate: requests per second to allow on average, at most.
+        burst: requests that may be made back to back; defaults to rate.
+        min_rate: requests per second never to throttle below."""
+
+  def __init__(self, rate, burst=None, min_rate=0.5):
+    self.max_rate = float(rate)
+    self.min_rate = min(float(min_rate), self.max_rate)
+    self.rate = self.max_rate
+    self.capacity = float(burst or rate)
+    self.tokens = self.capacity
+    self.stamp = time.time()
+    self.slowed = 0
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    """Block until a request may be made."""
+    while True:
+      with self.lock:
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+  def throttled(self):
+    """Note that a request was throttled: halve the rate and drop any burst.
+
+    Throttles seen within a second of the last cut are taken to be the same
+    overload, so concurrent workers don't collapse the rate between them."""
+    with self.lock:
+      now = time.time()
+      self.tokens = min(self.tokens, 0)
+      if now - self.slowed >= 1:
+        self.slowed = now
+        self.rate = max(self.min_rate, self.rate / 2)
+        log.debug('throttled; slowing to %.2f requests/s' % self.rate)
+
+  def succeeded(self):
+    """Note that a request went through: raise the rate a little."""
+    with self.lock:
+      if self.rate < self.max_rate:
+        self.rate = min(self.max_rate, self.rate + 1 / self.rate)
 
-def fetch_config(zone, conn):
+# Error codes worth retrying after a pause; see
+# http://docs.aws.amazon.com/Route53/latest/DeveloperGuide/DNSLimitations.html
+RETRY_ERRORS = ('Throttling', 'PriorRequestNotComplete', 'ServiceUnavailable')
+
+class ThrottledConnection(object):
+  """Route53Connection wrapper that takes a RateLimiter token per API call
+  and retries throttled calls.
+
+  Calls failing with one of RETRY_ERRORS or a 5xx status are retried after
+  a jittered exponential backoff (a random delay of up to
+  base_delay * 2^attempt, capped at max_delay), and slow the shared limiter
+  down. Calls failing on a broken connection, typically a kept-alive one
+  the server has since closed, are retried the same way on a new one.
+  boto's own retries are turned off, so every attempt goes through the
+  limiter. Everything not wrapped here is passed through to the
+  connection.
+
+  Args: conn: boto.route53.Route53Connection
+        limiter: RateLimiter
+        retries: how many times to retry a call before giving up.
+        base_delay, max_delay: seconds; see above."""
+
+  def __init__(self, conn, limiter, retries=8, base_delay=0.5, max_delay=30):
+    self.conn = conn
+    self.limiter = limiter
+    self.retries = retries
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    import session
+    if isinstance(conn, session.Route53Connection):
+      conn._retry_handler = session.keep_error_body
+      conn.num_retries = 0
+
+  def __getattr__(self, name):
+    return getattr(self.conn, name)
+
+  def _call(self, method, *args, **kwargs):
+    from boto.exception import BotoServerError
+    import session
+    attempt = 0
+    while True:
+      self.limiter.acquire()
+      try:
+        result = method(*args, **kwargs)
+      except BotoServerError as e:
+        if (e.error_code not in RETRY_ERRORS and e.status < 500) or attempt >= self.retries:
+          raise
+        reason = e.error_code or e.status
+        self.limiter.throttled()
+      except (socket.error, httplib.HTTPException) as e:
+        if attempt >= self.retries:
+          raise
+        reason = repr(e)
+        # The server dropped the connection boto used; it will have dropped
+        # the other idle ones in the pool too.
+        session.drop_connections(self.conn)
+      else:
+        self.limiter.succeeded()
+        return result
+      delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+      attempt += 1
+      STATS.count(retries=1)
+      log.debug('%s; retry %d in %.2fs' % (reason, attempt, delay))
+      time.sleep(delay)
+
+  def _make_request(self, *args, **kwargs):
+    resp = self.conn.make_request(*args, **kwargs)
+    if getattr(resp, 'status', 200) == 400:
+      from boto.route53.exception import DNSServerError
+      raise DNSServerError(resp.status, resp.reason, resp.read())
+    return resp
+
+  def make_request(self, *args, **kwargs):
+    return self._call(self._make_request, *args, **kwargs)
+
+  def change_rrsets(self, *args, **kwargs):
+    return self._call(self.conn.change_rrsets, *args, **kwargs)
+
+  def get_change(self, *args, **kwargs):
+    return self._call(self.conn.get_change, *args, **kwargs)
+
+def rrset_path(zone, name=None, type=None, identifier=None, max_items=None):
+  """Build the ListResourceRecordSets request path for a page of a zone.
+
+  Args: zone: string, hosted zone id.
+        name, type, identifier: optional Next* cursor from the previous page,
+          or where to start listing.
+        max_items: optional page size.
+  Returns: string eg. /2013-04-01/hostedzone/ZE2DYFZDWGSL4/rrset"""
+  getstr = '/%s/hostedzone/%s/rrset' % (R53_API_VERSION, zone)
+  params = []
+  if name is not None:
+    params.append('name=%s' % name)
+    if type is not None:
+      params.append('type=%s' % type)
+      if identifier is not None:
+        params.append('identifier=%s' % identifier)
+  if max_items is not None:
+    params.append('maxitems=%d' % max_items)
+  if params:
+    getstr += '?' + '&'.join(params)
+  return getstr
+
+def fetch_config(zone, conn, retries=3):
   """Fetch all pieces of a Route 53 config from Amazon.
 
+  A page that breaks off part way through is fetched again from the same
+  cursor, keeping the pages already fetched.
+
   Args: zone: string, hosted zone id.
         conn: boto.route53.Route53Connection
+        retries: how many broken pages to refetch before giving up.
   Returns: list of ElementTrees, one for each piece of config."""
   more_to_fetch = True
   cfg_chunks = []
@@ -49,15 +395,21 @@ def fetch_config(zone, conn):
   next_identifier = None
   while more_to_fetch == True:
     more_to_fetch = False
-    getstr = '/%s/hostedzone/%s/rrset' % (R53_API_VERSION, zone)
-    if next_name is not None:
-      getstr += '?name=%s&type=%s' % (next_name, next_type)
-      if next_identifier is not None:
-        getstr += '&identifier=%s' % next_identifier
+    getstr = rrset_path(zone, next_name, next_type, next_identifier)
     log.debug('requesting %s' % getstr)
     resp = conn.make_request('GET', getstr)
-    etree = lxml.etree.parse(resp)
+    check_response(resp)
+    try:
+      etree = lxml.etree.parse(resp)
+    except (socket.error, httplib.HTTPException, lxml.etree.XMLSyntaxError) as e:
+      if retries <= 0:
+        raise
+      retries -= 1
+      log.warning('page %s broke off (%s); fetching it again' % (getstr, e))
+      more_to_fetch = True
+      continue
     cfg_chunks.append(etree)
+    STATS.count(pages=1, rrsets=len(etree.getroot().findall('.//{%s}ResourceRecordSet' % R53_XMLNS)))
     root = etree.getroot()
     truncated = root.find('{%s}IsTruncated' % R53_XMLNS)
     if truncated is not None and truncated.text == 'true':
@@ -70,12 +422,101 @@ def fetch_config(zone, conn):
         next_identifier = None
   return cfg_chunks
 
+def iter_rrsets(zone, conn, retries=3, start=None, max_items=None):
+  """Stream every ResourceRecordSet of a zone, one page at a time.
+
+  Each page is parsed incrementally and elements are discarded once the
+  caller is done with them, so memory use does not grow with zone size.
+  A yielded element is only valid until the next one is requested: copy
+  it (or convert it) if it has to outlive the iteration.
+
+  If a page breaks off part way through, listing resumes from the last
+  record yielded rather than starting over.
+
+  Args: zone: string, hosted zone id.
+        conn: boto.route53.Route53Connection
+        retries: how many broken pages to resume from before giving up.
+        start: optional (name, type, identifier) to start listing at.
+        max_items: optional page size.
+  Yields: lxml.etree.Element (<ResourceRecordSet>)"""
+  rrset_tag = '{%s}ResourceRecordSet' % R53_XMLNS
+  cursor_tags = {
+      '{%s}NextRecordName' % R53_XMLNS: 'name',
+      '{%s}NextRecordType' % R53_XMLNS: 'type',
+      '{%s}NextRecordIdentifier' % R53_XMLNS: 'identifier',
+      }
+  cursor = dict(zip(('name', 'type', 'identifier'), start or ()))
+  last = None
+  skip = None
+  while True:
+    getstr = rrset_path(zone, max_items=max_items, **cursor)
+    log.debug('requesting %s' % getstr)
+    resp = conn.make_request('GET', getstr)
+    check_response(resp)
+    truncated = False
+    cursor = {}
+    n = 0
+    try:
+      for _, elem in lxml.etree.iterparse(resp, events=('end',)):
+        if elem.tag == rrset_tag:
+          key = rrset_key(elem)
+          if key != skip:
+            last = key
+            n += 1
+            yield elem
+          skip = None
+          # drop this record and anything already seen before it
+          elem.clear()
+          while elem.getprevious() is not None:
+            del elem.getparent()[0]
+        elif elem.tag == '{%s}IsTruncated' % R53_XMLNS:
+          truncated = elem.text == 'true'
+        elif elem.tag in cursor_tags:
+          cursor[cursor_tags[elem.tag]] = elem.text
+    except (socket.error, httplib.HTTPException, lxml.etree.XMLSyntaxError) as e:
+      if retries <= 0:
+        raise
+      retries -= 1
+      log.warning('listing %s broke off (%s); resuming after %s' % (zone, e, last and last[0]))
+      # ListResourceRecordSets starts at the record named, so skip it again.
+      cursor = dict(zip(('name', 'type', 'identifier'), last or start or ()))
+      skip = last
+      continue
+    finally:
+      STATS.count(pages=1, rrsets=n)
+    if not truncated:
+      return
+
+def _write_element(xf, elem, depth):
+  """Write elem to an lxml.etree.xmlfile, indented like pretty_print."""
+  xf.write('\n' + '  ' * depth)
+  with xf.element(elem.tag):
+    if len(elem):
+      for child in elem:
+        _write_element(xf, child, depth + 1)
+      xf.write('\n' + '  ' * depth)
+    elif elem.text:
+      xf.write(elem.text)
+
+def write_rrsets(rrsets, out):
+  """Incrementally write ResourceRecordSet elements as a <ResourceRecordSets>
+  document, so output starts before the whole zone has been fetched.
+
+  Args: rrsets: iterable of lxml.etree.Element (<ResourceRecordSet>)
+        out: file-like object to write to."""
+  with lxml.etree.xmlfile(out, buffered=False) as xf:
+    with xf.element('{%s}ResourceRecordSets' % R53_XMLNS, nsmap={None: R53_XMLNS}):
+      for rrset in rrsets:
+        _write_element(xf, rrset, 1)
+      xf.write('\n')
+  out.write('\n')
+
 def merge_config(cfg_chunks):
   """Merge a set of fetched Route 53 config Etrees into a canonical form.
 
   Args: cfg_chunks: [ lxml.etree.ETree ]
   Returns: lxml.etree.Element"""
-  root = lxml.etree.XML('<ResourceRecordSets xmlns="%s"></ResourceRecordSets>' % R53_XMLNS, parser=XML_PARSER)
+  root = lxml.etree.XML('<ResourceRecordSets xmlns="%s"></ResourceRecordSets>' % R53_XMLNS, parser=xml_parser())
   for chunk in cfg_chunks:
     for rrset in chunk.iterfind('.//{%s}ResourceRecordSet' % R53_XMLNS):
       root.append(rrset)
@@ -111,94 +552,1522 @@ def normalize_rrs(rrsets):
           rrs[:] = sorted_rrs
   return rrsets
 
-def generate_changeset(old, new, comment=None):
+# Children of a <ResourceRecordSet>, in the order the schema requires them.
+RRSET_FIELDS = ('Name', 'Type', 'SetIdentifier', 'Weight', 'Region', 'GeoLocation', 'Failover',
+                'MultiValueAnswer', 'TTL', 'ResourceRecords', 'AliasTarget', 'HealthCheckId',
+                'TrafficPolicyInstanceId', 'CidrRoutingConfig', 'GeoProximityLocation')
+_FIELD_ORDER = dict((field, i) for i, field in enumerate(RRSET_FIELDS))
+
+# Children of the nested fields, likewise.
+NESTED_FIELDS = {
+    'AliasTarget': ('HostedZoneId', 'DNSName', 'EvaluateTargetHealth'),
+    'GeoLocation': ('ContinentCode', 'CountryCode', 'SubdivisionCode'),
+    'CidrRoutingConfig': ('CollectionId', 'LocationName'),
+    }
+
+def _field_order(field):
+  return (_FIELD_ORDER.get(field[0], len(RRSET_FIELDS)), field[0])
+
+def _localname(tag):
+  return tag.rpartition('}')[2]
+
+def _text(elem):
+  """Returns: elem's text without surrounding whitespace, or None."""
+  text = elem.text
+  return text.strip() if text else text
+
+def canonical_name(name):
+  """Spell a record set name the way Route 53 lists it: lower case, fully
+  qualified, and with a leading wildcard written as \\052 (see normalize_rrs).
+
+  Route 53 compares names case-insensitively and accepts them without the
+  trailing dot, but always lists them in this form."""
+  name = name.lower()
+  if not name.endswith('.'):
+    name += '.'
+  if name.startswith('*.'):
+    name = '\\052.%s' % name[2:]
+  return name
+
+def _canonical_field(field):
+  """Put a nested field's children in schema order, and spell an alias's
+  DNSName as canonical_name does, as Route 53 lists it.
+
+  Args: field: (tag, text) pair of RRSet.extra.
+  Returns: the same field, canonicalized."""
+  tag, value = field
+  if not isinstance(value, tuple):
+    return field
+  if tag == 'AliasTarget':
+    value = [(sub, canonical_name(text) if sub == 'DNSName' and text else text) for sub, text in value]
+  order = NESTED_FIELDS.get(tag, ())
+  return tag, tuple(sorted(value, key=lambda sub: (order.index(sub[0]) if sub[0] in order else len(order),
+                                                   sub[0])))
+
+def _utf8(text):
+  if isinstance(text, unicode):
+    return text.encode('utf-8')
+  return text
+
+class RRSet(object):
+  """Immutable, compact form of a <ResourceRecordSet>.
+
+  Names, alias target names included, are passed through canonical_name,
+  values kept sorted and fields kept in schema order, so two RRSets are
+  equal exactly when Route 53 would consider them the same record set. The
+  hash is computed once, up front; fingerprint is a stable digest for
+  comparing record sets across processes.
+
+  Fields other than Name, Type, SetIdentifier, TTL and ResourceRecords
+  (Weight, AliasTarget, GeoLocation, ...) are kept in extra as (tag, text)
+  pairs; a nested element's text is itself a tuple of (tag, text) pairs.
+
+  Args: name, type: strings.
+        set_identifier, ttl: strings or None.
+        values: iterable of ResourceRecord Value strings.
+        extra: iterable of (tag, text) pairs."""
+  __slots__ = ('name', 'type', 'set_identifier', 'ttl', 'values', 'extra', '_hash', '_fingerprint')
+
+  def __init__(self, name, type, set_identifier=None, ttl=None, values=(), extra=()):
+    name = canonical_name(name)
+    values = tuple(sorted(values))
+    extra = tuple(sorted((_canonical_field(field) for field in extra), key=_field_order)) if extra else ()
+    init = object.__setattr__
+    init(self, 'name', name)
+    init(self, 'type', type)
+    init(self, 'set_identifier', set_identifier)
+    init(self, 'ttl', ttl)
+    init(self, 'values', values)
+    init(self, 'extra', extra)
+    init(self, '_hash', hash((name, type, set_identifier, ttl, values, extra)))
+
+  def __setattr__(self, name, value):
+    raise AttributeError('RRSet is immutable')
+
+  def __reduce__(self):
+    return (RRSet, (self.name, self.type, self.set_identifier, self.ttl, self.values, self.extra))
+
+  def __hash__(self):
+    return self._hash
+
+  def __eq__(self, other):
+    return (isinstance(other, RRSet) and self._hash == other._hash and
+            self.name == other.name and self.type == other.type and
+            self.set_identifier == other.set_identifier and self.ttl == other.ttl and
+            self.values == other.values and self.extra == other.extra)
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'RRSet(%r, %r, %r, %r, %r, %r)' % (self.name, self.type, self.set_identifier,
+                                              self.ttl, self.values, self.extra)
+
+  @property
+  def key(self):
+    """(Name, Type, SetIdentifier): how Route 53 identifies a record set."""
+    return (self.name, self.type, self.set_identifier)
+
+  def to_dict(self):
+    """Returns: dict of the fields that are set, for JSON; nested elements
+    become dicts too."""
+    d = {'name': self.name, 'type': self.type}
+    if self.set_identifier is not None:
+      d['set_identifier'] = self.set_identifier
+    if self.ttl is not None:
+      d['ttl'] = self.ttl
+    if self.values:
+      d['values'] = list(self.values)
+    for tag, text in self.extra:
+      d[tag] = dict(text) if isinstance(text, tuple) else text
+    return d
+
+  @property
+  def fingerprint(self):
+    """Hex SHA-1 of the record set's canonical form. Unlike hash() it is the
+    same in every process and on every machine, so it can be stored or
+    compared with another host's."""
+    try:
+      return self._fingerprint
+    except AttributeError:
+      pass
+    parts = [self.name, self.type, self.set_identifier, self.ttl, '\x02']
+    parts.extend(self.values)
+    for tag, text in self.extra:
+      parts.append('\x02' + tag)
+      if isinstance(text, tuple):
+        for subtag, subtext in text:
+          parts.append(subtag)
+          parts.append(subtext)
+      else:
+        parts.append(text)
+    parts = ['\x01' if part is None else part for part in parts]
+    try:
+      data = '\x00'.join(parts)
+      if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    except UnicodeDecodeError:
+      # utf-8 bytes mixed with unicode text.
+      data = '\x00'.join(_utf8(part) for part in parts)
+    fingerprint = hashlib.sha1(data).hexdigest()
+    object.__setattr__(self, '_fingerprint', fingerprint)
+    return fingerprint
+
+  @classmethod
+  def from_element(cls, elem):
+    """Build an RRSet from a <ResourceRecordSet> element in a single pass.
+
+    This is the whole of canonicalization: whitespace around text is
+    stripped here, so the element needs neither normalize_xml nor
+    normalize_rrs first, and the constructor sorts values and normalizes
+    the name."""
+    name = type = set_identifier = ttl = None
+    values = ()
+    extra = []
+    for child in elem:
+      tag = child.tag
+      if not isinstance(tag, basestring):
+        continue
+      tag = _localname(tag)
+      if tag == 'Name':
+        name = _text(child)
+      elif tag == 'Type':
+        type = _text(child)
+      elif tag == 'SetIdentifier':
+        set_identifier = _text(child)
+      elif tag == 'TTL':
+        ttl = _text(child)
+      elif tag == 'ResourceRecords':
+        values = [_text(value) for value in child.iterfind('{%s}ResourceRecord/{%s}Value' % (R53_XMLNS, R53_XMLNS))]
+      elif len(child):
+        extra.append((tag, tuple((_localname(c.tag), _text(c)) for c in child
+                                 if isinstance(c.tag, basestring))))
+      else:
+        extra.append((tag, _text(child)))
+    return cls(name, type, set_identifier, ttl, values, extra)
+
+  def to_element(self, parent=None):
+    """Serialize to a <ResourceRecordSet>, appended to parent if given.
+
+    Returns: lxml.etree.Element"""
+    if parent is None:
+      rrset = lxml.etree.Element('{%s}ResourceRecordSet' % R53_XMLNS, nsmap={None: R53_XMLNS})
+    else:
+      rrset = lxml.etree.SubElement(parent, '{%s}ResourceRecordSet' % R53_XMLNS)
+    fields = [('Name', self.name), ('Type', self.type)]
+    if self.set_identifier is not None:
+      fields.append(('SetIdentifier', self.set_identifier))
+    if self.ttl is not None:
+      fields.append(('TTL', self.ttl))
+    if self.values:
+      fields.append(('ResourceRecords', self.values))
+    fields.extend(self.extra)
+    fields.sort(key=_field_order)
+    for tag, value in fields:
+      child = lxml.etree.SubElement(rrset, '{%s}%s' % (R53_XMLNS, tag))
+      if tag == 'ResourceRecords':
+        for v in value:
+          rr = lxml.etree.SubElement(child, '{%s}ResourceRecord' % R53_XMLNS)
+          lxml.etree.SubElement(rr, '{%s}Value' % R53_XMLNS).text = v
+      elif isinstance(value, tuple):
+        for subtag, text in value:
+          lxml.etree.SubElement(child, '{%s}%s' % (R53_XMLNS, subtag)).text = text
+      else:
+        child.text = value
+    return rrset
+
+def rrsets_from_xml(rrsets):
+  """Args: rrsets: lxml.etree.Element (<ResourceRecordSets>)
+  Returns: [ RRSet ]"""
+  return [RRSet.from_element(rrset) for rrset in rrsets.iterfind('{%s}ResourceRecordSet' % R53_XMLNS)]
+
+def rrsets_to_xml(rrsets):
+  """Args: rrsets: iterable of RRSet
+  Returns: lxml.etree.Element (<ResourceRecordSets>)"""
+  root = lxml.etree.Element('{%s}ResourceRecordSets' % R53_XMLNS, nsmap={None: R53_XMLNS})
+  for rrset in rrsets:
+    rrset.to_element(root)
+  return root
+
+def iter_parse_rrsets(source):
+  """Stream RRSets from a <ResourceRecordSets> file, without keeping the
+  document tree around.
+
+  Args: source: filename or file-like object.
+  Yields: RRSet"""
+  for _, elem in lxml.etree.iterparse(source, tag='{%s}ResourceRecordSet' % R53_XMLNS):
+    yield RRSet.from_element(elem)
+    elem.clear()
+    while elem.getprevious() is not None:
+      del elem.getparent()[0]
+
+def parse_rrsets(source):
+  """Read a <ResourceRecordSets> file straight into RRSets.
+
+  Args: source: filename or file-like object.
+  Returns: [ RRSet ]"""
+  return list(iter_parse_rrsets(source))
+
+CONFIG_FORMATS = ('xml', 'bind', 'json')
+
+def config_format(filename):
+  """Guess a config's format from its file name: .json is JSON, .zone, .db
+  and .bind are RFC 1035 zone files, and anything else is Route 53 XML."""
+  ext = os.path.splitext(filename)[1].lower()
+  if ext == '.json':
+    return 'json'
+  if ext in ('.zone', '.db', '.bind'):
+    return 'bind'
+  return 'xml'
+
+def read_config(source, format=None, origin=None):
+  """Read a config to push, in any of CONFIG_FORMATS.
+
+  Args: source: filename, or an open file. Gzipped files, such as
+          snapshots, are read through gzip if their name ends in .gz.
+        format: one of CONFIG_FORMATS; guessed from the file name if None.
+        origin: string, zone name that relative names in zone files are in.
+  Returns: [ RRSet ]
+  Raises: zonefile.ZoneFileError on malformed zone files and JSON."""
+  if isinstance(source, basestring) and source.endswith('.gz'):
+    with gzip.open(source, 'rb') as f:
+      return read_config(f, format or config_format(source[:-3]), origin)
+  if format is None:
+    format = config_format(getattr(source, 'name', source))
+  if format == 'xml':
+    return parse_rrsets(source)
+  if isinstance(source, basestring):
+    with open(source) as f:
+      return read_config(f, format, origin)
+  import zonefile
+  if format == 'json':
+    return zonefile.parse_json(source)
+  if origin is None:
+    raise InvalidArgumentException('zone files need an origin')
+  return zonefile.parse_zonefile(source, origin)
+
+def iter_config(source, format=None, origin=None):
+  """Like read_config, but streams XML configs rather than reading them
+  whole; other formats are read whole regardless.
+
+  Yields: RRSet"""
+  if (format or config_format(getattr(source, 'name', source))) == 'xml':
+    return iter_parse_rrsets(source)
+  return iter(read_config(source, format, origin))
+
+def fetch_rrsets(zone, conn):
+  """Fetch a zone's live config as RRSets.
+
+  Args: zone: string, hosted zone id.
+        conn: boto.route53.Route53Connection
+  Returns: [ RRSet ]"""
+  return [RRSet.from_element(rrset) for rrset in iter_rrsets(zone, conn)]
+
+def run_parallel(func, items, workers):
+  """Call func on every item from up to workers threads.
+
+  Returns: [ func(item) ] in the order of items.
+  Raises: the first exception any call raised, once all calls are done."""
+  queue = Queue.Queue()
+  for i, item in enumerate(items):
+    queue.put((i, item))
+  results = [None] * len(items)
+  errors = []
+
+  def worker():
+    while True:
+      try:
+        i, item = queue.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = func(item)
+      except Exception as e:
+        errors.append(sys.exc_info())
+
+  threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+  for thread in threads:
+    thread.daemon = True
+    thread.start()
+  for thread in threads:
+    thread.join()
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return results
+
+def shard_boundaries(rrsets, shards):
+  """Pick where to start each shard of a sharded fetch so the shards come out
+  about the same size.
+
+  Args: rrsets: [ RRSet ] in listing order, eg. an earlier fetch or snapshot.
+        shards: int, how many shards to make.
+  Returns: [ (name, type, identifier) ] start keys of every shard but the
+           first, which starts at the beginning of the zone."""
+  boundaries = []
+  for i in range(1, shards):
+    key = rrsets[i * len(rrsets) // shards].key
+    if key not in boundaries:
+      boundaries.append(key)
+  return boundaries
+
+def listing_order(key):
+  """Sort key putting (Name, Type, SetIdentifier) keys in about the order
+  ListResourceRecordSets returns them: names compared label by label from
+  the right, case-insensitively, then by type and set identifier."""
+  name, rtype, identifier = key
+  labels = tuple(reversed(name.lower().rstrip('.').split('.')))
+  return (labels, rtype or '', identifier or '')
+
+# Characters to probe with for shard boundaries, spread over the name space.
+PROBE_LABELS = '0123456789abcdefghijklmnopqrstuvwxyz'
+# Zones that fit in one page of this many are not worth probing.
+PROBE_PAGE = 300
+# Probes per shard at each of probe_boundaries' two levels.
+PROBES_PER_SHARD = 4
+
+def _probe_labels(n):
+  """Returns: n of PROBE_LABELS (all of them if n is larger), evenly spread."""
+  n = min(n, len(PROBE_LABELS))
+  return [PROBE_LABELS[i * len(PROBE_LABELS) // n] for i in range(n)]
+
+def probe_boundaries(zone, conn, shards, workers=8):
+  """Find shard starting points in a zone without a listing to go by.
+
+  Asks for the first record at or after names made of characters spread
+  over PROBE_LABELS just below the apex, then again around each first
+  label found that way (after host17 comes host10, host15...), so zones
+  whose names share a prefix still split up. Costs one page of PROBE_PAGE
+  records, and then, unless that was the whole zone, up to about
+  2 * PROBES_PER_SHARD * shards one-record requests.
+
+  Args: zone: string, hosted zone id.
+        conn: boto.route53.Route53Connection
+        shards: int, how many shards to aim for.
+        workers: how many probes to make at once.
+  Returns: see shard_boundaries; [] for a zone that fits in one page."""
+  def first(name):
+    for elem in iter_rrsets(zone, conn, retries=0, start=(name,) if name else None, max_items=1):
+      return rrset_key(elem)
+
+  page = [rrset_key(elem) for elem in
+          itertools.islice(iter_rrsets(zone, conn, retries=0, max_items=PROBE_PAGE), PROBE_PAGE)]
+  if len(page) < PROBE_PAGE:
+    return []
+  apex = page[0]
+  origin = apex[0]
+  depth = len(origin.rstrip('.').split('.'))
+  budget = PROBES_PER_SHARD * shards
+
+  def probe(prefixes, labels):
+    names = ['%s%s.%s' % (prefix, c, origin) for prefix in prefixes for c in labels]
+    return set(key for key in run_parallel(first, names, workers) if key is not None and key != apex)
+
+  keys = probe([''], _probe_labels(budget))
+  labels = set()
+  for name, _, _ in sorted(keys, key=listing_order):
+    label = name.rstrip('.').split('.')[-depth - 1]
+    if len(label) > 1:
+      labels.add(label[:-1])
+    if len(labels) >= shards:
+      break
+  if labels:
+    keys |= probe(sorted(labels), _probe_labels(max(2, budget // len(labels))))
+  keys = sorted(keys, key=listing_order)
+  if len(keys) < shards:
+    return keys
+  return [keys[i * len(keys) // shards] for i in range(1, shards)]
+
+def fetch_rrsets_sharded(zone, conn, boundaries, workers=8):
+  """Fetch a zone's live config as RRSets, listing several stretches of it
+  at once.
+
+  Shard i lists from boundaries[i - 1] (shard 0 from the start of the zone)
+  until it reaches the first record the next shard found, so however the
+  boundaries were picked, and whatever changed since, every record is
+  fetched: a boundary that no longer exists only costs overlap, which is
+  dropped.
+
+  Args: zone: string, hosted zone id.
+        conn: boto.route53.Route53Connection, shared by the workers.
+        boundaries: see shard_boundaries or probe_boundaries; in listing
+          order, or the result will be out of order.
+        workers: how many shards to fetch at once.
+  Returns: [ RRSet ] in listing order, as fetch_rrsets would."""
+  starts = [None] + list(boundaries)
+  # first[i]: key of the first record shard i found; None until known,
+  # False if the shard was empty.
+  first = [None] * len(starts)
+
+  def stop_key(i):
+    for key in first[i + 1:]:
+      if key is None or key:
+        return key
+    return None
+
+  def fetch(i):
+    rrsets = []
+    stop = None
+    for elem in iter_rrsets(zone, conn, start=starts[i]):
+      rrset = RRSet.from_element(elem)
+      if not rrsets:
+        first[i] = rrset.key
+      if stop is None:
+        stop = stop_key(i)
+      if rrset.key == stop:
+        break
+      rrsets.append(rrset)
+    if not rrsets:
+      first[i] = False
+    return rrsets
+
+  shards = run_parallel(fetch, range(len(starts)), workers)
+  rrsets = []
+  seen = set()
+  for i, shard in enumerate(shards):
+    stop = stop_key(i)
+    for rrset in shard:
+      if rrset.key == stop:
+        break
+      if rrset.key not in seen:
+        seen.add(rrset.key)
+        rrsets.append(rrset)
+  log.debug('fetched %d record sets in %d shards' % (len(rrsets), len(shards)))
+  return rrsets
+
+def fetch_rrsets_for(zone, conn, keys, max_items=10, workers=8):
+  """Fetch just the live record sets with the given names and types.
+
+  Lists a few records starting at each (Name, Type) instead of the whole
+  zone, so checking a handful of keys costs a handful of requests.
+
+  Args: zone: string, hosted zone id.
+        conn: boto.route53.Route53Connection
+        keys: iterable of (Name, Type).
+        max_items: page size; more pages are fetched only for sets with
+          more set identifiers than that.
+        workers: how many keys to look up at once.
+  Returns: [ RRSet ] for every key, in the order of keys."""
+  keys = sorted(set(keys), key=lambda key: listing_order(key + (None,)))
+
+  def fetch(key):
+    name, rtype = key
+    rrsets = []
+    for elem in iter_rrsets(zone, conn, start=(name, rtype), max_items=max_items):
+      rrset = RRSet.from_element(elem)
+      if rrset.name.lower() != name.lower() or rrset.type != rtype:
+        break
+      rrsets.append(rrset)
+    return rrsets
+
+  return [rrset for rrsets in run_parallel(fetch, keys, workers) for rrset in rrsets]
+
+def touched_keys(old, new):
+  """Find what a local edit touches.
+
+  Args: old, new: [ RRSet ], eg. the last snapshot and the file to push.
+  Returns: set of (Name, Type) that differ between them."""
+  return set((rrset.name, rrset.type) for _, rrset in diff_rrsets(old, new))
+
+def plan_targeted_push(conn, zone_id, new_config, keys):
+  """Plan a push of new_config that only touches keys, checking the live
+  state of just those keys rather than fetching the whole zone.
+
+  Anything changed in Route 53 outside keys is neither noticed nor undone.
+
+  Args: conn: boto.route53.Route53Connection
+        zone_id: string, hosted zone id.
+        new_config: [ RRSet ]
+        keys: set of (Name, Type), eg. from touched_keys.
+  Returns: as plan_push."""
+  live = fetch_rrsets_for(zone_id, conn, keys)
+  wanted = set((name.lower(), rtype) for name, rtype in keys)
+  new = [rrset for rrset in new_config if (rrset.name.lower(), rrset.type) in wanted]
+  return plan_push(live, new, zone_id, complete=False)
+
+def rrset_key(rrset):
+  """Identify a ResourceRecordSet the way Route 53 does.
+
+  Args: rrset: lxml.etree.Element (<ResourceRecordSet>)
+  Returns: (Name, Type, SetIdentifier) tuple; SetIdentifier may be None."""
+  return (rrset.findtext('{%s}Name' % R53_XMLNS),
+          rrset.findtext('{%s}Type' % R53_XMLNS),
+          rrset.findtext('{%s}SetIdentifier' % R53_XMLNS))
+
+def index_rrsets(rrsets):
+  """Index a config by key.
+
+  Args: rrsets: iterable of RRSet.
+  Returns: dict mapping each RRSet.key to its RRSet.
+  Raises: InvalidArgumentException if a key appears more than once."""
+  index = {}
+  for rrset in rrsets:
+    if rrset.key in index:
+      msg = 'duplicate ResourceRecordSet for name %s type %s identifier %s' % rrset.key
+      log.error(msg)
+      raise InvalidArgumentException(msg)
+    index[rrset.key] = rrset
+  return index
+
+def diff_rrsets(old, new, processes=1):
+  """Diff two configs keyed by (Name, Type, SetIdentifier): sets only in old
+  are DELETEd, sets only in new are CREATEd, and sets whose contents differ
+  are UPSERTed in place.
+
+  Args: old, new: [ RRSet ]
+        processes: int, diff in this many processes; see diff_rrsets_sharded.
+  Returns: [ (action, RRSet) ]: DELETEs in old's order, then CREATEs and
+           UPSERTs in new's order."""
+  if processes > 1:
+    return diff_rrsets_sharded(old, new, processes)
+  old_index = index_rrsets(old)
+  new_index = index_rrsets(new)
+  changes = []
+  # look for removed elements
+  for rrset in old:
+    if rrset.key not in new_index:
+      log.debug("REMOVED: %r" % (rrset,))
+      changes.append(('DELETE', rrset))
+  # look for added and modified elements
+  for rrset in new:
+    current = old_index.get(rrset.key)
+    if current is None:
+      log.debug("ADDED: %r" % (rrset,))
+      changes.append(('CREATE', rrset))
+    elif current != rrset:
+      log.debug("MODIFIED: %r" % (rrset,))
+      changes.append(('UPSERT', rrset))
+  return changes
+
+# In a diff_rrsets_sharded worker, the configs being diffed.
+_DIFF_INPUT = None
+
+def _init_diff_worker(old, new):
+  global _DIFF_INPUT
+  _DIFF_INPUT = (old, new)
+  # A collection in a worker would write to every object it inherited,
+  # copying the parent's whole heap; the workers are short-lived anyway.
+  gc.disable()
+
+def _index_shard(rrsets, shard, shards):
+  index = {}
+  for i, rrset in enumerate(rrsets):
+    # Partitioning by name keeps every key of a name in one shard, and a
+    # string's hash is cached, so skipping other shards' sets costs little.
+    if hash(rrset.name) % shards == shard:
+      key = rrset.key
+      if key in index:
+        msg = 'duplicate ResourceRecordSet for name %s type %s identifier %s' % key
+        log.error(msg)
+        raise InvalidArgumentException(msg)
+      index[key] = i
+  return index
+
+def _diff_shard(args):
+  """Diff the keys that hash to shard.
+
+  Returns: ([ index in old of each DELETE ], [ (index in new, action) of
+           each CREATE and UPSERT ]), both sorted."""
+  shard, shards = args
+  old, new = _DIFF_INPUT
+  old_index = _index_shard(old, shard, shards)
+  new_index = _index_shard(new, shard, shards)
+  deletes = sorted(i for key, i in old_index.iteritems() if key not in new_index)
+  changes = []
+  for key, j in new_index.iteritems():
+    i = old_index.get(key)
+    if i is None:
+      changes.append((j, 'CREATE'))
+    elif old[i] != new[j]:
+      changes.append((j, 'UPSERT'))
+  changes.sort()
+  return deletes, changes
+
+def diff_rrsets_sharded(old, new, processes):
+  """diff_rrsets, spread over a pool of processes.
+
+  Record sets are partitioned by the hash of their name, part of their key,
+  so a key lands in the same shard in both configs, and each shard is diffed
+  in a process of its own. Workers are forked with the configs already in
+  memory, handed to them by the pool itself so concurrent calls never share
+  them, and send back only positions, which are merged back into exactly the
+  changes, in exactly the order, diff_rrsets gives.
+
+  Args: old, new: [ RRSet ]
+        processes: int, how many shards and processes.
+  Returns: as diff_rrsets."""
+  import multiprocessing
+  # Pool's forked workers inherit initargs rather than unpickling them.
+  pool = multiprocessing.Pool(processes, _init_diff_worker, (old, new))
+  try:
+    shards = pool.map(_diff_shard, [(shard, processes) for shard in range(processes)])
+  finally:
+    pool.terminate()
+    pool.join()
+  changes = [('DELETE', old[i]) for i in heapq.merge(*[shard[0] for shard in shards])]
+  changes.extend((action, new[j]) for j, action in heapq.merge(*[shard[1] for shard in shards]))
+  return changes
+
+def default_comment():
+  try:
+    user = getpass.getuser()
+  except (ImportError, KeyError):
+    user = 'unknown'
+  return 'Generated by %s for %s@%s at %s.' % (
+      __file__,
+      user,
+      socket.gethostname(),
+      time.strftime('%Y-%m-%d %H:%M:%S'))
+
+def changes_to_xml(changes, comment=None):
+  """Serialize changes into a request body.
+
+  Args: changes: [ (action, RRSet) ]
+        comment: string, defaults to default_comment().
+  Returns: lxml.etree.Element (<ChangeResourceRecordSetsRequest>)"""
+  if comment is None:
+    comment = default_comment()
+  root = lxml.etree.Element('{%s}ChangeResourceRecordSetsRequest' % R53_XMLNS, nsmap={None: R53_XMLNS})
+  batch = lxml.etree.SubElement(root, '{%s}ChangeBatch' % R53_XMLNS)
+  lxml.etree.SubElement(batch, '{%s}Comment' % R53_XMLNS).text = comment
+  changesroot = lxml.etree.SubElement(batch, '{%s}Changes' % R53_XMLNS)
+  for action, rrset in changes:
+    change = lxml.etree.SubElement(changesroot, '{%s}Change' % R53_XMLNS)
+    lxml.etree.SubElement(change, '{%s}Action' % R53_XMLNS).text = action
+    rrset.to_element(change)
+  return root
+
+def changes_from_xml(changeset):
+  """Args: changeset: lxml.etree.Element (<ChangeResourceRecordSetsRequest>)
+  Returns: [ (action, RRSet) ]"""
+  changes = []
+  for change in changeset.iterfind('.//{%s}Change' % R53_XMLNS):
+    changes.append((change.findtext('{%s}Action' % R53_XMLNS),
+                    RRSet.from_element(change.find('{%s}ResourceRecordSet' % R53_XMLNS))))
+  return changes
+
+def generate_changeset(old, new, comment=None, processes=1):
   """Diff two XML configs and return an object with changes to be written.
 
+  See diff_rrsets.
+
   Args: old, new: lxml.etree.Element (<ResourceRecordSets>).
+        processes: see diff_rrsets.
   Returns: lxml.etree.ETree (<ChangeResourceRecordSetsRequest>) or None"""
   rrsets_tag = '{%s}ResourceRecordSets' % R53_XMLNS
   if rrsets_tag not in (old.tag, new.tag):
-    log.error('both configs must be ResourceRecordSets tags. old: %s, new: %s' % (old.tag, new.tag))
-    raise InvalidArgumentException()
-  if comment is None:
-    comment = 'Generated by %s for %s@%s at %s.' % (
-        __file__,
-        os.environ['USER'],
-        socket.gethostname(),
-        time.strftime('%Y-%m-%d %H:%M:%S'))
-  root = lxml.etree.XML("""<ChangeResourceRecordSetsRequest xmlns="%s">
-                        <ChangeBatch>
-                          <Comment>%s</Comment>
-                          <Changes/>
-                        </ChangeBatch>
-                        </ChangeResourceRecordSetsRequest>""" % (
-      R53_XMLNS, comment), parser=XML_PARSER)
-  changesroot = root.find('.//{%s}Changes' % R53_XMLNS)
-  old = normalize_rrs(old)
-  new = normalize_rrs(new)
-  oldset = set([lxml.etree.tostring(x).rstrip() for x in old])
-  newset = set([lxml.etree.tostring(x).rstrip() for x in new])
-  if oldset == newset:
-      return None
-  # look for removed elements
-  for rrs in old:
-    rrsst = lxml.etree.tostring(rrs).rstrip()
-    if rrsst not in newset:
-      log.debug("REMOVED:")
-      log.debug(rrsst)
-      change = lxml.etree.XML('<Change xmlns="%s"><Action>DELETE</Action></Change>' % R53_XMLNS, parser=XML_PARSER)
-      change.append(rrs)
-      changesroot.append(change)
-  # look for added elements
-  for rrs in new:
-    rrsst = lxml.etree.tostring(rrs).rstrip()
-    if rrsst not in oldset:
-      log.debug("ADDED:")
-      log.debug(rrsst)
-      change = lxml.etree.XML('<Change xmlns="%s"><Action>CREATE</Action></Change>' % R53_XMLNS, parser=XML_PARSER)
-      change.append(rrs)
-      changesroot.append(change)
-  return root
+    msg = 'both configs must be ResourceRecordSets tags. old: %s, new: %s' % (old.tag, new.tag)
+    log.error(msg)
+    raise InvalidArgumentException(msg)
+  changes = diff_rrsets(rrsets_from_xml(old), rrsets_from_xml(new), processes)
+  if not changes:
+    return None
+  return changes_to_xml(changes, comment)
 
-def validate_changeset(changeset):
-  """Validate a changeset is compatible with Amazon's API spec.
+def change_size(change):
+  """Measure a change against the ChangeResourceRecordSets limits.
 
-  Args: changeset: lxml.etree.Element (<ChangeResourceRecordSetsRequest>)
+  Route 53 counts the records and values of an UPSERT twice.
+
+  Args: change: (action, RRSet)
+  Returns: (ResourceRecord count, <Value> character count)"""
+  action, rrset = change
+  weight = 1
+  if action == 'UPSERT':
+    weight = 2
+  num_chars = 0
+  for value in rrset.values:
+    num_chars += len(value)
+  return weight * len(rrset.values), weight * num_chars
+
+def validate_changes(changes):
+  """Validate one request's worth of changes is compatible with Amazon's API
+  spec.
+
+  Args: changes: [ (action, RRSet) ]
   Returns: [ errors ] list of error strings or []."""
   errors = []
-  changes = changeset.findall('.//{%s}Change' % R53_XMLNS)
   num_changes = len(changes)
   if num_changes == 0:
     errors.append('changeset must have at least one <Change> element')
-  if num_changes > 100:
-    errors.append('changeset has %d <Change> elements: max is 100' % num_changes)
-  rrs = changeset.findall('.//{%s}ResourceRecord' % R53_XMLNS)
-  num_rrs = len(rrs)
-  if num_rrs > 1000:
-    errors.append('changeset has %d ResourceRecord elements: max is 1000' % num_rrs)
-  values = changeset.findall('.//{%s}Value' % R53_XMLNS)
+  if num_changes > MAX_CHANGES:
+    errors.append('changeset has %d <Change> elements: max is %d' % (num_changes, MAX_CHANGES))
+  num_rrs = 0
   num_chars = 0
-  for value in values:
-    num_chars += len(value.text)
-  if num_chars > 10000:
-    errors.append('changeset has %d chars in <Value> text: max is 10000' % num_chars)
+  for change in changes:
+    change_rrs, change_chars = change_size(change)
+    num_rrs += change_rrs
+    num_chars += change_chars
+  if num_rrs > MAX_RRS:
+    errors.append('changeset has %d ResourceRecord elements: max is %d' % (num_rrs, MAX_RRS))
+  if num_chars > MAX_VALUE_CHARS:
+    errors.append('changeset has %d chars in <Value> text: max is %d' % (num_chars, MAX_VALUE_CHARS))
+  return errors
+
+def validate_changeset(changeset):
+  """Validate a changeset is compatible with Amazon's API spec.
+
+  Args: changeset: lxml.etree.Element (<ChangeResourceRecordSetsRequest>)
+  Returns: [ errors ] list of error strings or []."""
+  return validate_changes(changes_from_xml(changeset))
+
+def alias_target(rrset):
+  """Returns: (HostedZoneId, DNSName) an alias record set points at, with
+  DNSName spelled as canonical_name does, or None if rrset is no alias."""
+  target = dict(rrset.extra).get('AliasTarget') if rrset.extra else None
+  if not isinstance(target, tuple):
+    return None
+  target = dict(target)
+  return target.get('HostedZoneId'), canonical_name(target.get('DNSName') or '.')
+
+def order_changes(changes, live_index=None):
+  """Order changes so record sets are created before the aliases that point
+  at them, and deleted after them, including in later batches.
+
+  Changes to the same name are kept together, as plan_change_batches needs,
+  and otherwise keep their order. Dependencies that go round in a circle
+  are left in their original order.
+
+  Args: changes: [ (action, RRSet) ], eg. from diff_rrsets.
+        live_index: optional index_rrsets of the config the changes apply
+          to, to tell what the aliases being UPSERTed pointed at before.
+  Returns: [ (action, RRSet) ]"""
+  groups = collections.OrderedDict()
+  for change in changes:
+    groups.setdefault(change[1].name, []).append(change)
+  names = list(groups)
+  position = dict((name, i) for i, name in enumerate(names))
+  created = {}
+  deleted = {}
+  for action, rrset in changes:
+    made = deleted if action == 'DELETE' else created
+    made.setdefault((rrset.name, rrset.type), set()).add(position[rrset.name])
+  # after[i]: the groups that must come after group i.
+  after = [set() for _ in names]
+  for action, rrset in changes:
+    i = position[rrset.name]
+    if action != 'DELETE':
+      target = alias_target(rrset)
+      if target is not None:
+        for j in created.get((target[1], rrset.type), ()):
+          after[j].add(i)
+    old = rrset if action == 'DELETE' else (live_index or {}).get(rrset.key)
+    target = alias_target(old) if old is not None else None
+    if target is not None:
+      for j in deleted.get((target[1], old.type), ()):
+        after[i].add(j)
+  waiting = [0] * len(names)
+  for i, later in enumerate(after):
+    later.discard(i)
+    for j in later:
+      waiting[j] += 1
+  if not [n for n in waiting if n]:
+    return changes
+  ready = [i for i, n in enumerate(waiting) if n == 0]
+  heapq.heapify(ready)
+  order = []
+  while ready:
+    i = heapq.heappop(ready)
+    order.append(i)
+    for j in after[i]:
+      waiting[j] -= 1
+      if waiting[j] == 0:
+        heapq.heappush(ready, j)
+  if len(order) < len(names):
+    log.warning('alias dependencies between %d names go round in a circle' % (len(names) - len(order)))
+    done = set(order)
+    order.extend(i for i in range(len(names)) if i not in done)
+  return [change for i in order for change in groups[names[i]]]
+
+def _zone_apex(rrsets):
+  for rrset in rrsets:
+    if rrset.type == 'SOA':
+      return rrset.name
+  return None
+
+def preflight(live_config, batches, zone_id=None, live_index=None, complete=True):
+  """Play batches against a zone's config the way Route 53 would, to catch
+  changes it would reject before sending them.
+
+  Checks that CREATEs are of record sets that don't exist yet and DELETEs
+  exactly match what does. With complete set, live_config must be the
+  whole zone, and it also checks that after each batch no CNAME shares
+  its name with other record sets, every alias within the zone points at
+  record sets that exist, and nothing still aliased was deleted.
+
+  Args: live_config: [ RRSet ], the zone's config before the batches.
+        batches: [ [ (action, RRSet) ] ], eg. from plan_change_batches.
+        zone_id: string, the zone's ID, to tell which aliases point into it;
+          without it, aliases to names under the zone's SOA are.
+        live_index: index_rrsets(live_config), if already at hand.
+        complete: bool, whether live_config is the whole zone.
+  Returns: [ errors ] list of error strings or []."""
+  if live_index is None:
+    live_index = index_rrsets(live_config)
+  apex = _zone_apex(live_config) if zone_id is None and complete else None
+
+  def in_zone(target):
+    if zone_id is not None:
+      return target[0] == zone_id
+    return apex is not None and (target[1] == apex or target[1].endswith('.' + apex))
+
+  def alias_key(rrset):
+    target = alias_target(rrset)
+    if target is not None and in_zone(target):
+      return (target[1], rrset.type)
+    return None
+
+  changes = [change for batch in batches for change in batch]
+  types_at = {}
+  aliases_to = {}
+  if complete:
+    # Scan the zone once for what the checks need: the types at every name
+    # changed or aliased, and the aliases to anything deleted.
+    watched = set(rrset.name for _, rrset in changes)
+    watched.update(target[1] for target in (alias_target(rrset) for _, rrset in changes) if target)
+    deleted = set((rrset.name, rrset.type) for action, rrset in changes if action == 'DELETE')
+    for rrset in live_config:
+      if rrset.name in watched:
+        types_at.setdefault(rrset.name, collections.Counter())[rrset.type] += 1
+      if rrset.extra and deleted:
+        key = alias_key(rrset)
+        if key in deleted:
+          aliases_to.setdefault(key, set()).add(rrset.key)
+  errors = []
+  state = {}
+  for n, batch in enumerate(batches):
+    prefix = 'batch %d/%d: ' % (n + 1, len(batches)) if len(batches) > 1 else ''
+    for action, rrset in batch:
+      current = state[rrset.key] if rrset.key in state else live_index.get(rrset.key)
+      if action == 'CREATE' and current is not None:
+        errors.append('%sCREATE of %s %s, which already exists' % (prefix, rrset.name, rrset.type))
+      elif action == 'DELETE' and current is None:
+        errors.append('%sDELETE of %s %s, which does not exist' % (prefix, rrset.name, rrset.type))
+      elif action == 'DELETE' and current != rrset:
+        errors.append('%sDELETE of %s %s does not match its current values' % (prefix, rrset.name, rrset.type))
+      new = None if action == 'DELETE' else rrset
+      state[rrset.key] = new
+      if not complete:
+        continue
+      for old, count in ((current, -1), (new, 1)):
+        if old is None:
+          continue
+        types_at.setdefault(old.name, collections.Counter())[old.type] += count
+        key = alias_key(old)
+        if key is not None:
+          aliases = aliases_to.setdefault(key, set())
+          if count > 0:
+            aliases.add(old.key)
+          else:
+            aliases.discard(old.key)
+    if not complete:
+      continue
+    for name in set(rrset.name for _, rrset in batch):
+      types = [rtype for rtype, count in types_at.get(name, {}).items() if count > 0]
+      if 'CNAME' in types and len(types) > 1:
+        errors.append('%s%s would have a CNAME alongside %s' % (
+            prefix, name, ', '.join(sorted(t for t in types if t != 'CNAME'))))
+    for action, rrset in batch:
+      if action != 'DELETE':
+        key = alias_key(rrset)
+        if key is not None and not types_at.get(key[0], {}).get(key[1]):
+          errors.append('%salias %s %s points at %s %s, which would not exist' % (
+              prefix, rrset.name, rrset.type, key[0], key[1]))
+      elif not types_at.get(rrset.name, {}).get(rrset.type) and aliases_to.get((rrset.name, rrset.type)):
+        errors.append('%sDELETE of %s %s, which %s still alias' % (
+            prefix, rrset.name, rrset.type,
+            ', '.join(sorted(key[0] for key in aliases_to[(rrset.name, rrset.type)]))))
   return errors
 
+def plan_change_batches(changes):
+  """Split changes into the fewest requests that each fit within Amazon's
+  limits.
+
+  Changes touching the same Name (eg. the DELETE and CREATE that replace an A
+  record with a CNAME) are kept together in one batch so they apply
+  atomically. Batches are filled greedily in order, which is optimal when
+  the order of the changes has to be preserved. A group of changes too large
+  for any batch gets a batch of its own, which validate_changes will then
+  reject.
+
+  Args: changes: [ (action, RRSet) ]
+  Returns: [ [ (action, RRSet) ] ]"""
+  groups = []
+  by_name = {}
+  for change in changes:
+    name = change[1].name
+    if name not in by_name:
+      by_name[name] = []
+      groups.append(by_name[name])
+    by_name[name].append(change)
+  batches = []
+  current = []
+  totals = (0, 0, 0)
+  for group in groups:
+    size = [len(group), 0, 0]
+    for change in group:
+      change_rrs, change_chars = change_size(change)
+      size[1] += change_rrs
+      size[2] += change_chars
+    new_totals = (totals[0] + size[0], totals[1] + size[1], totals[2] + size[2])
+    if current and (new_totals[0] > MAX_CHANGES or new_totals[1] > MAX_RRS or
+                    new_totals[2] > MAX_VALUE_CHARS):
+      batches.append(current)
+      current = []
+      new_totals = tuple(size)
+    current.extend(group)
+    totals = new_totals
+  if current:
+    batches.append(current)
+  return batches
+
+def batch_comment(comment, i, num_batches):
+  """Label the comment of batch i (counting from 0) of a split changeset."""
+  if num_batches == 1:
+    return comment
+  return '%s (batch %d/%d)' % (comment, i + 1, num_batches)
+
+def plan_batches(changeset):
+  """Split a changeset into the fewest ChangeResourceRecordSetsRequests that
+  each fit within Amazon's limits. See plan_change_batches.
+
+  Args: changeset: lxml.etree.Element (<ChangeResourceRecordSetsRequest>)
+  Returns: [ lxml.etree.Element (<ChangeResourceRecordSetsRequest>) ]"""
+  batches = plan_change_batches(changes_from_xml(changeset))
+  if len(batches) == 1:
+    return [changeset]
+  comment = changeset.findtext('.//{%s}Comment' % R53_XMLNS)
+  return [changes_to_xml(batch, batch_comment(comment, i, len(batches)))
+          for i, batch in enumerate(batches)]
+
+def submit_batches(conn, zone, batches, comment=None):
+  """Submit planned batches back to back without waiting for each to sync.
+
+  Args: conn: boto.route53.Route53Connection
+        zone: string, hosted zone id.
+        batches: [ [ (action, RRSet) ] ], eg. from plan_change_batches.
+        comment: string, defaults to default_comment().
+  Returns: [ change IDs ] eg. ['C2H851FU66F9RY']"""
+  if comment is None:
+    comment = default_comment()
+  change_ids = []
+  for i, batch in enumerate(batches):
+    body = lxml.etree.tostring(changes_to_xml(batch, batch_comment(comment, i, len(batches))))
+    resp = conn.change_rrsets(zone, body)
+    STATS.count(batches=1, changes=len(batch))
+    change_id = resp['ChangeResourceRecordSetsResponse']['ChangeInfo']['Id'].replace('/change/', '')
+    log.info('submitted batch %d/%d as change %s' % (i + 1, len(batches), change_id))
+    change_ids.append(change_id)
+  return change_ids
+
+ChangeWait = collections.namedtuple('ChangeWait', 'change_id status latency polls')
+
+def wait_for_changes(conn, change_ids, timeout=600, start=None, delay=1.0, max_delay=30, workers=32):
+  """Poll GetChange for many changes at once until all are INSYNC or the
+  timeout passes.
+
+  Each change backs off on its own: it is polled delay seconds after the
+  last poll at first, half as long again every time it is still PENDING up
+  to max_delay, with jitter so the polls spread out, and once more right at
+  the deadline.
+
+  Args: conn: boto.route53.Route53Connection
+        change_ids: [ change IDs ], eg. from submit_batches.
+        timeout: seconds to wait in all.
+        start: time.time() when the changes were submitted, which latency
+          is measured from; defaults to now.
+        delay, max_delay: seconds between polls of a change.
+        workers: int, maximum changes polled concurrently.
+  Returns: [ ChangeWait ] in the order of change_ids. Status is INSYNC,
+           PENDING if the timeout passed first, or the error code (else
+           HTTP status) polling failed with, or ConnectionError; latency
+           is None unless the change is INSYNC."""
+  if start is None:
+    start = time.time()
+  deadline = time.time() + timeout
+  from boto.exception import BotoServerError
+
+  def wait(change_id):
+    gap = delay
+    polls = 0
+    while True:
+      polls += 1
+      STATS.count(polls=1)
+      try:
+        info = conn.get_change(change_id)['GetChangeResponse']['ChangeInfo']
+      except BotoServerError as e:
+        log.error('cannot poll change %s: %s' % (change_id, e))
+        return ChangeWait(change_id, e.error_code or str(e.status), None, polls)
+      except (socket.error, httplib.HTTPException) as e:
+        log.error('cannot poll change %s: %r' % (change_id, e))
+        return ChangeWait(change_id, 'ConnectionError', None, polls)
+      now = time.time()
+      if info['Status'] == 'INSYNC':
+        log.debug('change %s is INSYNC after %.1fs' % (change_id, now - start))
+        return ChangeWait(change_id, 'INSYNC', now - start, polls)
+      if now >= deadline:
+        return ChangeWait(change_id, info['Status'], None, polls)
+      time.sleep(min(gap * random.uniform(0.5, 1), deadline - now))
+      gap = min(max_delay, gap * 1.5)
+
+  return run_parallel(wait, change_ids, workers)
+
+def print_wait_summary(waits):
+  """Print how long changes took to propagate, and which did not.
+
+  Args: waits: [ ChangeWait ], from wait_for_changes.
+  Returns: True if every change is INSYNC."""
+  latencies = sorted(w.latency for w in waits if w.status == 'INSYNC')
+  if latencies:
+    print '%d/%d changes INSYNC after %.1fs (min %.1fs, median %.1fs), %d polls' % (
+        len(latencies), len(waits), latencies[-1], latencies[0], latencies[len(latencies) // 2],
+        sum(w.polls for w in waits))
+  for w in waits:
+    if w.status != 'INSYNC':
+      print 'change %s: %s' % (w.change_id, w.status)
+  return len(latencies) == len(waits)
+
 def normalize_xml(xml):
   """Normalize an XML object. Right now this only strips whitespace.
 
+  RRSet.from_element strips whitespace itself; this is kept for callers
+  working on raw trees.
+
   Args: xml: lxml.tree.Element. Mutated by this function."""
-  XSLT_STRIPSPACE(xml)
+  strip_space(xml)
+
+class Tee(object):
+  """File-like object that writes to several files at once."""
+
+  def __init__(self, *files):
+    self.files = files
+
+  def write(self, data):
+    for f in self.files:
+      f.write(data)
+
+def _snapshot_apex(path):
+  """Returns: the name of the SOA in a snapshot, or None."""
+  with gzip.open(path, 'rb') as f:
+    for rrset in iter_parse_rrsets(f):
+      if rrset.type == 'SOA':
+        return rrset.name
+  return None
+
+def snapshot_zone_id(store, zone, cache=None):
+  """Find the ID of a zone in the snapshot store without asking Route 53:
+  from the zone ID cache, however old the entry, or else by looking for
+  the zone's SOA in the newest snapshot of each zone stored.
+
+  Args: store: snapshot.SnapshotStore
+        zone: string eg. foursquare.com
+        cache: optional ZoneCache.
+  Returns: zone ID eg. ZE2DYFZDWGSL4.
+  Raises: ZoneNotFoundError if there is no snapshot of the zone."""
+  if cache is not None:
+    zone_id = cache.get(zone, stale=True)
+    if zone_id is not None and store.latest(zone_id) is not None:
+      return zone_id
+  apex = canonical_name(zone)
+  for zone_id in store.zone_ids():
+    latest = store.latest(zone_id)
+    if latest is not None and _snapshot_apex(latest[1]) == apex:
+      return zone_id
+  raise ZoneNotFoundError('no snapshot of zone %s in %s; pull it first' % (zone.rstrip('.'), store.path))
+
+def use_snapshot(store, zone_id, max_age=0):
+  """Decide whether a zone's newest snapshot is fresh enough to stand in for
+  its live state.
+
+  Args: store: snapshot.SnapshotStore or None.
+        zone_id: string, hosted zone id.
+        max_age: seconds a snapshot may be old; 0 always refetches.
+  Returns: bool"""
+  if store is None or not max_age:
+    return False
+  age = store.age(zone_id)
+  if age is None or age > max_age:
+    return False
+  log.info('using snapshot of zone %s taken %ds ago' % (zone_id, age))
+  return True
+
+def save_snapshot(store, zone_id, rrsets):
+  """Snapshot a zone's config.
+
+  Args: store: snapshot.SnapshotStore
+        zone_id: string, hosted zone id.
+        rrsets: iterable of RRSet."""
+  with store.open(zone_id) as snap:
+    write_rrsets((rrset.to_element() for rrset in rrsets), snap)
+
+def get_live_config(conn, zone_id, store=None, max_age=0, shards=1):
+  """Get a zone's current config, from a fresh snapshot if there is one and
+  from Route 53 otherwise. Configs fetched from Route 53 are snapshotted.
+
+  Args: conn: boto.route53.Route53Connection
+        zone_id: string, hosted zone id.
+        store: optional snapshot.SnapshotStore.
+        max_age: seconds a snapshot may be old; 0 always refetches.
+        shards: list the zone in this many stretches at once; see
+          fetch_rrsets_sharded. Shards are split evenly by the latest
+          snapshot, however old, or else by probing the zone.
+  Returns: [ RRSet ]"""
+  if use_snapshot(store, zone_id, max_age):
+    return rrsets_from_xml(store.load(zone_id))
+  if shards > 1:
+    if store is not None and store.latest(zone_id) is not None:
+      boundaries = shard_boundaries(rrsets_from_xml(store.load(zone_id)), shards)
+    else:
+      boundaries = probe_boundaries(zone_id, conn, shards)
+    live_config = fetch_rrsets_sharded(zone_id, conn, boundaries, shards)
+  else:
+    live_config = fetch_rrsets(zone_id, conn)
+  if store is not None:
+    save_snapshot(store, zone_id, live_config)
+  return live_config
+
+def plan_push(live_config, new_config, zone_id=None, complete=True, processes=1):
+  """Work out how to push new_config to a zone currently holding live_config.
+
+  Changes are ordered by order_changes, and the batches checked against
+  live_config by preflight as well as against the API limits.
+
+  Args: live_config, new_config: [ RRSet ]
+        zone_id, complete: see preflight.
+        processes: see diff_rrsets.
+  Returns: (changes, batches, errors): the changes to make, the same changes
+           split into requests, and validation errors."""
+  changes = diff_rrsets(live_config, new_config, processes)
+  if not changes:
+    return [], [], []
+  live_index = index_rrsets(live_config)
+  changes = order_changes(changes, live_index)
+  batches = plan_change_batches(changes)
+  errs = []
+  for batch in batches:
+    errs.extend(validate_changes(batch))
+  errs.extend(preflight(live_config, batches, zone_id, live_index, complete))
+  return changes, batches, errs
+
+def check_config(config):
+  """Check a config without asking Route 53: plan pushing it to an empty
+  zone, which checks every record set against the API limits and the
+  config as a whole for duplicates and CNAMEs sharing their names.
+
+  Args: config: [ RRSet ]
+  Returns: [ errors ] list of error strings or []."""
+  return plan_push([], config)[2]
+
+SyncResult = collections.namedtuple('SyncResult', 'zone changes change_ids errors')
+
+def read_manifest(path):
+  """Read a manifest of zones to sync.
+
+  Each non-blank line holds a zone name and the file to push to it, separated
+  by whitespace; # starts a comment. Relative paths are taken relative to the
+  manifest itself.
+
+  Args: path: string, path to the manifest.
+  Returns: [ (zone, file) ]"""
+  entries = []
+  base = os.path.dirname(os.path.abspath(path))
+  with open(path) as f:
+    for line in f:
+      line = line.split('#', 1)[0].strip()
+      if not line:
+        continue
+      zone, filename = line.split(None, 1)
+      entries.append((zone, os.path.join(base, filename)))
+  return entries
+
+def sync_zone(conn, zones, zone, filename, dryrun=False, cache=None, store=None, max_age=0):
+  """Push one zone of a manifest, recording rather than raising failures.
+
+  Args: conn: boto.route53.Route53Connection
+        zones: result of list_zones.
+        zone: string eg. foursquare.com
+        filename: string, config to push.
+        dryrun: bool, plan and validate only.
+        cache: optional ZoneCache.
+        store, max_age: see get_live_config.
+  Returns: SyncResult"""
+  try:
+    zone_id = lookup_zone(conn, zone, zones, cache)
+    new_config = read_config(filename, origin=zone)
+    live_config = get_live_config(conn, zone_id, store, max_age)
+    changes, batches, errs = plan_push(live_config, new_config, zone_id)
+    if not changes:
+      return SyncResult(zone, 0, [], [])
+    if log.isEnabledFor(logging.DEBUG):
+      log.debug('changeset for %s:\n%s' % (
+          zone, lxml.etree.tostring(changes_to_xml(changes, 'r53 sync'), pretty_print=True)))
+    if errs or dryrun:
+      return SyncResult(zone, len(changes), [], errs)
+    change_ids = submit_batches(conn, zone_id, batches)
+    if store is not None:
+      save_snapshot(store, zone_id, new_config)
+    return SyncResult(zone, len(changes), change_ids, [])
+  except Exception as e:
+    if getattr(e, 'error_code', None) == 'NoSuchHostedZone' and cache is not None:
+      cache.invalidate(zone)
+    log.exception('syncing %s failed' % zone)
+    return SyncResult(zone, 0, [], [str(e) or e.__class__.__name__])
+
+def sync_manifest(conn, entries, workers=8, dryrun=False, cache=None, store=None, max_age=0):
+  """Sync many zones concurrently on a bounded pool of threads.
+
+  All workers share conn, so wrap it in a ThrottledConnection to keep the
+  whole run within the account's API rate limit. When more than one zone is
+  missing from cache, the account is listed once up front rather than
+  looking each zone up separately.
+
+  Args: conn: boto.route53.Route53Connection
+        entries: [ (zone, file) ], eg. from read_manifest.
+        workers: int, maximum zones in flight at once.
+        dryrun: bool, plan and validate only.
+        cache: optional ZoneCache.
+        store, max_age: see get_live_config.
+  Returns: [ SyncResult ] in manifest order."""
+  zones = None
+  missing = [zone for zone, _ in entries if cache is None or cache.get(zone) is None]
+  if len(missing) > 1:
+    zones = list_zones(conn, cache)
+
+  def sync(entry):
+    zone, filename = entry
+    log.info('syncing %s from %s' % (zone, filename))
+    return sync_zone(conn, zones, zone, filename, dryrun, cache, store, max_age)
+
+  return run_parallel(sync, entries, workers)
+
+def zone_fingerprint(rrsets):
+  """Order-independent digest of a whole config: the hex SHA-1 of its record
+  sets' sorted fingerprints, so two configs hash the same exactly when they
+  hold the same record sets.
+
+  Args: rrsets: iterable of RRSet.
+  Returns: string"""
+  return hashlib.sha1(''.join(sorted(rrset.fingerprint for rrset in rrsets))).hexdigest()
+
+AuditResult = collections.namedtuple('AuditResult',
+                                     'zone filename zone_id live_hash file_hash rrsets changes error snapshot_age')
+
+def audit_zone(conn, zones, zone, filename, cache=None, store=None, max_age=0, format=None):
+  """Compare one zone's live config with its file, recording rather than
+  raising failures. Only a zone whose hash differs from its file's is
+  diffed.
+
+  Args: see sync_zone; format: see read_config.
+  Returns: AuditResult; changes is [ (action, live RRSet or None, file
+           RRSet or None) ], in diff_rrsets order. snapshot_age is how many
+           seconds old the snapshot standing in for the live zone was, or
+           None if the zone was fetched."""
+  try:
+    zone_id = lookup_zone(conn, zone, zones, cache)
+    new_config = read_config(filename, format, zone)
+    snapshot_age = None
+    if use_snapshot(store, zone_id, max_age):
+      snapshot_age = int(store.age(zone_id))
+      live_config = rrsets_from_xml(store.load(zone_id))
+    else:
+      live_config = get_live_config(conn, zone_id, store)
+    live_hash = zone_fingerprint(live_config)
+    file_hash = zone_fingerprint(new_config)
+    changes = []
+    if live_hash != file_hash:
+      live_index = index_rrsets(live_config)
+      for action, rrset in diff_rrsets(live_config, new_config):
+        if action == 'DELETE':
+          changes.append((action, rrset, None))
+        else:
+          changes.append((action, live_index.get(rrset.key), rrset))
+      log.info('%s has drifted from %s: %d changes' % (zone, filename, len(changes)))
+    return AuditResult(zone, filename, zone_id, live_hash, file_hash, len(live_config), changes, None,
+                       snapshot_age)
+  except Exception as e:
+    log.exception('auditing %s failed' % zone)
+    return AuditResult(zone, filename, None, None, None, 0, [], str(e) or e.__class__.__name__, None)
+
+def audit_manifest(conn, entries, workers=8, cache=None, store=None, max_age=0, format=None):
+  """Audit many zones concurrently; see sync_manifest and audit_zone.
+
+  Returns: [ AuditResult ] in manifest order."""
+  zones = None
+  missing = [zone for zone, _ in entries if cache is None or cache.get(zone) is None]
+  if len(missing) > 1:
+    zones = list_zones(conn, cache)
+
+  def audit(entry):
+    zone, filename = entry
+    log.debug('auditing %s against %s' % (zone, filename))
+    return audit_zone(conn, zones, zone, filename, cache, store, max_age, format)
 
+  return run_parallel(audit, entries, workers)
+
+def audit_report(results):
+  """Build a drift report from audit results, for dumping as JSON.
+
+  Each zone's status is in_sync, drifted or error. Changes are what a push
+  of the file would do, with the record set as it is live and as it is in
+  the file. snapshot_age is set for zones whose live state came from a
+  snapshot rather than Route 53.
+
+  Args: results: [ AuditResult ]
+  Returns: dict"""
+  zones = []
+  for result in results:
+    if result.error:
+      status = 'error'
+    elif result.changes:
+      status = 'drifted'
+    else:
+      status = 'in_sync'
+    zones.append({
+        'zone': result.zone,
+        'file': result.filename,
+        'zone_id': result.zone_id,
+        'status': status,
+        'live_hash': result.live_hash,
+        'file_hash': result.file_hash,
+        'rrsets': result.rrsets,
+        'changes': [{'action': action,
+                     'live': live and live.to_dict(),
+                     'file': new and new.to_dict()}
+                    for action, live, new in result.changes],
+        'error': result.error,
+        'snapshot_age': result.snapshot_age,
+        })
+  return {
+      'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+      'zones': zones,
+      'drifted': len([z for z in zones if z['status'] == 'drifted']),
+      'errors': len([z for z in zones if z['status'] == 'error']),
+      }
+
+def print_sync_summary(results):
+  """Print one line per zone for the results of sync_manifest.
+
+  Returns: True if every zone synced cleanly."""
+  ok = True
+  for result in results:
+    if result.errors:
+      ok = False
+      print '%s: FAILED: %s' % (result.zone, '; '.join(result.errors))
+    elif result.changes == 0:
+      print '%s: no changes' % result.zone
+    elif result.change_ids:
+      print '%s: %d changes submitted as %s' % (result.zone, result.changes, ', '.join(result.change_ids))
+    else:
+      print '%s: %d changes (dry run)' % (result.zone, result.changes)
+  return ok
+
+
+def read_revision(path, rev, format=None, origin=None):
+  """Read a config as it was at a git revision.
+
+  Args: path: string, the config's path in a git checkout.
+        rev: a git revision, or 'last-push' for the one last recorded by
+          record_revision for origin.
+        format, origin: see read_config.
+  Returns: [ RRSet ], or None if rev is 'last-push' and none was recorded."""
+  import gitrev
+  if rev == 'last-push':
+    rev = gitrev.last_push(path, origin)
+    if rev is None:
+      log.warning('no push of %s recorded in git; fetching the whole zone' % origin)
+      return None
+  log.info('comparing %s with revision %s' % (path, rev))
+  return read_config(StringIO.StringIO(gitrev.show(path, rev)), format or config_format(path), origin)
+
+def record_revision(path, zone):
+  """Record HEAD as the revision of path last pushed to zone, if path has
+  no uncommitted changes."""
+  import gitrev
+  if not gitrev.is_clean(path):
+    log.warning('%s has uncommitted changes; not recording this push in git' % path)
+    return
+  log.info('recorded push of %s to %s as %s' % (path, zone, gitrev.record_push(path, zone)))
+
+def report_stats(format=None, sink=None, tags=None):
+  """Print STATS to stderr and/or send them to a metrics sink.
+
+  Args: format: 'text', 'json' or None not to print.
+        sink: see metrics.Stats.send.
+        tags: dict of tags for the sink."""
+  if format == 'json':
+    print >>sys.stderr, STATS.to_json()
+  elif format == 'text':
+    print >>sys.stderr, STATS.summary()
+  if sink:
+    try:
+      STATS.send(sink, dict((k, v) for k, v in (tags or {}).items() if v))
+    except (socket.error, ValueError) as e:
+      log.warning('could not send stats to %s: %s' % (sink, e))
 
 def main():
   parser = argparse.ArgumentParser(description='Push/pull Amazon Route 53 configs.')
   parser.add_argument('--push', metavar='file_to_push.xml', help="Push the config in this file to R53.")
+  parser.add_argument('--format', choices=CONFIG_FORMATS,
+                      help="Format of the file to push; by default guessed from its extension.")
   parser.add_argument('--pull', action='store_true', help="Dump current R53 config to stdout.")
+  parser.add_argument('--validate', nargs='+', metavar='config.xml',
+                      help="Check configs offline; exit 1 if any would not push. Bind files need --zone.")
+  parser.add_argument('--diff', nargs=2, metavar=('old.xml', 'new.xml'),
+                      help="Print the changeset turning one config or snapshot into another, offline; "
+                           "exit 1 if they differ.")
   parser.add_argument('--confirm', action='store_true', help="Do not prompt before push.")
   parser.add_argument('--dryrun', action='store_true', help="Do not actually apply changes.")
   parser.add_argument('--verbose', action='store_true')
-  parser.add_argument('--zone', required=True, metavar="foursquare.com", help="Zone to push/pull.")
+  parser.add_argument('--zone', metavar="foursquare.com", help="Zone to push/pull.")
+  parser.add_argument('--manifest', metavar='zones.txt',
+                      help="Push many zones at once: each line holds a zone and the file to push to it.")
+  parser.add_argument('--workers', type=int, default=8, help="Zones to sync concurrently with --manifest.")
+  parser.add_argument('--rate', type=float, default=5,
+                      help="Maximum API requests per second; slowed down automatically when throttled.")
+  parser.add_argument('--retries', type=int, default=8, help="Times to retry a throttled API request.")
+  parser.add_argument('--targeted', action='store_true',
+                      help="Push only what changed since the zone's latest snapshot, checking just those "
+                           "records in Route 53 instead of fetching the whole zone.")
+  parser.add_argument('--since', metavar='REV',
+                      help="Push only what changed in the file since this git revision, checking just those "
+                           "records in Route 53; 'last-push' means the revision last pushed to the zone.")
+  parser.add_argument('--low-memory', nargs='?', type=int, const=64, metavar='MB',
+                      help="Diff through sorted files on disk, holding about this many MB (default 64) of each "
+                           "side in memory; for zones bigger than memory. Takes no snapshots.")
+  parser.add_argument('--processes', type=int, default=1,
+                      help="Diff in this many processes; for zones of millions of record sets.")
+  parser.add_argument('--shards', type=int, default=1,
+                      help="Fetch a zone in this many stretches at once; for very large zones.")
+  parser.add_argument('--endpoint', metavar='localhost:8053',
+                      help="Talk plain HTTP to this stand-in for Route 53, eg. r53-fakeroute53.")
+  parser.add_argument('--zone-cache', metavar='zones.json',
+                      help="Where to cache zone IDs; by default ~/.r53/zones.json, or one file per --endpoint.")
+  parser.add_argument('--zone-cache-ttl', type=int, default=86400, help="Seconds to trust cached zone IDs.")
+  parser.add_argument('--refresh-zones', action='store_true', help="Discard cached zone IDs.")
+  parser.add_argument('--snapshots', metavar='DIR', default=os.path.expanduser('~/.r53/snapshots'),
+                      help="Where to keep snapshots of zone state; empty to disable.")
+  parser.add_argument('--max-snapshot-age', type=int, default=0, metavar='SECONDS',
+                      help="Use a snapshot instead of fetching the live zone if it is at most this old.")
+  parser.add_argument('--from-snapshot', nargs='?', const='latest', metavar='snapshot.xml.gz',
+                      help="Use a snapshot (the newest by default) instead of the live zone, however old.")
+  parser.add_argument('--list-snapshots', action='store_true', help="List the zone's snapshots.")
+  parser.add_argument('--wait', nargs='?', type=float, const=600, metavar='SECONDS',
+                      help="After pushing, wait up to this long (default 600) for the changes to reach every "
+                           "Route 53 server; exit non-zero if they do not.")
+  parser.add_argument('--audit', action='store_true',
+                      help="Compare --push with --zone (or every --manifest zone with its file) and report "
+                           "drift as JSON, changing nothing; exit 1 if any zone has drifted.")
+  parser.add_argument('--report', metavar='drift.json', default='-',
+                      help="Where --audit writes its report; stdout by default.")
+  parser.add_argument('--watch', action='store_true',
+                      help="Keep running, pushing --push (or every --manifest zone) whenever the file changes.")
+  parser.add_argument('--debounce', type=float, default=2, metavar='SECONDS',
+                      help="With --watch, push once a changed file has been left alone this long.")
+  parser.add_argument('--reconcile', type=float, default=300, metavar='SECONDS',
+                      help="With --watch, refetch each zone this often and push again if it has drifted.")
+  parser.add_argument('--stats', nargs='?', const='text', choices=('text', 'json'),
+                      help="On exit, print time, CPU and memory per phase and API counters to stderr.")
+  parser.add_argument('--stats-sink', metavar='statsd://host:port',
+                      help="Also send them to statsd, or to InfluxDB with influx://host:port.")
   args = parser.parse_args()
 
   ch = logging.StreamHandler()
@@ -206,8 +2075,138 @@ def main():
     ch.setLevel(logging.DEBUG)
   else:
     ch.setLevel(logging.INFO)
+    # So log.isEnabledFor skips building debug output no one will see.
+    log.setLevel(logging.INFO)
   log.addHandler(ch)
 
+  if args.stats or args.stats_sink:
+    atexit.register(report_stats, args.stats, args.stats_sink, {'zone': args.zone or args.manifest})
+
+  # --validate and --diff work on local files, and don't import boto.
+  if args.validate:
+    ok = True
+    for filename in args.validate:
+      try:
+        with STATS.phase('parse'):
+          config = read_config(filename, args.format, args.zone)
+        with STATS.phase('plan'):
+          errs = check_config(config)
+      except Exception as e:
+        config, errs = [], [str(e) or e.__class__.__name__]
+      if errs:
+        ok = False
+        print "%s: invalid. errors:" % filename
+        print '\n'.join(errs)
+      else:
+        print "%s: %d record sets, valid" % (filename, len(config))
+    sys.exit(0 if ok else 1)
+
+  if args.diff:
+    with STATS.phase('parse'):
+      old, new = [read_config(filename, args.format, args.zone) for filename in args.diff]
+    with STATS.phase('plan'):
+      changes = diff_rrsets(old, new, args.processes)
+    if not changes:
+      print "No changes found; exiting"
+      sys.exit(0)
+    with STATS.phase('render'):
+      print lxml.etree.tostring(changes_to_xml(order_changes(changes)), pretty_print=True)
+    sys.exit(1)
+
+  if args.from_snapshot and not args.dryrun:
+    log.info('--from-snapshot plans against a snapshot of any age; not submitting anything (--dryrun).')
+    args.dryrun = True
+  # Snapshots of a single zone are found without talking to Route 53.
+  conn = None
+  if not ((args.from_snapshot or args.list_snapshots) and args.zone and
+          not (args.manifest or args.watch or args.audit)):
+    conn = ThrottledConnection(connect(args.endpoint), RateLimiter(args.rate), args.retries)
+  if args.zone_cache is None:
+    args.zone_cache = os.path.expanduser('~/.r53/zones.json')
+    if args.endpoint:
+      args.zone_cache = os.path.expanduser('~/.r53/zones-%s.json' % args.endpoint.replace(':', '_'))
+  cache = ZoneCache(args.zone_cache, args.zone_cache_ttl)
+  if args.refresh_zones:
+    cache.invalidate()
+  store = None
+  if args.snapshots:
+    store = snapshot.SnapshotStore(args.snapshots)
+  elif args.from_snapshot or args.list_snapshots:
+    print "--from-snapshot and --list-snapshots need --snapshots."
+    sys.exit(1)
+  max_age = args.max_snapshot_age
+  if args.from_snapshot == 'latest':
+    max_age = sys.maxint
+
+  if args.watch or args.audit:
+    if args.manifest:
+      entries = read_manifest(args.manifest)
+    elif args.push and args.push != '-' and args.zone:
+      entries = [(args.zone, args.push)]
+    else:
+      print "--watch and --audit need --manifest, or --push with a file and --zone."
+      sys.exit(1)
+
+  if args.audit:
+    with STATS.phase('audit'):
+      results = audit_manifest(conn, entries, args.workers, cache, store, max_age, args.format)
+    report = audit_report(results)
+    if args.report == '-':
+      json.dump(report, sys.stdout, indent=2, sort_keys=True)
+      print
+    else:
+      with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    log.info('%d zones audited: %d drifted, %d failed' % (len(results), report['drifted'], report['errors']))
+    sys.exit(1 if report['drifted'] or report['errors'] else 0)
+
+  if args.watch:
+    if not (args.confirm or args.dryrun):
+      print "--watch cannot prompt; pass --confirm or --dryrun."
+      sys.exit(1)
+    import watch
+    daemon = watch.Daemon(conn, entries, args.debounce, args.reconcile, args.dryrun, cache, store,
+                          args.format, args.workers)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    try:
+      daemon.run()
+    except KeyboardInterrupt:
+      pass
+    sys.exit(0)
+
+  if args.manifest:
+    if not (args.confirm or args.dryrun):
+      print "--manifest cannot prompt; pass --confirm or --dryrun."
+      sys.exit(1)
+    start = time.time()
+    with STATS.phase('sync'):
+      results = sync_manifest(conn, read_manifest(args.manifest), args.workers, args.dryrun, cache,
+                              store, max_age)
+    ok = print_sync_summary(results)
+    change_ids = [change_id for result in results for change_id in result.change_ids]
+    if args.wait is not None and change_ids:
+      with STATS.phase('wait'):
+        ok = print_wait_summary(wait_for_changes(conn, change_ids, args.wait, start)) and ok
+    sys.exit(0 if ok else 1)
+
+  if args.zone is None:
+    print "You must specify --zone."
+    sys.exit(1)
+
+  if args.list_snapshots or args.from_snapshot:
+    try:
+      zone_id = snapshot_zone_id(store, args.zone, cache)
+    except ZoneNotFoundError as e:
+      print e
+      sys.exit(1)
+
+  if args.list_snapshots:
+    for stamp, path in store.list(zone_id):
+      print '%s  %8d bytes  %s' % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(stamp)),
+                                   os.path.getsize(path), path)
+    sys.exit(0)
+
   if args.push == args.pull:
     print "You must specify either --push or --pull."
     sys.exit(1)
@@ -215,31 +2214,93 @@ def main():
   # confirm wants stdin to itself
   if args.push == '-':
     args.confirm = True
+    if args.since:
+      print "--since needs the file to push to be in git, not on stdin."
+      sys.exit(1)
 
-  conn = Route53Connection()
-
-  log.info('looking up zone for %s' % args.zone)
-  zone_id = lookup_zone(conn, args.zone)
-  log.info('fetching live config for zone %s' % zone_id)
-  live_config = merge_config(fetch_config(zone_id, conn))
+  if not args.from_snapshot:
+    log.info('looking up zone for %s' % args.zone)
+    with STATS.phase('lookup_zone'):
+      zone_id = lookup_zone(conn, args.zone, cache=cache)
+  if args.from_snapshot not in (None, 'latest'):
+    with STATS.phase('load_snapshot'):
+      live_config = rrsets_from_xml(store.load(zone_id, args.from_snapshot))
+  elif use_snapshot(store, zone_id, max_age):
+    with STATS.phase('load_snapshot'):
+      live_config = rrsets_from_xml(store.load(zone_id))
+  else:
+    live_config = None
+    log.info('fetching live config for zone %s' % zone_id)
 
-  if args.pull:
-    print lxml.etree.tostring(live_config, pretty_print=True)
+  try:
+    if args.pull:
+      with STATS.phase('fetch'):
+        if live_config is None and args.shards > 1:
+          live_config = get_live_config(conn, zone_id, store, shards=args.shards)
+        if live_config is not None:
+          write_rrsets((rrset.to_element() for rrset in live_config), sys.stdout)
+        elif store is not None:
+          with store.open(zone_id) as snap:
+            write_rrsets(iter_rrsets(zone_id, conn), Tee(sys.stdout, snap))
+        else:
+          write_rrsets(iter_rrsets(zone_id, conn), sys.stdout)
+    if args.push:
+      if args.push == '-':
+          args.push = sys.stdin
+      if args.low_memory and live_config is None:
+        import extsort
+        log.info('diffing zone %s through sorted runs on disk' % zone_id)
+        with STATS.phase('plan'):
+          changes, batches, errs = extsort.plan_push(
+              (RRSet.from_element(elem) for elem in iter_rrsets(zone_id, conn)),
+              iter_config(args.push, args.format, args.zone), zone_id, args.low_memory << 20)
+        # Snapshotting would take a second pass over the new config.
+        store = None
+      else:
+        with STATS.phase('parse'):
+          new_config = read_config(args.push, args.format, args.zone)
+        base_config = None
+        if args.since and live_config is None:
+          base_config = read_revision(args.push, args.since, args.format, args.zone)
+        elif args.targeted and live_config is None:
+          if store is not None and store.latest(zone_id) is not None:
+            base_config = rrsets_from_xml(store.load(zone_id))
+          else:
+            log.warning('no snapshot of zone %s to compare with; fetching all of it' % zone_id)
+        if base_config is not None:
+          with STATS.phase('plan'):
+            keys = touched_keys(base_config, new_config)
+            log.info('checking %d changed names and types in zone %s' % (len(keys), zone_id))
+            changes, batches, errs = plan_targeted_push(conn, zone_id, new_config, keys)
+          # Only those were checked against the zone, so new_config is no
+          # snapshot of the rest of it.
+          store = None
+        else:
+          if live_config is None:
+            with STATS.phase('fetch'):
+              live_config = get_live_config(conn, zone_id, store, shards=args.shards)
+          with STATS.phase('plan'):
+            changes, batches, errs = plan_push(live_config, new_config, zone_id, processes=args.processes)
+  except Exception as e:
+    if getattr(e, 'error_code', None) != 'NoSuchHostedZone':
+      raise
+    cache.invalidate(args.zone)
+    print "Zone %s no longer exists; forgot its cached ID, rerun to look it up again." % zone_id
+    sys.exit(1)
 
   if args.push:
-    if args.push == '-':
-        args.push = sys.stdin
-    new_config = lxml.etree.parse(args.push)
-    normalize_xml(live_config)
-    normalize_xml(new_config.getroot())
-    changeset = generate_changeset(live_config, new_config.getroot())
-    if changeset is None:
+    if not changes:
         print "No changes found; exiting"
+        if args.since and not args.dryrun:
+          record_revision(args.push, args.zone)
         sys.exit(0)
-    changesetstr = lxml.etree.tostring(changeset, pretty_print=True)
+    comment = default_comment()
+    with STATS.phase('render'):
+      changesetstr = lxml.etree.tostring(changes_to_xml(changes, comment), pretty_print=True)
     print "==CHANGESET=="
     print changesetstr
-    errs = validate_changeset(changeset)
+    if len(batches) > 1:
+      print "changeset will be submitted in %d batches" % len(batches)
     if len(errs) > 0:
       print "changeset invalid. errors:"
       print '\n'.join(errs)
@@ -254,7 +2315,22 @@ def main():
       print "Dry run mode: exiting without applying changes"
       sys.exit(0)
     else:
-      conn.change_rrsets(zone_id, changesetstr)
+      start = time.time()
+      with STATS.phase('submit'):
+        change_ids = submit_batches(conn, zone_id, batches, comment)
+      if store is not None:
+        with STATS.phase('snapshot'):
+          save_snapshot(store, zone_id, new_config)
+      if args.since:
+        record_revision(args.push, args.zone)
+      if args.wait is not None:
+        with STATS.phase('wait'):
+          waits = wait_for_changes(conn, change_ids, args.wait, start)
+        if not print_wait_summary(waits):
+          sys.exit(1)
 
 if __name__ == '__main__':
+    # zonefile, extsort, watch and the rest import r53 back. Make that this
+    # module, not a second copy with its own RRSet class and STATS.
+    sys.modules.setdefault(__package__ + '.r53' if __package__ else 'r53', sys.modules[__name__])
     main()
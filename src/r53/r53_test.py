@@ -1,9 +1,20 @@
 import lxml.etree
 import mox
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 import StringIO
+from boto.exception import BotoServerError
 from boto.route53 import Route53Connection
+from boto.route53.exception import DNSServerError
+import bench
 import r53
+import snapshot
 
 class Route53Test(unittest.TestCase):
   """Tests for functions in r53.py."""
@@ -103,6 +114,185 @@ class Route53Test(unittest.TestCase):
     self.assertEqual([lxml.etree.tostring(x.getroot()) for x in chunks], [lxml.etree.tostring(x) for x in expected_output])
     mox.Verify(self.r53mock)
 
+  def test_list_zones(self):
+    first_resp = StringIO.StringIO('''<?xml version="1.0" encoding="UTF-8"?>
+<ListHostedZonesResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+   <HostedZones>
+      <HostedZone>
+         <Id>/hostedzone/AAAA</Id>
+         <Name>example.com.</Name>
+      </HostedZone>
+   </HostedZones>
+   <Marker/>
+   <IsTruncated>true</IsTruncated>
+   <NextMarker>BBBB</NextMarker>
+   <MaxItems>1</MaxItems>
+</ListHostedZonesResponse>''')
+    second_resp = StringIO.StringIO('''<?xml version="1.0" encoding="UTF-8"?>
+<ListHostedZonesResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+   <HostedZones>
+      <HostedZone>
+         <Id>/hostedzone/BBBB</Id>
+         <Name>example.org.</Name>
+      </HostedZone>
+   </HostedZones>
+   <Marker>BBBB</Marker>
+   <IsTruncated>false</IsTruncated>
+   <MaxItems>1</MaxItems>
+</ListHostedZonesResponse>''')
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzone').AndReturn(first_resp)
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzone?marker=BBBB').AndReturn(second_resp)
+    mox.Replay(self.r53mock)
+    self.assertEqual(r53.list_zones(self.r53mock), {'example.com': 'AAAA', 'example.org': 'BBBB'})
+    mox.Verify(self.r53mock)
+
+  def test_lookup_zone_cache(self):
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    cache = r53.ZoneCache(os.path.join(tmpdir, 'zones.json'))
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzonesbyname?dnsname=example.com.&maxitems=1').AndReturn(
+        StringIO.StringIO('''<?xml version="1.0" encoding="UTF-8"?>
+<ListHostedZonesByNameResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+   <HostedZones>
+      <HostedZone>
+         <Id>/hostedzone/AAAA</Id>
+         <Name>example.com.</Name>
+      </HostedZone>
+   </HostedZones>
+   <DNSName>example.com.</DNSName>
+   <IsTruncated>true</IsTruncated>
+   <NextDNSName>example.org.</NextDNSName>
+   <MaxItems>1</MaxItems>
+</ListHostedZonesByNameResponse>'''))
+    mox.Replay(self.r53mock)
+    self.assertEqual(r53.lookup_zone(self.r53mock, 'example.com', cache=cache), 'AAAA')
+    mox.Verify(self.r53mock)
+    # served from the file written by the first lookup, without API calls
+    cache = r53.ZoneCache(os.path.join(tmpdir, 'zones.json'))
+    self.assertEqual(r53.lookup_zone(self.r53mock, 'example.com.', cache=cache), 'AAAA')
+    cache.invalidate('example.com')
+    self.assertEqual(cache.get('example.com'), None)
+
+  def test_iter_rrsets(self):
+    first_resp = StringIO.StringIO('''<?xml version="1.0" encoding="UTF-8"?>
+<ListResourceRecordSetsResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+   <ResourceRecordSets>
+      <ResourceRecordSet>
+         <Name>example.com.</Name>
+         <Type>SOA</Type>
+         <TTL>900</TTL>
+         <ResourceRecords>
+            <ResourceRecord>
+               <Value>ns-2048.awsdns-64.net. hostmaster.awsdns.com. 1 7200 900 1209600 86400</Value>
+            </ResourceRecord>
+         </ResourceRecords>
+      </ResourceRecordSet>
+   </ResourceRecordSets>
+   <IsTruncated>true</IsTruncated>
+   <MaxItems>1</MaxItems>
+   <NextRecordName>testdoc2.example.com</NextRecordName>
+   <NextRecordType>NS</NextRecordType>
+</ListResourceRecordSetsResponse>''')
+    second_resp = StringIO.StringIO('''<?xml version="1.0" encoding="UTF-8"?>
+<ListResourceRecordSetsResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+   <ResourceRecordSets>
+      <ResourceRecordSet>
+         <Name>testdoc2.example.com.</Name>
+         <Type>NS</Type>
+         <TTL>60</TTL>
+         <ResourceRecords>
+            <ResourceRecord>
+               <Value>ns1.example.com.</Value>
+            </ResourceRecord>
+         </ResourceRecords>
+      </ResourceRecordSet>
+   </ResourceRecordSets>
+   <IsTruncated>false</IsTruncated>
+   <MaxItems>1</MaxItems>
+</ListResourceRecordSetsResponse>''')
+    expected_output = '''<ResourceRecordSets xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+  <ResourceRecordSet>
+    <Name>example.com.</Name>
+    <Type>SOA</Type>
+    <TTL>900</TTL>
+    <ResourceRecords>
+      <ResourceRecord>
+        <Value>ns-2048.awsdns-64.net. hostmaster.awsdns.com. 1 7200 900 1209600 86400</Value>
+      </ResourceRecord>
+    </ResourceRecords>
+  </ResourceRecordSet>
+  <ResourceRecordSet>
+    <Name>testdoc2.example.com.</Name>
+    <Type>NS</Type>
+    <TTL>60</TTL>
+    <ResourceRecords>
+      <ResourceRecord>
+        <Value>ns1.example.com.</Value>
+      </ResourceRecord>
+    </ResourceRecords>
+  </ResourceRecordSet>
+</ResourceRecordSets>
+'''
+    zone = 'AAAA'
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzone/%s/rrset' % zone).AndReturn(first_resp)
+    self.r53mock.make_request('GET',
+      '/2013-04-01/hostedzone/%s/rrset?name=testdoc2.example.com&type=NS' % zone).AndReturn(second_resp)
+    mox.Replay(self.r53mock)
+    out = StringIO.StringIO()
+    r53.write_rrsets(r53.iter_rrsets(zone, self.r53mock), out)
+    self.assertEqual(out.getvalue(), expected_output)
+    mox.Verify(self.r53mock)
+
+  def test_iter_rrsets_resume(self):
+    page = '''<?xml version="1.0" encoding="UTF-8"?>
+<ListResourceRecordSetsResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+   <ResourceRecordSets>%s</ResourceRecordSets>
+   <IsTruncated>false</IsTruncated>
+   <MaxItems>100</MaxItems>
+</ListResourceRecordSetsResponse>'''
+    rrsets = [r53.RRSet('host%d.example.com.' % i, 'A', ttl='60', values=['192.168.0.%d' % i]) for i in range(3)]
+    elems = [lxml.etree.tostring(rrset.to_element()) for rrset in rrsets]
+    broken = page % ''.join(elems)
+    broken = broken[:broken.index('host2')]
+    zone = 'AAAA'
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzone/%s/rrset' % zone).AndReturn(
+        StringIO.StringIO(broken))
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzone/%s/rrset?name=host1.example.com.&type=A' % zone
+                              ).AndReturn(StringIO.StringIO(page % ''.join(elems[1:])))
+    mox.Replay(self.r53mock)
+    self.assertEqual(r53.fetch_rrsets(zone, self.r53mock), rrsets)
+    mox.Verify(self.r53mock)
+
+  def test_throttled_connection(self):
+    throttled = DNSServerError(400, 'Bad Request', '''<?xml version="1.0"?>
+<ErrorResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+  <Error><Type>Sender</Type><Code>Throttling</Code><Message>Rate exceeded</Message></Error>
+</ErrorResponse>''')
+    invalid = DNSServerError(400, 'Bad Request', '''<?xml version="1.0"?>
+<ErrorResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+  <Error><Type>Sender</Type><Code>InvalidInput</Code><Message>No</Message></Error>
+</ErrorResponse>''')
+    self.r53mock.make_request('GET', '/a').AndRaise(throttled)
+    self.r53mock.make_request('GET', '/a').AndRaise(throttled)
+    self.r53mock.make_request('GET', '/a').AndReturn('ok')
+    self.r53mock.make_request('GET', '/b').AndRaise(invalid)
+    self.r53mock.make_request('GET', '/c').AndRaise(throttled)
+    self.r53mock.make_request('GET', '/c').AndRaise(throttled)
+    self.r53mock.make_request('GET', '/d').AndRaise(BotoServerError(503, 'Service Unavailable', ''))
+    self.r53mock.make_request('GET', '/d').AndReturn('ok')
+    mox.Replay(self.r53mock)
+    limiter = r53.RateLimiter(100)
+    conn = r53.ThrottledConnection(self.r53mock, limiter, retries=2, base_delay=0.001)
+    self.assertEqual(self.r53mock.num_retries, 0)
+    self.assertEqual(conn.make_request('GET', '/a'), 'ok')
+    # Both throttles came within a second, so the rate was only halved once.
+    self.assertTrue(50 < limiter.rate < 51)
+    self.assertRaises(DNSServerError, conn.make_request, 'GET', '/b')
+    conn.retries = 1
+    self.assertRaises(DNSServerError, conn.make_request, 'GET', '/c')
+    self.assertEqual(conn.make_request('GET', '/d'), 'ok')
+    mox.Verify(self.r53mock)
+
   def test_changeset_replace(self):
     old = lxml.etree.XML('''<ResourceRecordSets xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
       <ResourceRecordSet>
@@ -344,6 +534,400 @@ class Route53Test(unittest.TestCase):
    </ResourceRecordSets>''', parser=parser)
     self.assertEqual(r53.generate_changeset(old, new), None)
 
+  def test_changeset_upsert(self):
+    parser = lxml.etree.XMLParser(remove_blank_text=True)
+    old = lxml.etree.XML('''<ResourceRecordSets xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+      <ResourceRecordSet>
+         <Name>example.com.</Name>
+         <Type>A</Type>
+         <TTL>60</TTL>
+         <ResourceRecords>
+            <ResourceRecord>
+               <Value>192.168.0.1</Value>
+            </ResourceRecord>
+         </ResourceRecords>
+      </ResourceRecordSet>
+   </ResourceRecordSets>''', parser=parser)
+    new = lxml.etree.XML('''<ResourceRecordSets xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+      <ResourceRecordSet>
+         <Name>example.com.</Name>
+         <Type>A</Type>
+         <TTL>300</TTL>
+         <ResourceRecords>
+            <ResourceRecord>
+               <Value>192.168.0.1</Value>
+            </ResourceRecord>
+         </ResourceRecords>
+      </ResourceRecordSet>
+   </ResourceRecordSets>''', parser=parser)
+    expected_output = lxml.etree.XML(
+        '''<ChangeResourceRecordSetsRequest xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+          <ChangeBatch>
+            <Comment>foobar</Comment>
+            <Changes>
+              <Change>
+                <Action>UPSERT</Action>
+                <ResourceRecordSet>
+                  <Name>example.com.</Name>
+                  <Type>A</Type>
+                  <TTL>300</TTL>
+                  <ResourceRecords>
+                    <ResourceRecord>
+                      <Value>192.168.0.1</Value>
+                    </ResourceRecord>
+                  </ResourceRecords>
+                </ResourceRecordSet>
+              </Change>
+            </Changes>
+          </ChangeBatch>
+        </ChangeResourceRecordSetsRequest>''', parser=parser)
+    changeset = r53.generate_changeset(old, new, comment='foobar')
+    self.assertEqual(lxml.etree.tostring(changeset), lxml.etree.tostring(expected_output))
+
+  def test_validate_changeset_upsert_counts_twice(self):
+    changes = ''.join('''<Change><Action>UPSERT</Action><ResourceRecordSet>
+        <Name>host%d.example.com.</Name><Type>TXT</Type><TTL>60</TTL>
+        <ResourceRecords><ResourceRecord><Value>%s</Value></ResourceRecord></ResourceRecords>
+        </ResourceRecordSet></Change>''' % (i, 'x' * 100) for i in range(60))
+    changeset = lxml.etree.XML('''<ChangeResourceRecordSetsRequest xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+        <ChangeBatch><Changes>%s</Changes></ChangeBatch></ChangeResourceRecordSetsRequest>''' % changes)
+    self.assertEqual(r53.validate_changeset(changeset),
+                     ['changeset has 12000 chars in <Value> text: max is 10000'])
+
+  def test_plan_batches(self):
+    changes = []
+    for i in range(150):
+      changes.append('''<Change><Action>DELETE</Action><ResourceRecordSet>
+        <Name>host%d.example.com.</Name><Type>A</Type><TTL>60</TTL>
+        <ResourceRecords><ResourceRecord><Value>192.168.0.1</Value></ResourceRecord></ResourceRecords>
+        </ResourceRecordSet></Change>''' % i)
+    # replacing host99's A record with a CNAME must not straddle two batches
+    changes.append('''<Change><Action>CREATE</Action><ResourceRecordSet>
+        <Name>host99.example.com.</Name><Type>CNAME</Type><TTL>60</TTL>
+        <ResourceRecords><ResourceRecord><Value>example.com.</Value></ResourceRecord></ResourceRecords>
+        </ResourceRecordSet></Change>''')
+    changeset = lxml.etree.XML('''<ChangeResourceRecordSetsRequest xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+        <ChangeBatch><Comment>foobar</Comment><Changes>%s</Changes></ChangeBatch>
+        </ChangeResourceRecordSetsRequest>''' % ''.join(changes))
+    batches = r53.plan_batches(changeset)
+    self.assertEqual([len(b.findall('.//{%s}Change' % r53.R53_XMLNS)) for b in batches], [99, 52])
+    self.assertEqual([b.findtext('.//{%s}Comment' % r53.R53_XMLNS) for b in batches],
+                     ['foobar (batch 1/2)', 'foobar (batch 2/2)'])
+    for batch in batches:
+      self.assertEqual(r53.validate_changeset(batch), [])
+
+  def test_diff_rrsets_sharded(self):
+    old = bench.generate_zone(2000)
+    new = bench.mutate(old, 0.05)
+    changes = r53.diff_rrsets(old, new)
+    self.assertEqual(set(action for action, _ in changes), set(['DELETE', 'CREATE', 'UPSERT']))
+    self.assertEqual(r53.diff_rrsets(old, new, processes=3), changes)
+    self.assertEqual(r53.diff_rrsets(new, old, processes=2), r53.diff_rrsets(new, old))
+    self.assertRaises(r53.InvalidArgumentException, r53.diff_rrsets, old, new + new[:1], processes=2)
+    # Concurrent calls each diff their own configs.
+    results = {}
+    def diff(name, a, b):
+      results[name] = r53.diff_rrsets(a, b, processes=2)
+    threads = [threading.Thread(target=diff, args=('forward', old, new)),
+               threading.Thread(target=diff, args=('back', new, old))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(results, {'forward': changes, 'back': r53.diff_rrsets(new, old)})
+
+  def test_order_changes(self):
+    def alias(name, target):
+      return r53.RRSet(name, 'A', extra=[('AliasTarget', (
+          ('HostedZoneId', 'ZEXAMPLE'), ('DNSName', target), ('EvaluateTargetHealth', 'false')))])
+    soa = r53.RRSet('example.com.', 'SOA', ttl='900', values=['ns1.example.com. hostmaster.example.com. 1 2 3 4 5'])
+    old = r53.RRSet('old.example.com.', 'A', ttl='60', values=['192.168.0.1'])
+    new = r53.RRSet('new.example.com.', 'A', ttl='60', values=['192.168.0.2'])
+    live = [soa, old, alias('www.example.com.', 'OLD.example.com')]
+    changes = r53.diff_rrsets(live, [soa, alias('www.example.com.', 'new.example.com.'), new])
+    self.assertEqual([(action, rrset.name) for action, rrset in changes],
+                     [('DELETE', 'old.example.com.'), ('UPSERT', 'www.example.com.'), ('CREATE', 'new.example.com.')])
+    ordered = r53.order_changes(changes, r53.index_rrsets(live))
+    self.assertEqual([(action, rrset.name) for action, rrset in ordered],
+                     [('CREATE', 'new.example.com.'), ('UPSERT', 'www.example.com.'), ('DELETE', 'old.example.com.')])
+    # Each change in a batch of its own: in diff order both ends break.
+    self.assertEqual(r53.preflight(live, [[change] for change in changes]), [
+        'batch 1/3: DELETE of old.example.com. A, which www.example.com. still alias',
+        'batch 2/3: alias www.example.com. A points at new.example.com. A, which would not exist'])
+    self.assertEqual(r53.preflight(live, [[change] for change in ordered]), [])
+    self.assertEqual(r53.preflight(live, [changes]), [])
+    # Aliases elsewhere are not checked.
+    self.assertEqual(r53.preflight(live, [[change] for change in changes], zone_id='ZOTHER'), [])
+
+  def test_preflight(self):
+    live = [r53.RRSet('example.com.', 'SOA', ttl='900', values=['ns1.example.com. hostmaster.example.com. 1 2 3 4 5']),
+            r53.RRSet('mail.example.com.', 'A', ttl='60', values=['192.168.0.1']),
+            r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.0.2'])]
+    cname = r53.RRSet('mail.example.com.', 'CNAME', ttl='60', values=['www.example.com.'])
+    self.assertEqual(r53.preflight(live, [[('CREATE', cname)]]),
+                     ['mail.example.com. would have a CNAME alongside A'])
+    self.assertEqual(r53.preflight(live, [[('DELETE', live[1]), ('CREATE', cname)]]), [])
+    self.assertEqual(r53.preflight(live, [[('CREATE', live[2])],
+                                          [('DELETE', r53.RRSet('www.example.com.', 'A', ttl='300', values=['192.168.0.2'])),
+                                           ('DELETE', r53.RRSet('ftp.example.com.', 'A', ttl='60', values=['192.168.0.3']))]]),
+                     ['batch 1/2: CREATE of www.example.com. A, which already exists',
+                      'batch 2/2: DELETE of www.example.com. A does not match its current values',
+                      'batch 2/2: DELETE of ftp.example.com. A, which does not exist'])
+    # Without the whole zone, only what is known is checked.
+    self.assertEqual(r53.preflight(live[1:2], [[('CREATE', cname)]], complete=False), [])
+    changes, batches, errs = r53.plan_push(live, live[:2] + [r53.RRSet('mail.example.com.', 'CNAME', ttl='60', values=['x.'])])
+    self.assertEqual(errs, ['mail.example.com. would have a CNAME alongside A'])
+
+  def test_submit_batches(self):
+    batches = [[('CREATE', r53.RRSet('a.example.com.', 'A', ttl='60', values=['192.168.0.1']))],
+               [('DELETE', r53.RRSet('b.example.com.', 'A', ttl='60', values=['192.168.0.2']))]]
+    body = ('<ChangeResourceRecordSetsRequest xmlns="https://route53.amazonaws.com/doc/2013-04-01/">'
+            '<ChangeBatch><Comment>foobar (batch %d/2)</Comment><Changes><Change><Action>%s</Action>'
+            '<ResourceRecordSet><Name>%s.example.com.</Name><Type>A</Type><TTL>60</TTL><ResourceRecords>'
+            '<ResourceRecord><Value>%s</Value></ResourceRecord></ResourceRecords></ResourceRecordSet>'
+            '</Change></Changes></ChangeBatch></ChangeResourceRecordSetsRequest>')
+    self.r53mock.change_rrsets('AAAA', body % (1, 'CREATE', 'a', '192.168.0.1')).AndReturn(
+        {'ChangeResourceRecordSetsResponse': {'ChangeInfo': {'Id': '/change/C1'}}})
+    self.r53mock.change_rrsets('AAAA', body % (2, 'DELETE', 'b', '192.168.0.2')).AndReturn(
+        {'ChangeResourceRecordSetsResponse': {'ChangeInfo': {'Id': '/change/C2'}}})
+    mox.Replay(self.r53mock)
+    self.assertEqual(r53.submit_batches(self.r53mock, 'AAAA', batches, 'foobar'), ['C1', 'C2'])
+    mox.Verify(self.r53mock)
+
+  def test_sync_manifest(self):
+    rrsets = '''<ResourceRecordSets xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+      <ResourceRecordSet>
+         <Name>%s.</Name>
+         <Type>A</Type>
+         <TTL>%d</TTL>
+         <ResourceRecords>
+            <ResourceRecord>
+               <Value>192.168.0.1</Value>
+            </ResourceRecord>
+         </ResourceRecords>
+      </ResourceRecordSet>
+   </ResourceRecordSets>'''
+    tmpdir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, tmpdir)
+    for zone in ('example.com', 'example.org'):
+      with open(os.path.join(tmpdir, zone + '.xml'), 'w') as f:
+        f.write(rrsets % (zone, 60))
+    with open(os.path.join(tmpdir, 'manifest'), 'w') as f:
+      f.write('# zone file\nexample.com example.com.xml\n\nexample.org  example.org.xml\n')
+    entries = r53.read_manifest(os.path.join(tmpdir, 'manifest'))
+    self.assertEqual(entries, [('example.com', os.path.join(tmpdir, 'example.com.xml')),
+                               ('example.org', os.path.join(tmpdir, 'example.org.xml'))])
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzone').AndReturn(StringIO.StringIO('''
+<ListHostedZonesResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+   <HostedZones>
+      <HostedZone><Id>/hostedzone/AAAA</Id><Name>example.com.</Name></HostedZone>
+      <HostedZone><Id>/hostedzone/BBBB</Id><Name>example.org.</Name></HostedZone>
+   </HostedZones>
+   <IsTruncated>false</IsTruncated>
+</ListHostedZonesResponse>'''))
+    live = '''<ListResourceRecordSetsResponse xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+      %s<IsTruncated>false</IsTruncated></ListResourceRecordSetsResponse>'''
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzone/AAAA/rrset').AndReturn(
+        StringIO.StringIO(live % (rrsets % ('example.com', 60))))
+    self.r53mock.make_request('GET', '/2013-04-01/hostedzone/BBBB/rrset').AndReturn(
+        StringIO.StringIO(live % (rrsets % ('example.org', 300))))
+    mox.Replay(self.r53mock)
+    results = r53.sync_manifest(self.r53mock, entries, workers=1, dryrun=True)
+    self.assertEqual(results, [r53.SyncResult('example.com', 0, [], []),
+                               r53.SyncResult('example.org', 1, [], [])])
+    mox.Verify(self.r53mock)
+
+  def test_rrset(self):
+    parser = lxml.etree.XMLParser(remove_blank_text=True)
+    elem = lxml.etree.XML('''<ResourceRecordSet xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+         <Name>*.example.com.</Name>
+         <Type>A</Type>
+         <SetIdentifier>west</SetIdentifier>
+         <Weight>10</Weight>
+         <AliasTarget>
+            <HostedZoneId>Z2FDTNDATAQYW2</HostedZoneId>
+            <DNSName>d111111abcdef8.cloudfront.net.</DNSName>
+            <EvaluateTargetHealth>false</EvaluateTargetHealth>
+         </AliasTarget>
+      </ResourceRecordSet>''', parser=parser)
+    rrset = r53.RRSet.from_element(elem)
+    self.assertEqual(rrset.key, ('\\052.example.com.', 'A', 'west'))
+    self.assertEqual(rrset, r53.RRSet('*.example.com.', 'A', 'west', extra=[
+        ('AliasTarget', (('HostedZoneId', 'Z2FDTNDATAQYW2'),
+                         ('DNSName', 'd111111abcdef8.cloudfront.net.'),
+                         ('EvaluateTargetHealth', 'false'))),
+        ('Weight', '10')]))
+    elem.find('{%s}Name' % r53.R53_XMLNS).text = '\\052.example.com.'
+    self.assertEqual(lxml.etree.tostring(rrset.to_element()), lxml.etree.tostring(elem))
+    self.assertEqual(pickle.loads(pickle.dumps(rrset)), rrset)
+    self.assertRaises(AttributeError, setattr, rrset, 'ttl', '60')
+    self.assertNotEqual(r53.RRSet('example.com.', 'NS', ttl='60', values=['ns2.', 'ns1.']),
+                        r53.RRSet('example.com.', 'NS', ttl='300', values=['ns1.', 'ns2.']))
+    self.assertEqual(r53.RRSet('example.com.', 'NS', ttl='60', values=['ns2.', 'ns1.']),
+                     r53.RRSet('example.com.', 'NS', ttl='60', values=['ns1.', 'ns2.']))
+
+  def test_canonical_rrset(self):
+    elem = lxml.etree.XML('''<ResourceRecordSet xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+         <Name> *.WWW.Example.com </Name>
+         <Type>A</Type>
+         <TTL>
+           60
+         </TTL>
+         <ResourceRecords>
+           <ResourceRecord><Value> 192.168.0.2 </Value></ResourceRecord>
+           <!-- primary -->
+           <ResourceRecord><Value>192.168.0.1</Value></ResourceRecord>
+         </ResourceRecords>
+      </ResourceRecordSet>''')
+    rrset = r53.RRSet.from_element(elem)
+    expected = r53.RRSet('\\052.www.example.com.', 'A', ttl='60', values=['192.168.0.1', '192.168.0.2'])
+    self.assertEqual(rrset, expected)
+    self.assertEqual(rrset.fingerprint, expected.fingerprint)
+    self.assertEqual(rrset.fingerprint, pickle.loads(pickle.dumps(rrset)).fingerprint)
+    self.assertEqual(rrset.fingerprint, r53.RRSet(u'*.www.example.com', u'A', ttl=u'60',
+                                                  values=[u'192.168.0.1', u'192.168.0.2']).fingerprint)
+    self.assertEqual(len(rrset.fingerprint), 40)
+    others = [r53.RRSet('\\052.www.example.com.', 'A', 'x', '60', ['192.168.0.1', '192.168.0.2']),
+              r53.RRSet('\\052.www.example.com.', 'A', ttl='60', values=['192.168.0.1192.168.0.2']),
+              r53.RRSet('\\052.www.example.com.', 'A', extra=[('TTL', '60')])]
+    self.assertEqual(len(set(other.fingerprint for other in others + [rrset])), 4)
+
+  def test_canonical_alias(self):
+    live = lxml.etree.XML('''<ResourceRecordSet xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+         <Name>www.example.com.</Name>
+         <Type>A</Type>
+         <AliasTarget>
+           <EvaluateTargetHealth>false</EvaluateTargetHealth>
+           <DNSName>Foo.Example.com</DNSName>
+           <HostedZoneId>ZEXAMPLE</HostedZoneId>
+         </AliasTarget>
+      </ResourceRecordSet>''')
+    rrset = r53.RRSet('www.example.com.', 'A', extra=[('AliasTarget', (
+        ('HostedZoneId', 'ZEXAMPLE'), ('DNSName', 'foo.example.com.'), ('EvaluateTargetHealth', 'false')))])
+    self.assertEqual(r53.RRSet.from_element(live), rrset)
+    self.assertEqual(r53.RRSet.from_element(live).fingerprint, rrset.fingerprint)
+    self.assertEqual(r53.diff_rrsets([r53.RRSet.from_element(live)], [rrset]), [])
+    self.assertEqual([child.tag.rpartition('}')[2] for child in rrset.to_element().find(
+        '{%s}AliasTarget' % r53.R53_XMLNS)], ['HostedZoneId', 'DNSName', 'EvaluateTargetHealth'])
+
+  def test_canonical_geolocation(self):
+    live = lxml.etree.XML('''<ResourceRecordSet xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+         <Name>www.example.com.</Name>
+         <Type>A</Type>
+         <SetIdentifier>us-ca</SetIdentifier>
+         <GeoLocation>
+           <SubdivisionCode>CA</SubdivisionCode>
+           <CountryCode>US</CountryCode>
+         </GeoLocation>
+         <TTL>60</TTL>
+         <ResourceRecords><ResourceRecord><Value>192.168.0.1</Value></ResourceRecord></ResourceRecords>
+      </ResourceRecordSet>''')
+    rrset = r53.RRSet('www.example.com.', 'A', 'us-ca', '60', ['192.168.0.1'], [
+        ('GeoLocation', (('CountryCode', 'US'), ('SubdivisionCode', 'CA')))])
+    self.assertEqual(r53.RRSet.from_element(live), rrset)
+    self.assertEqual(r53.RRSet.from_element(live).extra,
+                     (('GeoLocation', (('CountryCode', 'US'), ('SubdivisionCode', 'CA'))),))
+
+  def test_lazy_constants(self):
+    self.assertTrue(isinstance(r53.xml_parser(), lxml.etree.XMLParser))
+    self.assertTrue(r53.xml_parser() is r53.xml_parser())
+    self.assertTrue(r53.XSLT_STRIPSPACE is r53.strip_space)
+
+  def test_offline_cli(self):
+    """--validate and --diff work without boto."""
+    rrsets = bench.generate_zone(100)
+    tmpdir = tempfile.mkdtemp()
+    paths = dict((name, os.path.join(tmpdir, name)) for name in ('old.xml', 'new.xml', 'bad.xml'))
+    configs = {'old.xml': rrsets, 'new.xml': bench.mutate(rrsets, 0.1),
+               'bad.xml': [r53.RRSet('www.example.com.', 'CNAME', ttl='60', values=['example.com.']),
+                           r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.0.1'])]}
+    for name, config in configs.items():
+      with open(paths[name], 'w') as f:
+        f.write(bench.to_xml(config))
+    self.assertEqual(r53.check_config(configs['new.xml']), [])
+    self.assertEqual(r53.check_config(configs['bad.xml']), ['www.example.com. would have a CNAME alongside A'])
+    script = ('import sys; sys.path.insert(0, %r); import r53; sys.argv[0] = "r53"\n'
+              'try:\n  r53.main()\nfinally:\n  print "boto imported: %%s" %% ("boto" in sys.modules)'
+              % os.path.dirname(os.path.abspath(r53.__file__)))
+    # No USER, as in many CI jobs and containers.
+    env = dict((k, v) for k, v in os.environ.items() if k not in ('USER', 'LOGNAME', 'LNAME', 'USERNAME'))
+    def run(*args):
+      proc = subprocess.Popen([sys.executable, '-c', script] + list(args), stdout=subprocess.PIPE,
+                              env=env)
+      out = proc.communicate()[0]
+      self.assertTrue(out.endswith('boto imported: False\n'), out)
+      return proc.returncode, out
+    try:
+      self.assertEqual(run('--validate', paths['old.xml'], paths['new.xml'])[0], 0)
+      code, out = run('--validate', paths['old.xml'], paths['bad.xml'])
+      self.assertEqual(code, 1)
+      self.assertTrue('would have a CNAME alongside A' in out)
+      self.assertEqual(run('--diff', paths['old.xml'], paths['old.xml'])[0], 0)
+      code, out = run('--diff', paths['old.xml'], paths['new.xml'])
+      self.assertEqual(code, 1)
+      self.assertEqual(len(r53.changes_from_xml(lxml.etree.XML(out[:out.rindex('boto')]))),
+                       len(r53.diff_rrsets(configs['old.xml'], configs['new.xml'])))
+    finally:
+      shutil.rmtree(tmpdir)
+
+  def test_script_zonefile(self):
+    """Run as a script, r53.py reads zone files into the same RRSet class."""
+    tmpdir = tempfile.mkdtemp()
+    old, new = os.path.join(tmpdir, 'old.xml'), os.path.join(tmpdir, 'new.zone')
+    with open(old, 'w') as f:
+      f.write(bench.to_xml([r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.0.1']),
+                            r53.RRSet('mail.example.com.', 'A', ttl='60', values=['192.168.0.2'])]))
+    with open(new, 'w') as f:
+      f.write('$TTL 60\nwww A 192.168.0.1\nmail A 192.168.0.3\n')
+    script = os.path.join(os.path.dirname(os.path.abspath(r53.__file__)), 'r53.py')
+    try:
+      proc = subprocess.Popen([sys.executable, script, '--diff', old, new, '--zone', 'example.com'],
+                              stdout=subprocess.PIPE, env=dict(os.environ, USER='r53'))
+      out = proc.communicate()[0]
+    finally:
+      shutil.rmtree(tmpdir)
+    self.assertEqual(proc.returncode, 1)
+    self.assertEqual(r53.changes_from_xml(lxml.etree.XML(out)),
+                     [('UPSERT', r53.RRSet('mail.example.com.', 'A', ttl='60', values=['192.168.0.3']))])
+
+  def test_snapshot_zone_id(self):
+    tmpdir = tempfile.mkdtemp()
+    store = snapshot.SnapshotStore(os.path.join(tmpdir, 'snapshots'))
+    cache = r53.ZoneCache(os.path.join(tmpdir, 'zones.json'), ttl=0)
+    soa = r53.RRSet('example.com.', 'SOA', ttl='900', values=['ns1.example.com. admin.example.com. 1 2 3 4 5'])
+    www = r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.0.1'])
+    r53.save_snapshot(store, 'ZOTHER', [r53.RRSet('example.net.', 'SOA', ttl='900', values=soa.values)])
+    r53.save_snapshot(store, 'ZEXAMPLE', [www, soa])
+    new = os.path.join(tmpdir, 'new.xml')
+    with open(new, 'w') as f:
+      f.write(bench.to_xml([soa, r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.0.2'])]))
+    script = os.path.join(os.path.dirname(os.path.abspath(r53.__file__)), 'r53.py')
+    def run(*args):
+      # Nothing listens on the endpoint: any API call fails.
+      proc = subprocess.Popen([sys.executable, script, '--endpoint', 'localhost:1', '--zone', 'Example.com',
+                               '--snapshots', store.path, '--zone-cache', cache.path] + list(args),
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=dict(os.environ, USER='r53'))
+      out = proc.communicate()[0]
+      return proc.returncode, out
+    try:
+      self.assertEqual(r53.snapshot_zone_id(store, 'Example.com.'), 'ZEXAMPLE')
+      self.assertRaises(r53.ZoneNotFoundError, r53.snapshot_zone_id, store, 'example.org')
+      # Expired cache entries are good enough, if the zone has snapshots.
+      cache.update({'example.com': 'ZOTHER'})
+      self.assertEqual(r53.snapshot_zone_id(store, 'example.com', cache), 'ZOTHER')
+      cache.update({'example.com': 'ZGONE'})
+      self.assertEqual(r53.snapshot_zone_id(store, 'example.com', cache), 'ZEXAMPLE')
+      code, out = run('--list-snapshots')
+      self.assertEqual((code, out.count('ZEXAMPLE')), (0, 1))
+      code, out = run('--pull', '--from-snapshot')
+      self.assertEqual((code, r53.parse_rrsets(StringIO.StringIO(out))), (0, [www, soa]))
+      code, out = run('--push', new, '--confirm', '--from-snapshot')
+      self.assertEqual(code, 0)
+      self.assertTrue('Dry run mode' in out)
+      self.assertEqual(run('--list-snapshots', '--zone', 'example.org')[0], 1)
+    finally:
+      shutil.rmtree(tmpdir)
+
   def test_normalize_rrs(self):
     parser = lxml.etree.XMLParser(remove_blank_text=True)
     old = lxml.etree.XML('''<ResourceRecordSets xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
@@ -0,0 +1,132 @@
+"""boto connections to Route 53, and the things boto needs patching for.
+
+Importing this module imports boto, so r53 only does so once it has to
+talk to Route 53; see r53.connect.
+"""
+
+import os
+import StringIO
+import zlib
+from boto.route53 import Route53Connection
+import metrics
+
+
+def keep_error_body(response, i, next_sleep):
+  """boto retry handler that hands 400 responses back to the caller intact.
+
+  boto's own Route 53 handler sleeps through throttling itself, outside any
+  RateLimiter, gives up with an error that lacks the response body, and
+  consumes the body of other 400s, losing their error code. This one reads
+  the body, so the connection can go back to the pool, and keeps it for
+  the caller; ThrottledConnection does the retrying."""
+  if response.status == 400:
+    response.read = StringIO.StringIO(response.read()).read
+
+
+def drop_connections(conn):
+  """Close the connections conn's pool is keeping alive, so the next request
+  opens a new one.
+
+  Args: conn: boto connection; anything else is left alone."""
+  if not isinstance(conn, Route53Connection):
+    return
+  pool = conn._pool
+  with pool.mutex:
+    hosts = pool.host_to_pool.values()
+    pool.host_to_pool.clear()
+  for host in hosts:
+    for connection, _ in host.queue:
+      connection.close()
+
+
+class GzipResponse(object):
+  """A gzip-encoded API response, decompressed as it is read.
+
+  Args: resp: httplib.HTTPResponse"""
+
+  def __init__(self, resp):
+    self.resp = resp
+    self.status = resp.status
+    self.reason = resp.reason
+    self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    self.buffer = ''
+    self.offset = 0
+
+  def __getattr__(self, name):
+    return getattr(self.resp, name)
+
+  def read(self, amt=None):
+    while amt is None or len(self.buffer) - self.offset < amt:
+      chunk = self.resp.read(65536)
+      data = self.decompressor.decompress(chunk) if chunk else self.decompressor.flush()
+      self.buffer = self.buffer[self.offset:] + data
+      self.offset = 0
+      if not chunk:
+        break
+    end = len(self.buffer) if amt is None else self.offset + amt
+    data = self.buffer[self.offset:end]
+    self.offset = end
+    return data
+
+
+class Route53Session(Route53Connection):
+  """Route53Connection tuned for making many requests in a row.
+
+  boto pools connections, but only takes one back once its response has
+  been read in full and no retry handler has raised; keep_error_body makes
+  sure error responses don't cost a reconnect (and TLS handshake) either.
+  Responses are requested gzip-encoded, and since Route 53 signatures cover
+  only the Date header, one signature serves every request made within
+  the same second.
+
+  Requests made, connections opened and response body bytes received are
+  counted in stats as api_calls, connections and bytes.
+
+  Args: endpoint: optional host:port of a plain HTTP stand-in for the API,
+          such as fakeroute53; credentials default to dummies there.
+        compress: ask for gzip-encoded responses.
+        keepalive: reuse connections; if False, each request opens one.
+        stats: optional metrics.Stats to count requests in.
+        Anything else is passed to Route53Connection."""
+
+  def __init__(self, endpoint=None, compress=True, keepalive=True, stats=None, **kwargs):
+    if endpoint is not None:
+      host, _, port = endpoint.partition(':')
+      kwargs.setdefault('aws_access_key_id', os.environ.get('AWS_ACCESS_KEY_ID', 'fake'))
+      kwargs.setdefault('aws_secret_access_key', os.environ.get('AWS_SECRET_ACCESS_KEY', 'fake'))
+      kwargs.update(host=host, port=int(port or 80))
+    Route53Connection.__init__(self, **kwargs)
+    if endpoint is not None:
+      # Route53Connection always asks for https; switch the connection to http.
+      self.is_secure = False
+      self.protocol = 'http'
+      self._connection = (self.host, self.port, False)
+    self.compress = compress
+    self.keepalive = keepalive
+    self.stats = stats if stats is not None else metrics.Stats()
+    self._retry_handler = keep_error_body
+    signatures = {}
+    sign_string = self._auth_handler.sign_string
+    def sign(string):
+      signature = signatures.get(string)
+      if signature is None:
+        signatures.clear()
+        signature = signatures[string] = sign_string(string)
+      return signature
+    self._auth_handler.sign_string = sign
+
+  def make_request(self, action, path, headers=None, data='', params=None):
+    headers = dict(headers or {})
+    if self.compress:
+      headers.setdefault('Accept-Encoding', 'gzip')
+    if not self.keepalive:
+      headers['Connection'] = 'close'
+    resp = Route53Connection.make_request(self, action, path, headers, data, params)
+    self.stats.count(api_calls=1, bytes=int(resp.getheader('Content-Length') or 0))
+    if (resp.getheader('Content-Encoding') or '').lower() == 'gzip':
+      return GzipResponse(resp)
+    return resp
+
+  def new_http_connection(self, host, port, is_secure):
+    self.stats.count(connections=1)
+    return Route53Connection.new_http_connection(self, host, port, is_secure)
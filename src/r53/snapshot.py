@@ -0,0 +1,163 @@
+"""Local store of zone state snapshots, so r53 can diff, pull and inspect zones
+without asking Route 53 for them again."""
+
+import calendar
+import gzip
+import os
+import time
+import lazy
+
+lxml = lazy.LazyModule('lxml.etree')
+
+SUFFIX = '.xml.gz'
+
+
+class SnapshotNotFoundError(Exception):
+  """Raised when a zone has no snapshot to read."""
+
+
+class SnapshotStore(object):
+  """Compressed, timestamped copies of <ResourceRecordSets> documents, kept in
+  one directory per zone ID:
+
+    <path>/ZE2DYFZDWGSL4/20110831T004107.518Z.xml.gz
+
+  Args: path: string, root directory of the store.
+        keep: int, snapshots to keep per zone; older ones are pruned."""
+
+  def __init__(self, path, keep=20):
+    self.path = path
+    self.keep = keep
+
+  def _zone_dir(self, zone_id):
+    return os.path.join(self.path, zone_id)
+
+  def zone_ids(self):
+    """Returns: [ zone IDs ] with a directory in the store."""
+    try:
+      names = os.listdir(self.path)
+    except OSError:
+      return []
+    return sorted(name for name in names if os.path.isdir(self._zone_dir(name)))
+
+  def list(self, zone_id):
+    """List a zone's snapshots.
+
+    Args: zone_id: string, hosted zone id.
+    Returns: [ (timestamp, path) ], oldest first; timestamp in epoch seconds."""
+    try:
+      names = os.listdir(self._zone_dir(zone_id))
+    except OSError:
+      return []
+    snapshots = []
+    for name in names:
+      if not name.endswith(SUFFIX):
+        continue
+      stamp = name[:-len(SUFFIX)]
+      try:
+        seconds = calendar.timegm(time.strptime(stamp[:15], '%Y%m%dT%H%M%S'))
+        seconds += float(stamp[15:-1] or 0)
+      except ValueError:
+        continue
+      snapshots.append((seconds, os.path.join(self._zone_dir(zone_id), name)))
+    snapshots.sort()
+    return snapshots
+
+  def latest(self, zone_id):
+    """Returns: (timestamp, path) of the newest snapshot, or None."""
+    snapshots = self.list(zone_id)
+    if not snapshots:
+      return None
+    return snapshots[-1]
+
+  def age(self, zone_id):
+    """Returns: seconds since the newest snapshot was taken, or None."""
+    latest = self.latest(zone_id)
+    if latest is None:
+      return None
+    return time.time() - latest[0]
+
+  def open(self, zone_id):
+    """Open a new snapshot for writing. Write a <ResourceRecordSets> document
+    to it and close it; it only becomes visible to readers once closed.
+    Used in a with statement, it is closed on success and discarded if the
+    write fails.
+
+    Args: zone_id: string, hosted zone id.
+    Returns: file-like object."""
+    directory = self._zone_dir(zone_id)
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+    now = time.time()
+    name = '%s.%03dZ%s' % (time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)),
+                           int(now * 1000) % 1000, SUFFIX)
+    return _SnapshotWriter(self, zone_id, os.path.join(directory, name))
+
+  def save(self, zone_id, rrsets):
+    """Store a snapshot of a zone.
+
+    Args: zone_id: string, hosted zone id.
+          rrsets: lxml.etree.Element (<ResourceRecordSets>)
+    Returns: path of the new snapshot."""
+    with self.open(zone_id) as f:
+      f.write(lxml.etree.tostring(rrsets))
+    return f.path
+
+  def load(self, zone_id, path=None):
+    """Read a snapshot back.
+
+    Args: zone_id: string, hosted zone id.
+          path: optional snapshot to read; defaults to the newest.
+    Returns: lxml.etree.Element (<ResourceRecordSets>)
+    Raises: SnapshotNotFoundError if the zone has no snapshots."""
+    if path is None:
+      latest = self.latest(zone_id)
+      if latest is None:
+        raise SnapshotNotFoundError('no snapshot of zone %s in %s' % (zone_id, self.path))
+      path = latest[1]
+    f = gzip.open(path, 'rb')
+    try:
+      return lxml.etree.parse(f).getroot()
+    finally:
+      f.close()
+
+  def prune(self, zone_id):
+    """Delete all but the newest self.keep snapshots of a zone."""
+    for _, path in self.list(zone_id)[:-self.keep]:
+      os.remove(path)
+
+
+class _SnapshotWriter(object):
+  """gzip writer that moves the finished snapshot into place on close."""
+
+  def __init__(self, store, zone_id, path):
+    self.store = store
+    self.zone_id = zone_id
+    self.path = path
+    self.tmp = '%s.%d.tmp' % (path, os.getpid())
+    self.f = gzip.open(self.tmp, 'wb')
+
+  def write(self, data):
+    self.f.write(data)
+
+  def close(self):
+    self.f.close()
+    os.rename(self.tmp, self.path)
+    self.store.prune(self.zone_id)
+
+  def discard(self):
+    """Give up on the snapshot, removing what was written of it."""
+    self.f.close()
+    try:
+      os.remove(self.tmp)
+    except OSError:
+      pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.discard()
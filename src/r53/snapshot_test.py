@@ -0,0 +1,57 @@
+import lxml.etree
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import snapshot
+
+class SnapshotStoreTest(unittest.TestCase):
+  """Tests for functions in snapshot.py."""
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.store = snapshot.SnapshotStore(self.tmpdir, keep=2)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def test_save_load(self):
+    rrsets = lxml.etree.XML('''<ResourceRecordSets xmlns="https://route53.amazonaws.com/doc/2013-04-01/">
+      <ResourceRecordSet>
+         <Name>example.com.</Name>
+         <Type>A</Type>
+         <TTL>60</TTL>
+         <ResourceRecords>
+            <ResourceRecord>
+               <Value>192.168.0.1</Value>
+            </ResourceRecord>
+         </ResourceRecords>
+      </ResourceRecordSet>
+   </ResourceRecordSets>''')
+    self.assertEqual(self.store.latest('AAAA'), None)
+    self.assertRaises(snapshot.SnapshotNotFoundError, self.store.load, 'AAAA')
+    path = self.store.save('AAAA', rrsets)
+    self.assertEqual(self.store.latest('AAAA')[1], path)
+    self.assertTrue(self.store.age('AAAA') < 60)
+    self.assertEqual(lxml.etree.tostring(self.store.load('AAAA')), lxml.etree.tostring(rrsets))
+
+  def test_prune(self):
+    rrsets = lxml.etree.XML('<ResourceRecordSets xmlns="https://route53.amazonaws.com/doc/2013-04-01/"/>')
+    paths = []
+    for _ in range(3):
+      paths.append(self.store.save('AAAA', rrsets))
+      time.sleep(0.002)
+    self.assertEqual([path for _, path in self.store.list('AAAA')], paths[1:])
+
+
+  def test_failed_write(self):
+    def write():
+      with self.store.open('AAAA') as f:
+        f.write('<ResourceRecordSets')
+        raise IOError('connection reset')
+    self.assertRaises(IOError, write)
+    self.assertEqual(os.listdir(os.path.join(self.tmpdir, 'AAAA')), [])
+    self.assertEqual(self.store.latest('AAAA'), None)
+
+if __name__ == '__main__':
+    unittest.main()
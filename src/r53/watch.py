@@ -0,0 +1,254 @@
+"""Keep zones in sync with their config files as the files change.
+
+A Daemon looks its zones up and fetches them once, then keeps their live
+state in memory and its connection open. When a config file changes it
+waits for edits to settle, diffs the file against the state it holds and
+pushes just that, without fetching the zone again. Every so often it
+refetches each zone to catch changes made behind its back, and pushes the
+file again if the zone has drifted from it.
+
+Files are watched with inotify when pyinotify is installed, and by polling
+their modification times otherwise.
+"""
+
+import os
+import threading
+import time
+from boto.route53.exception import DNSServerError
+import r53
+
+try:
+  import pyinotify
+except ImportError:
+  pyinotify = None
+
+log = r53.log
+
+
+def _stat(path):
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime, st.st_size, st.st_ino)
+
+
+class PollingWatcher(object):
+  """Notices changes to files by polling their stat.
+
+  Args: paths: iterable of file paths.
+        interval: seconds between polls."""
+
+  def __init__(self, paths, interval=1.0):
+    self.interval = interval
+    self.stats = dict((os.path.abspath(path), None) for path in paths)
+    for path in self.stats:
+      self.stats[path] = _stat(path)
+
+  def _changed(self):
+    changed = set()
+    for path, old in self.stats.items():
+      new = _stat(path)
+      if new != old:
+        self.stats[path] = new
+        changed.add(path)
+    return changed
+
+  def wait(self, timeout):
+    """Returns: set of absolute paths changed since the last call, as soon
+    as there are any or after timeout seconds."""
+    deadline = time.time() + timeout
+    while True:
+      changed = self._changed()
+      remaining = deadline - time.time()
+      if changed or remaining <= 0:
+        return changed
+      time.sleep(min(self.interval, remaining))
+
+  def close(self):
+    pass
+
+
+class InotifyWatcher(object):
+  """Notices changes to files with inotify. The directories holding them are
+  watched, so files replaced by renaming, as many editors do, are noticed.
+
+  Args: paths: iterable of file paths."""
+
+  MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE
+          if pyinotify else 0)
+
+  def __init__(self, paths):
+    self.paths = set(os.path.abspath(path) for path in paths)
+    self.changed = set()
+    watcher = self
+
+    class Handler(pyinotify.ProcessEvent):
+      def process_default(self, event):
+        if event.pathname in watcher.paths:
+          watcher.changed.add(event.pathname)
+
+    self.manager = pyinotify.WatchManager()
+    self.notifier = pyinotify.Notifier(self.manager, Handler())
+    for directory in set(os.path.dirname(path) for path in self.paths):
+      self.manager.add_watch(directory, self.MASK)
+
+  def wait(self, timeout):
+    """See PollingWatcher.wait."""
+    deadline = time.time() + timeout
+    while not self.changed:
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        break
+      if self.notifier.check_events(int(remaining * 1000)):
+        self.notifier.read_events()
+        self.notifier.process_events()
+    changed, self.changed = self.changed, set()
+    return changed
+
+  def close(self):
+    self.notifier.stop()
+
+
+def file_watcher(paths, interval=1.0):
+  """Returns: an InotifyWatcher if pyinotify is available, else a
+  PollingWatcher polling every interval seconds."""
+  if pyinotify is not None:
+    return InotifyWatcher(paths)
+  log.info('pyinotify is not installed; polling for changes every %gs' % interval)
+  return PollingWatcher(paths, interval)
+
+
+class WatchedZone(object):
+  """A zone, the file it is pushed from, and its live state as last seen.
+
+  Args: zone: string eg. foursquare.com
+        filename: string, config to push.
+        format: see r53.read_config."""
+
+  def __init__(self, zone, filename, format=None):
+    self.zone = zone
+    self.filename = os.path.abspath(filename)
+    self.format = format
+    self.zone_id = None
+    self.live = None
+    self.reconciled = 0
+
+
+class Daemon(object):
+  """Push zones whenever their config files change; see the module docstring.
+
+  Args: conn: boto.route53.Route53Connection, preferably a ThrottledConnection.
+        entries: [ (zone, file) ], eg. from r53.read_manifest.
+        debounce: seconds a file must go unchanged before it is pushed.
+        reconcile: seconds between refetches of each zone.
+        dryrun: bool, log changes instead of submitting them.
+        cache: optional r53.ZoneCache.
+        store: optional snapshot.SnapshotStore, updated after every push.
+        format: see r53.read_config.
+        workers: int, maximum zones pushed or refetched at once.
+        watcher: object with wait(timeout) and close(), as file_watcher
+          returns by default."""
+
+  def __init__(self, conn, entries, debounce=2.0, reconcile=300, dryrun=False, cache=None,
+               store=None, format=None, workers=8, watcher=None):
+    self.conn = conn
+    self.zones = [WatchedZone(zone, filename, format) for zone, filename in entries]
+    self.debounce = debounce
+    self.reconcile_interval = reconcile
+    self.dryrun = dryrun
+    self.cache = cache
+    self.store = store
+    self.workers = workers
+    self.watcher = watcher or file_watcher([zone.filename for zone in self.zones])
+    self.stopped = threading.Event()
+
+  def stop(self):
+    """Make run return, from any thread or a signal handler."""
+    self.stopped.set()
+
+  def refetch(self, zone):
+    """Refresh a zone's live state from Route 53."""
+    if zone.zone_id is None:
+      zone.zone_id = r53.lookup_zone(self.conn, zone.zone, cache=self.cache)
+    zone.live = r53.get_live_config(self.conn, zone.zone_id, self.store)
+    zone.reconciled = time.time()
+
+  def push(self, zone, retry=True):
+    """Push what differs between a zone's file and its live state.
+
+    If Route 53 rejects the changes, the live state was stale: refetch it
+    and try once more.
+
+    Returns: [ change IDs ]"""
+    new_config = r53.read_config(zone.filename, zone.format, zone.zone)
+    changes, batches, errs = r53.plan_push(zone.live, new_config, zone.zone_id)
+    if not changes:
+      return []
+    if errs:
+      log.error('%s: not pushing %d invalid changes: %s' % (zone.zone, len(changes), '; '.join(errs)))
+      return []
+    if self.dryrun:
+      log.info('%s: would push %d changes (dry run)' % (zone.zone, len(changes)))
+      return []
+    try:
+      change_ids = r53.submit_batches(self.conn, zone.zone_id, batches)
+    except DNSServerError as e:
+      if e.status != 400 or not retry:
+        raise
+      log.warning('%s: changes rejected (%s); refetching the zone' % (zone.zone, e.error_code or e.body))
+      self.refetch(zone)
+      return self.push(zone, retry=False)
+    log.info('%s: pushed %d changes as %s' % (zone.zone, len(changes), ', '.join(change_ids)))
+    zone.live = new_config
+    if self.store is not None:
+      r53.save_snapshot(self.store, zone.zone_id, new_config)
+    return change_ids
+
+  def _sync(self, zone, refetch):
+    try:
+      if refetch or zone.live is None:
+        # Even if this fails, wait a full interval before trying again.
+        zone.reconciled = time.time()
+        self.refetch(zone)
+      self.push(zone)
+    except Exception:
+      log.exception('%s: sync failed' % zone.zone)
+
+  def sync(self, zones, refetch=False):
+    """Push zones concurrently, first refetching them if refetch is set.
+    Failures are logged, not raised, so the daemon keeps going."""
+    r53.run_parallel(lambda zone: self._sync(zone, refetch), zones, self.workers)
+
+  def changed(self, timeout):
+    """Wait up to timeout for file changes, then until they settle.
+
+    Returns: set of changed paths."""
+    changed = self.watcher.wait(timeout)
+    if changed:
+      while not self.stopped.is_set():
+        more = self.watcher.wait(self.debounce)
+        if not more:
+          break
+        changed |= more
+    return changed
+
+  def run(self, tick=0.5):
+    """Sync every zone, then keep them in sync until stop is called.
+
+    Args: tick: longest time to go without checking for stop."""
+    self.sync(self.zones, refetch=True)
+    try:
+      while not self.stopped.is_set():
+        due = min(zone.reconciled for zone in self.zones) + self.reconcile_interval
+        changed = self.changed(max(0, min(tick, due - time.time())))
+        if changed:
+          log.info('changed: %s' % ', '.join(sorted(changed)))
+          self.sync([zone for zone in self.zones if zone.filename in changed])
+        now = time.time()
+        due = [zone for zone in self.zones if now >= zone.reconciled + self.reconcile_interval]
+        if due and not self.stopped.is_set():
+          log.debug('reconciling %s' % ', '.join(zone.zone for zone in due))
+          self.sync(due, refetch=True)
+    finally:
+      self.watcher.close()
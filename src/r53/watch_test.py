@@ -0,0 +1,89 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import fakeroute53
+import r53
+import watch
+
+class WatchTest(unittest.TestCase):
+  """Tests for functions in watch.py, against fakeroute53."""
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'example.com.zone')
+    self.write('www A 192.168.0.1\n')
+    self.route53 = fakeroute53.FakeRoute53()
+    self.zone_id = self.route53.add_zone('example.com')
+    self.server = fakeroute53.Server(('localhost', 0), self.route53)
+    thread = threading.Thread(target=self.server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    self.conn = r53.connect(self.server.endpoint)
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    shutil.rmtree(self.tmpdir)
+
+  def write(self, records):
+    with open(self.path, 'w') as f:
+      f.write('$TTL 60\n' + records)
+    # Make sure the change shows however coarse the file system's clock.
+    stamp = time.time() + len(records)
+    os.utime(self.path, (stamp, stamp))
+
+  def wait_for(self, predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+      if time.time() > deadline:
+        self.fail('timed out')
+      time.sleep(0.02)
+
+  def live_values(self):
+    return [(rrset.name, rrset.values) for rrset in r53.fetch_rrsets(self.zone_id, self.conn)]
+
+  def test_polling_watcher(self):
+    watcher = watch.PollingWatcher([self.path], 0.01)
+    self.assertEqual(watcher.wait(0.05), set())
+    self.write('www A 192.168.0.2\n')
+    self.assertEqual(watcher.wait(1), set([self.path]))
+    self.assertEqual(watcher.wait(0), set())
+    os.unlink(self.path)
+    self.assertEqual(watcher.wait(0), set([self.path]))
+
+  def test_daemon(self):
+    daemon = watch.Daemon(self.conn, [('example.com', self.path)], debounce=0.1, reconcile=3600,
+                          watcher=watch.PollingWatcher([self.path], 0.01))
+    thread = threading.Thread(target=daemon.run, kwargs={'tick': 0.05})
+    thread.start()
+    try:
+      self.wait_for(lambda: self.live_values() == [('www.example.com.', ('192.168.0.1',))])
+      # Edits are pushed from the state in memory, without refetching.
+      r53.STATS.reset()
+      self.write('www A 192.168.0.2\nmail A 192.168.0.3\n')
+      self.wait_for(lambda: r53.STATS.counters['batches'])
+      self.assertEqual(r53.STATS.counters['pages'], 0)
+      self.assertEqual(self.live_values(), [('mail.example.com.', ('192.168.0.3',)),
+                                            ('www.example.com.', ('192.168.0.2',))])
+      # Changes made behind the daemon's back are undone at the next reconcile.
+      daemon.reconcile_interval = 0.2
+      r53.submit_batches(self.conn, self.zone_id, [[
+          ('DELETE', r53.RRSet('mail.example.com.', 'A', ttl='60', values=['192.168.0.3']))]])
+      self.wait_for(lambda: len(self.live_values()) == 2)
+      # An edit on top of a stale state is rejected; the daemon refetches and retries.
+      daemon.reconcile_interval = 3600
+      self.route53.apply_changes(self.route53.zones[self.zone_id], [
+          ('UPSERT', r53.RRSet('mail.example.com.', 'A', ttl='60', values=['192.168.0.9']))])
+      r53.STATS.reset()
+      self.write('www A 192.168.0.4\n')
+      self.wait_for(lambda: r53.STATS.counters['batches'])
+      self.assertEqual(self.live_values(), [('www.example.com.', ('192.168.0.4',))])
+    finally:
+      daemon.stop()
+      thread.join()
+
+
+if __name__ == '__main__':
+    unittest.main()
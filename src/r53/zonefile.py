@@ -0,0 +1,233 @@
+"""Readers for zone data kept as RFC 1035 (BIND) zone files or as JSON, feeding
+the same RRSet pipeline as Route 53 XML."""
+
+import json
+import r53
+
+# Types whose rdata holds domain names, and which fields (counting from 0)
+# those are; relative names there are qualified with the origin.
+NAME_FIELDS = {
+    'CNAME': (0,),
+    'NS': (0,),
+    'PTR': (0,),
+    'MX': (1,),
+    'SRV': (3,),
+    'SOA': (0, 1),
+    }
+TTL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+CLASSES = ('IN', 'CH', 'HS', 'CS')
+
+
+class ZoneFileError(Exception):
+  """Raised on zone data that can't be read."""
+
+
+def _tokenize(f):
+  """Split a zone file into logical lines of tokens.
+
+  Handles ; comments, "quoted strings" (kept with their quotes) and
+  parentheses continuing a record across lines.
+
+  Yields: (line number, starts with whitespace, [ tokens ])"""
+  tokens = []
+  depth = 0
+  indented = False
+  start = 0
+  for lineno, line in enumerate(f, 1):
+    if depth == 0:
+      tokens = []
+      indented = line[:1] in (' ', '\t')
+      start = lineno
+    i = 0
+    n = len(line)
+    while i < n:
+      c = line[i]
+      if c in ' \t\r\n':
+        i += 1
+      elif c == ';':
+        break
+      elif c == '(':
+        depth += 1
+        i += 1
+      elif c == ')':
+        if depth == 0:
+          raise ZoneFileError('line %d: unbalanced )' % lineno)
+        depth -= 1
+        i += 1
+      elif c == '"':
+        j = i + 1
+        while j < n and line[j] != '"':
+          if line[j] == '\\':
+            j += 1
+          j += 1
+        if j >= n:
+          raise ZoneFileError('line %d: unterminated string' % lineno)
+        tokens.append(line[i:j + 1])
+        i = j + 1
+      else:
+        j = i
+        while j < n and line[j] not in ' \t\r\n;()"':
+          if line[j] == '\\':
+            j += 1
+          j += 1
+        tokens.append(line[i:j])
+        i = j
+    if depth == 0 and tokens:
+      yield start, indented, tokens
+  if depth:
+    raise ZoneFileError('line %d: unbalanced (' % start)
+
+
+def _ttl(token):
+  """Parse a TTL such as 3600 or 1h30m. Returns: int, or None if not a TTL."""
+  if token.isdigit():
+    return int(token)
+  total = 0
+  number = ''
+  for c in token.lower():
+    if c.isdigit():
+      number += c
+    elif c in TTL_UNITS and number:
+      total += int(number) * TTL_UNITS[c]
+      number = ''
+    else:
+      return None
+  if number:
+    return None
+  return total
+
+
+def _qualify(name, origin):
+  if name == '@':
+    return origin
+  if name.endswith('.'):
+    return name
+  return '%s.%s' % (name, origin)
+
+
+def iter_zonefile(f, origin, ttl=None):
+  """Stream the records of an RFC 1035 zone file.
+
+  Supports $ORIGIN, $TTL, @, relative names, owners carried over from the
+  previous record, TTLs with units and optional classes.
+
+  Args: f: file-like object.
+        origin: string, starting $ORIGIN eg. foursquare.com
+        ttl: int, default TTL until a $TTL directive.
+  Yields: (line number, name, type, ttl, rdata string)
+  Raises: ZoneFileError"""
+  origin = origin.rstrip('.') + '.'
+  owner = None
+  last_ttl = None
+  for lineno, indented, tokens in _tokenize(f):
+    first = tokens[0].upper()
+    if first == '$ORIGIN':
+      origin = _qualify(tokens[1], origin)
+      continue
+    if first == '$TTL':
+      ttl = _ttl(tokens[1])
+      continue
+    if first.startswith('$'):
+      raise ZoneFileError('line %d: unsupported directive %s' % (lineno, tokens[0]))
+    if not indented:
+      owner = _qualify(tokens.pop(0), origin)
+    elif owner is None:
+      raise ZoneFileError('line %d: record has no owner name' % lineno)
+    record_ttl = None
+    while tokens:
+      if tokens[0].upper() in CLASSES:
+        if tokens.pop(0).upper() != 'IN':
+          raise ZoneFileError('line %d: only class IN is supported' % lineno)
+      elif record_ttl is None and _ttl(tokens[0]) is not None:
+        record_ttl = _ttl(tokens.pop(0))
+      else:
+        break
+    if not tokens:
+      raise ZoneFileError('line %d: record has no type' % lineno)
+    rtype = tokens.pop(0).upper()
+    if record_ttl is None:
+      # RFC 1035: default to the last TTL given; RFC 2308: $TTL wins.
+      record_ttl = ttl if ttl is not None else last_ttl
+    if record_ttl is None:
+      raise ZoneFileError('line %d: record has no TTL and there is no $TTL' % lineno)
+    last_ttl = record_ttl
+    for i in NAME_FIELDS.get(rtype, ()):
+      if i < len(tokens):
+        tokens[i] = _qualify(tokens[i], origin)
+    yield lineno, owner, rtype, record_ttl, ' '.join(tokens)
+
+
+def parse_zonefile(f, origin, ttl=None):
+  """Read an RFC 1035 zone file into record sets, one per name and type.
+
+  Args: see iter_zonefile.
+  Returns: [ r53.RRSet ] in order of first appearance.
+  Raises: ZoneFileError"""
+  order = []
+  sets = {}
+  for lineno, name, rtype, record_ttl, rdata in iter_zonefile(f, origin, ttl):
+    # Owner names are case-insensitive: WWW and www are one record set.
+    name = r53.canonical_name(name)
+    key = (name, rtype)
+    if key not in sets:
+      order.append(key)
+      sets[key] = (record_ttl, [])
+    elif sets[key][0] != record_ttl:
+      r53.log.warning('line %d: TTL %d differs from %d used for the rest of %s %s' % (
+          lineno, record_ttl, sets[key][0], name, rtype))
+    if rdata not in sets[key][1]:
+      sets[key][1].append(rdata)
+  return [r53.RRSet(name, rtype, ttl=str(sets[(name, rtype)][0]), values=sets[(name, rtype)][1])
+          for name, rtype in order]
+
+
+def _text(value):
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return unicode(value)
+
+
+def parse_json(f):
+  """Read record sets in the JSON form used by the Route 53 API and the AWS
+  CLI: either {"ResourceRecordSets": [...]} or the bare list, with values as
+  [{"Value": "..."}] or plain strings.
+
+  Args: f: file-like object.
+  Returns: [ r53.RRSet ]
+  Raises: ZoneFileError"""
+  try:
+    doc = json.load(f)
+  except ValueError as e:
+    raise ZoneFileError('invalid JSON: %s' % e)
+  if isinstance(doc, dict):
+    if 'ResourceRecordSets' not in doc:
+      raise ZoneFileError('JSON object has no ResourceRecordSets')
+    doc = doc['ResourceRecordSets']
+  if not isinstance(doc, list):
+    raise ZoneFileError('expected a list of record sets, not %s' % type(doc).__name__)
+  rrsets = []
+  for i, item in enumerate(doc):
+    try:
+      name = item['Name']
+      rtype = item['Type']
+    except (KeyError, TypeError):
+      raise ZoneFileError('record set %d has no Name or Type' % i)
+    ttl = item.get('TTL')
+    values = []
+    for rr in item.get('ResourceRecords', []):
+      try:
+        values.append(rr['Value'] if isinstance(rr, dict) else rr)
+      except KeyError:
+        raise ZoneFileError('record set %d (%s %s) has a record with no Value' % (i, name, rtype))
+    extra = []
+    for field, value in item.items():
+      if field in ('Name', 'Type', 'SetIdentifier', 'TTL', 'ResourceRecords'):
+        continue
+      if isinstance(value, dict):
+        # RRSet puts the nested fields in order.
+        extra.append((field, tuple((k, _text(v)) for k, v in value.items())))
+      else:
+        extra.append((field, _text(value)))
+    rrsets.append(r53.RRSet(name, rtype, item.get('SetIdentifier'),
+                            None if ttl is None else _text(ttl), values, extra))
+  return rrsets
@@ -0,0 +1,78 @@
+import unittest
+import StringIO
+import r53
+import zonefile
+
+class ZoneFileTest(unittest.TestCase):
+  """Tests for functions in zonefile.py."""
+
+  def test_parse_zonefile(self):
+    f = StringIO.StringIO('''$TTL 1h
+@       IN  SOA  ns1 hostmaster (
+                 2011083100 ; serial
+                 7200 900 1209600 86400 )
+        IN  NS   ns2.example.net.
+        IN  NS   ns1
+www     300 IN CNAME @
+*       A   192.168.0.1
+mail    IN  MX   10 mx1
+        IN  MX   20 mx2.example.net.
+txt     TXT "v=spf1 include:example.net ~all" "a ; b"
+$ORIGIN sub.example.com.
+host    60  A 192.168.0.2
+        60  A 192.168.0.3
+''')
+    self.assertEqual(zonefile.parse_zonefile(f, 'example.com'), [
+        r53.RRSet('example.com.', 'SOA', ttl='3600',
+                  values=['ns1.example.com. hostmaster.example.com. 2011083100 7200 900 1209600 86400']),
+        r53.RRSet('example.com.', 'NS', ttl='3600', values=['ns1.example.com.', 'ns2.example.net.']),
+        r53.RRSet('www.example.com.', 'CNAME', ttl='300', values=['example.com.']),
+        r53.RRSet('\\052.example.com.', 'A', ttl='3600', values=['192.168.0.1']),
+        r53.RRSet('mail.example.com.', 'MX', ttl='3600', values=['10 mx1.example.com.', '20 mx2.example.net.']),
+        r53.RRSet('txt.example.com.', 'TXT', ttl='3600', values=['"v=spf1 include:example.net ~all" "a ; b"']),
+        r53.RRSet('host.sub.example.com.', 'A', ttl='60', values=['192.168.0.2', '192.168.0.3']),
+        ])
+
+  def test_parse_zonefile_mixed_case(self):
+    f = StringIO.StringIO('$TTL 60\nWWW IN A 192.168.0.1\nwww IN A 192.168.0.2\nWww.Example.Com. A 192.168.0.1\n')
+    config = zonefile.parse_zonefile(f, 'example.com')
+    self.assertEqual(config, [r53.RRSet('www.example.com.', 'A', ttl='60', values=['192.168.0.1', '192.168.0.2'])])
+    self.assertEqual(r53.check_config(config), [])
+
+  def test_parse_zonefile_errors(self):
+    self.assertRaises(zonefile.ZoneFileError, zonefile.parse_zonefile,
+                      StringIO.StringIO('www A 192.168.0.1\n'), 'example.com')
+    self.assertRaises(zonefile.ZoneFileError, zonefile.parse_zonefile,
+                      StringIO.StringIO('www 60 A (192.168.0.1\n'), 'example.com')
+    self.assertRaises(zonefile.ZoneFileError, zonefile.parse_zonefile,
+                      StringIO.StringIO('$INCLUDE other.zone\n'), 'example.com')
+
+  def test_parse_json(self):
+    f = StringIO.StringIO('''{"ResourceRecordSets": [
+      {"Name": "example.com.", "Type": "NS", "TTL": 172800,
+       "ResourceRecords": [{"Value": "ns2.example.com."}, {"Value": "ns1.example.com."}]},
+      {"Name": "*.example.com.", "Type": "A", "SetIdentifier": "west", "Weight": 10,
+       "AliasTarget": {"DNSName": "d111111abcdef8.cloudfront.net.", "EvaluateTargetHealth": false,
+                       "HostedZoneId": "Z2FDTNDATAQYW2"}}
+      ]}''')
+    self.assertEqual(zonefile.parse_json(f), [
+        r53.RRSet('example.com.', 'NS', ttl='172800', values=['ns1.example.com.', 'ns2.example.com.']),
+        r53.RRSet('\\052.example.com.', 'A', 'west', extra=[
+            ('Weight', '10'),
+            ('AliasTarget', (('HostedZoneId', 'Z2FDTNDATAQYW2'),
+                             ('DNSName', 'd111111abcdef8.cloudfront.net.'),
+                             ('EvaluateTargetHealth', 'false')))]),
+        ])
+    f = StringIO.StringIO('[{"Name": "www.example.com.", "Type": "A", "ResourceRecords": [{}]}]')
+    self.assertRaises(zonefile.ZoneFileError, zonefile.parse_json, f)
+
+  def test_parse_json_shape_errors(self):
+    for text in ('{"ResourceRecordSet": []}',
+                 '{"ResourceRecordSets": {"Name": "www.example.com."}}',
+                 '"www.example.com."'):
+      self.assertRaises(zonefile.ZoneFileError, zonefile.parse_json, StringIO.StringIO(text))
+    self.assertEqual(zonefile.parse_json(StringIO.StringIO('{"ResourceRecordSets": []}')), [])
+
+
+if __name__ == '__main__':
+    unittest.main()